@@ -1,42 +1,150 @@
 import os
-from datetime import datetime
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Request, Depends, BackgroundTasks
-from fastapi.responses import JSONResponse
-from passlib.hash import bcrypt
-from pymongo.mongo_client import MongoClient
-import openai
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Depends, BackgroundTasks
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from llm_scheduler import create_llm_scheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from cache import TTLCache, InvalidationBus
+from cache_backends import create_cache_backend
+from metrics import metrics
+from plan_codec import create_plan_codec, migrate_collection, storage_report
+from plan_store import PlanStore
+from plan_snapshot import PlanSnapshot
+from plan_reuse import GeneratedPlans, canonical_request, request_key, shift_plan_dates
+from pregeneration import DemandLog, create_pregenerator
+from plan_index import PlanIndex
+from plan_stream import IncrementalPlanParser
+from plan_fanout import split_trip, chunk_prompt, stitch
+from model_router import create_model_router
+from template_maintenance import compact_template, escape_clause, join_template, template_parts
+from tokens import estimate_tokens, count_tokens, fit_prompt, PromptTooLarge
+from idempotency import IdempotencyStore
+from generation_jobs import GenerationJobs
+from generation_eta import LatencyEstimator
+from plan_waiters import PlanWaiters
+from plan_sections import SECTION_MAX_TOKENS, select_section, section_prompt, merge_section
+from rate_limit import RateLimiter, LocalBucketStore, MongoBucketStore, rate_limit
+from admin_auth import admin_token
+from resources import resources
+import repository
+from repository import db, history_collection, history_read_collection, plans_collection, plan_blobs_collection, \
+    rate_limits_collection, cache_invalidations_collection
 from fastapi.middleware.cors import CORSMiddleware
 import json
+import math
 import asyncio
-
-app = FastAPI()
-origins = ["*"]
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+import time
+import logging
 
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
+logger = logging.getLogger("safeplan")
+
+# LLM configuration - LLM_BACKEND selects openai, stub, replay or record
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4-turbo")
 
-# MongoDB configuration
+# MongoDB configuration - the client itself is created per worker (resources.py), queries live in repository.py
 MONGO_DB = os.getenv("MONGO_DB")
 MONGODB_URL = MONGO_DB
-mongo_client = MongoClient(MONGODB_URL)
-db = mongo_client["safeplan"]
-users_collection = db["users"]
-templates_collection = db["templates"]
-history_collection = db['history']
-additionalData_collection = db['additionalData']
-plans_collection = db['plans']
+
+# Largest number of emails accepted by /get-users in one call
+USER_BATCH_MAX = int(os.getenv("USER_BATCH_MAX", "100"))
+# Documents fetched per cursor round trip by /export-history, and written per bulk_write by /import-history
+HISTORY_EXPORT_BATCH = int(os.getenv("HISTORY_EXPORT_BATCH", "100"))
+HISTORY_IMPORT_BATCH = int(os.getenv("HISTORY_IMPORT_BATCH", "500"))
+
+# Caches - SHARED_CACHE_BACKEND=sqlite or redis keeps one copy per host instead of one per worker
+# Profiles: read-through on /get-user(s), invalidated in every worker when a user changes
+profile_cache = TTLCache("profile", create_cache_backend(int(os.getenv("PROFILE_CACHE_MAX_ENTRIES", "10000"))),
+                         ttl=float(os.getenv("PROFILE_CACHE_TTL", "60")))
+# Templates: general-template and instructions, read on every generation
+template_cache = TTLCache("template", create_cache_backend(100), ttl=float(os.getenv("TEMPLATE_CACHE_TTL", "300")))
+# Plans: resolved plan bodies by hash
+plan_cache = TTLCache("plan", create_cache_backend(int(os.getenv("PLAN_CACHE_MAX_ENTRIES", "1000"))),
+                      ttl=float(os.getenv("PLAN_CACHE_TTL", "3600")))
+invalidation_bus = InvalidationBus(cache_invalidations_collection,
+                                   poll_interval=float(os.getenv("CACHE_INVALIDATION_POLL_SECONDS", "1")))
+invalidation_bus.register(profile_cache)
+invalidation_bus.register(template_cache)
+# Running plan generations - a new request for the same email cancels the previous one, on whichever worker it runs
+generation_jobs = GenerationJobs(invalidation_bus)
+# Completion estimates from recent model latency - GENERATION_DEFAULT_SECONDS until there are enough calls
+latency_estimator = LatencyEstimator(default_seconds=float(os.getenv("GENERATION_DEFAULT_SECONDS", "60")))
+# Pollers are asked to come back after the estimate, but not later than this (finished days arrive before the end)
+RETRY_AFTER_MAX = int(os.getenv("RETRY_AFTER_MAX_SECONDS", "30"))
+# Long polling - /get-improved-response?wait=N holds the request until the generation finishes, N at most this
+plan_waiters = PlanWaiters(invalidation_bus)
+LONG_POLL_MAX_SECONDS = float(os.getenv("LONG_POLL_MAX_SECONDS", "60"))
+
+# Plan storage - PLAN_CODEC=br or zstd stores plan bodies compressed, reads decode whatever is stored
+plan_codec = create_plan_codec()
+# Plan bodies are kept once in plan_blobs, plans and history hold references to them
+plan_store = PlanStore(plan_blobs_collection, plan_codec, cache=plan_cache)
+# The shared 'global' plan is served from memory as pre-serialized bytes
+global_plan = PlanSnapshot("global", plan_store, poll_interval=float(os.getenv("GLOBAL_PLAN_REFRESH_SECONDS", "5")))
+GLOBAL_PLAN_MAX_AGE = int(os.getenv("GLOBAL_PLAN_MAX_AGE", "60"))
+# Plans by canonical request - the same trip asked again (or pre-generated off-peak) needs no model call
+generated_plans = GeneratedPlans(repository.generated_plans_collection,
+                                 ttl_days=float(os.getenv("GENERATED_PLAN_TTL_DAYS", "7")))
+demand_log = DemandLog(repository.plan_demand_collection)
+# Retried requests with the same Idempotency-Key get the first response back instead of running again
+idempotency = IdempotencyStore(repository.idempotency_keys_collection,
+                               ttl_seconds=int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400")))
+# Fan-out - multi-city trips, and trips of PLAN_FANOUT_MIN_DAYS or more, are generated as concurrent chunks
+PLAN_FANOUT = os.getenv("PLAN_FANOUT", "off").lower() in ("1", "on", "true")
+PLAN_FANOUT_MIN_DAYS = int(os.getenv("PLAN_FANOUT_MIN_DAYS", "6"))
+PLAN_FANOUT_CHUNK_DAYS = int(os.getenv("PLAN_FANOUT_CHUNK_DAYS", "4"))
+# Model routing - model and output budget per request (MODEL_ROUTING=on adds a faster tier for simple trips)
+model_router = create_model_router(LLM_MODEL, repository.model_routing_collection)
+# Vacation templates are compacted to stay under this many tokens when analyze_data extends them
+TEMPLATE_MAX_TOKENS = int(os.getenv("TEMPLATE_MAX_TOKENS", "1500"))
+# Output budget of the template analysis (its answer is a short phrase or 'NOT FOUND')
+ANALYZE_MAX_TOKENS = int(os.getenv("ANALYZE_MAX_TOKENS", "300"))
+# Near-identical requests reuse a plan found through a local vector index (PLAN_SIMILARITY_MAX_DISTANCE=0 disables)
+plan_index = PlanIndex(os.getenv("PLAN_INDEX_PATH", "plan_index.npz"),
+                       max_distance=float(os.getenv("PLAN_SIMILARITY_MAX_DISTANCE", "0.15")))
+
+router = APIRouter()
+
+# /admin/* and the history export and import need the X-Admin-Token header to match ADMIN_TOKEN (refused while unset)
+require_admin = admin_token(os.getenv("ADMIN_TOKEN"))
+
+# Rate limiting of generation - RATE_LIMIT_STORE=mongo shares the buckets between workers, local keeps them per process
+if os.getenv("RATE_LIMIT_STORE", "mongo") == "local":
+    rate_limit_store = LocalBucketStore()
+else:
+    rate_limit_store = MongoBucketStore(rate_limits_collection)
+
+generate_limiter = RateLimiter(rate_limit_store, "generate",
+                               capacity=float(os.getenv("RATE_LIMIT_GENERATE_BURST", "5")),
+                               per_minute=float(os.getenv("RATE_LIMIT_GENERATE_PER_MINUTE", "2")))
+generate_global_limiter = RateLimiter(rate_limit_store, "generate-global",
+                                      capacity=float(os.getenv("RATE_LIMIT_GENERATE_GLOBAL_BURST", "60")),
+                                      per_minute=float(os.getenv("RATE_LIMIT_GENERATE_GLOBAL_PER_MINUTE", "60")))
+# Per address - shared by everyone behind the same NAT or proxy, so well above one user's allowance
+generate_ip_limiter = RateLimiter(rate_limit_store, "generate-ip",
+                                  capacity=float(os.getenv("RATE_LIMIT_GENERATE_IP_BURST", "30")),
+                                  per_minute=float(os.getenv("RATE_LIMIT_GENERATE_IP_PER_MINUTE", "20")))
+# Reads are limited in each worker - shared buckets would cost two Mongo writes per (often cached) read. Every one of
+# the WEB_CONCURRENCY workers gets its share of the limits
+WEB_WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "4")))
+read_bucket_store = LocalBucketStore()
+read_limiter = RateLimiter(read_bucket_store, "read",
+                           capacity=max(1.0, float(os.getenv("RATE_LIMIT_READ_BURST", "60")) / WEB_WORKERS),
+                           per_minute=float(os.getenv("RATE_LIMIT_READ_PER_MINUTE", "120")) / WEB_WORKERS)
+read_ip_limiter = RateLimiter(read_bucket_store, "read-ip",
+                              capacity=max(1.0, float(os.getenv("RATE_LIMIT_READ_IP_BURST", "300")) / WEB_WORKERS),
+                              per_minute=float(os.getenv("RATE_LIMIT_READ_IP_PER_MINUTE", "600")) / WEB_WORKERS)
+limit_generate = Depends(rate_limit(generate_limiter, generate_global_limiter, ip_limiter=generate_ip_limiter))
+limit_reads = Depends(rate_limit(read_limiter, ip_limiter=read_ip_limiter))
+# The global snapshot is public and served from memory
+limit_plan_reads = Depends(rate_limit(read_limiter, public_emails=(global_plan.email,), ip_limiter=read_ip_limiter))
 
 user_details = {}
-response_semaphore = asyncio.Semaphore(1)
+# Caps concurrent model calls in this worker, interactive generation before housekeeping
+llm_scheduler = create_llm_scheduler()
+# Keeps fire-and-forget tasks referenced until they finish
+background_jobs = set()
 
 
 # Define the User model
@@ -57,11 +165,11 @@ def get_db():
 def get_general_template():
     try:
         # Fetch the general-template from the database
-        temp = templates_collection.find_one({}, {"_id": 0, "general-template": 1})
+        temp = template_cache.get_or_load("general-template", lambda key: repository.find_general_template())
 
         # If template is found, return template data as JSON
         if temp:
-            return temp['general-template']
+            return temp
         else:
             raise HTTPException(status_code=404, detail="General template not found")
     except Exception as e:
@@ -71,60 +179,350 @@ def get_general_template():
 def get_instructions():
     try:
         # Fetch the instructions from the database
-        instructions_doc = templates_collection.find_one({"instructions": {"$exists": True}},
-                                                         {"_id": 0, "instructions": 1})
+        instructions = template_cache.get_or_load("instructions", lambda key: repository.find_instructions())
         # If instructions are found, return them
-        if instructions_doc and 'instructions' in instructions_doc:
-            return instructions_doc['instructions']
+        if instructions:
+            return instructions
         else:
             raise HTTPException(status_code=404, detail="Instructions not found")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-async def assist_improve_response(user_message, email):
+async def pregenerate_plan(data):
+    """Generates the plan for a past request at background priority, without touching the template rotation."""
+    template = repository.find_template(data['vacationType'])
+    if not template:
+        raise HTTPException(status_code=404, detail="Template not found")
+    user_message = format_trip_details(template["template"], data['vacationType'], data) + \
+        get_general_template() + get_instructions()
+    return await generate_plan(user_message, "pregenerate", PRIORITY_BACKGROUND, route=model_router.route(data))
+
+
+# Nightly pre-generation of the most requested trips (PREGENERATE_TOKEN_BUDGET > 0 enables it), asked at least
+# PREGENERATE_MIN_COUNT times for the same destination, vacation type and trip length
+pregenerator = create_pregenerator(demand_log, generated_plans, repository.scheduled_runs_collection,
+                                   pregenerate_plan)
+
+
+async def complete_plan(user_message, user, priority=PRIORITY_INTERACTIVE, on_progress=None, route=None):
+    """
+    Runs the prompt through the model, returns (plan, model result).
+    The answer is streamed - on_progress(partial plan) is called each time one more day of the plan is complete.
+    route (from model_router) picks the model and output budget, and gets the outcome recorded.
+    """
+    parser = IncrementalPlanParser() if on_progress is not None else None
+
+    def on_text(text):
+        nonlocal parser
+        if parser is None:
+            return
+        try:
+            completed = parser.feed(text)
+        except ValueError:
+            # Not a plan after all - json.loads below reports it
+            parser = None
+            return
+        if any(isinstance(parser.plan.get(key), list) for key in completed):
+            on_progress(parser.plan)
+
+    model = route.model if route else LLM_MODEL
+    # Counted locally - an oversized prompt is refused before a slot or a network call is spent on it
+    max_tokens = fit_prompt(user_message, model, route.max_tokens if route else 4096, "plan")
+    async with llm_scheduler.slot(user, priority):
+        job = generation_jobs.mark_running(user)
+        if job is not None:
+            await asyncio.to_thread(repository.set_job_state, user, job, "running")
+        started = time.monotonic()
+        try:
+            gpt_response = await resources.llm_backend().astream(
+                messages=[
+                    {
+                        "role": "user",
+                        "content": user_message
+                    }
+                ],
+                model=model,
+                temperature=1,
+                max_tokens=max_tokens,
+                json_mode=True,
+                on_text=on_text,
+            )
+        except Exception as e:
+            if route is not None:
+                await asyncio.to_thread(model_router.observe, route, time.monotonic() - started, error=str(e))
+            raise
+        seconds = time.monotonic() - started
+        latency_estimator.record(model, gpt_response.prompt_tokens, seconds)
+
+    trip_plan = gpt_response.content
+    plan = None
+    try:
+        plan = json.loads(trip_plan)
+    finally:
+        if route is not None:
+            await asyncio.to_thread(model_router.observe, route, seconds, gpt_response, plan)
+    return plan, gpt_response
+
+
+async def generate_plan(user_message, user, priority=PRIORITY_INTERACTIVE, on_progress=None, route=None):
+    """Same as complete_plan, with the plan stored - returns (plan reference, model result)."""
+    plan, gpt_response = await complete_plan(user_message, user, priority, on_progress, route)
+    return plan_store.put(plan), gpt_response
+
+
+async def generate_fanout_plan(user_message, email, chunks, route=None, on_progress=None):
+    """Generates the chunks of a trip concurrently (within the LLM concurrency cap) and stitches them together."""
+    parts = [None] * len(chunks)
+
+    async def generate_chunk(position):
+        parts[position], _ = await complete_plan(chunk_prompt(user_message, chunks[position], chunks), email,
+                                                 route=chunks[position].get("route"))
+        try:
+            # The days from day 1 up to the first chunk still running
+            partial = stitch(parts, chunks, partial=True)
+            if partial and on_progress is not None:
+                on_progress(partial)
+        except ValueError:
+            pass
+
+    started = time.monotonic()
+    failure = None
+    try:
+        # The first chunk that fails cancels the others - their tokens would be wasted
+        async with asyncio.TaskGroup() as group:
+            for position in range(len(chunks)):
+                group.create_task(generate_chunk(position))
+    except* ValueError as errors:
+        # Invalid or truncated JSON (json.JSONDecodeError is a ValueError)
+        failure = errors.exceptions[0]
+    metrics.observe("plan_fanout_seconds", time.monotonic() - started)
+    if failure is None:
+        try:
+            plan = stitch(parts, chunks)
+        except ValueError as e:
+            failure = e
+
+    if failure is not None:
+        # A chunk came back unusable - generate the trip in one piece instead
+        metrics.increment("plan_fanout_fallbacks")
+        logger.warning("Fan-out plan for %s not usable, generating in one piece: %s", email, failure)
+        plan_ref, _ = await generate_plan(user_message, email, on_progress=on_progress, route=route)
+        return plan_ref
+    return plan_store.put(plan)
+
+
+def save_progress(email: str, partial: dict, job: str = None):
+    # Pollers get the finished days (with a 202) while the rest is still being generated
     try:
-        gpt_response = openai.chat.completions.create(
-            model="gpt-4-turbo",  # Specify the GPT model
-            messages=[
-                {
-                    "role": "user",
-                    "content": user_message
-                }
-            ],
-            temperature=1,
-            max_tokens=4096,
-            response_format={"type": "json_object"},
-        )
+        if job is None:
+            repository.set_plan(email, dict(partial, partial=True))
+        else:
+            repository.set_job_plan(email, job, dict(partial, partial=True))
+    except Exception as e:
+        logger.warning("Partial plan for %s not saved: %s", email, e)
+
+
+class ProgressWriter:
+    """
+    Saves a generation's partial plans in a thread, one write at a time, so the stream isn't held up by Mongo.
+    Partials that arrive while a write is running are coalesced - only the latest one is written next.
+    """
 
-        trip_plan = gpt_response.choices[0].message.content.strip()
+    def __init__(self, email: str, job: str = None):
+        self.email = email
+        self.job = job
+        self.pending = None
+        self.task = None
+
+    def save(self, partial: dict):
+        # Called on the event loop, from the stream callback. The parser keeps appending to the plan's lists, so the
+        # thread gets its own (the elements themselves are complete and no longer change)
+        self.pending = {key: list(value) if isinstance(value, list) else value for key, value in partial.items()}
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._write())
+
+    async def _write(self):
+        while self.pending is not None:
+            partial, self.pending = self.pending, None
+            await asyncio.to_thread(save_progress, self.email, partial, self.job)
+
+    async def flush(self):
+        """Waits for the partial writes - a partial written after the finished plan would replace it."""
+        if self.task is not None:
+            await self.task
+
+
+async def assist_improve_response(user_message, email, request_details=None, chunks=None, route=None, job=None):
+    progress = ProgressWriter(email, job)
+    try:
+        if chunks:
+            plan_ref = await generate_fanout_plan(user_message, email, chunks, route, progress.save)
+        else:
+            plan_ref, _ = await generate_plan(user_message, email, on_progress=progress.save, route=route)
+        await progress.flush()
 
-        db.plans.update_one(
-            {"email": email},
-            {"$set": {"plan": json.loads(trip_plan)}}
-        )
+        if job is None:
+            repository.set_plan(email, plan_ref)
+        else:
+            # A newer request owns the plan by now - its result wins, this one is only kept for reuse
+            repository.set_job_plan(email, job, plan_ref, done=True)
+        if request_details is not None:
+            key = request_key(request_details)
+            generated_plans.put(key, request_details, plan_ref)
+            plan_index.add(key, request_details)
+        if email == global_plan.email:
+            # This worker serves the new plan right away, the others on their next poll
+            await asyncio.to_thread(global_plan.refresh)
+        plan_waiters.publish(email)
 
     except Exception as e:
+        if job is not None:
+            repository.clear_plan_job(email, job)
+            plan_waiters.publish(email)
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def generation_estimate(user_message, route, chunks):
+    """Expected seconds of model time - fan-out chunks run in waves of the worker's LLM concurrency."""
+    if not chunks:
+        return latency_estimator.estimate(route.model, count_tokens(user_message, route.model))
+    prompt = chunk_prompt(user_message, chunks[0], chunks)
+    longest = max(latency_estimator.estimate(chunk["route"].model, count_tokens(prompt, chunk["route"].model))
+                  for chunk in chunks)
+    return longest * math.ceil(len(chunks) / llm_scheduler.max_concurrency)
+
+
+def describe_generation(email: str, doc: dict):
+    """
+    Status of the email's plan - idle, queued, running, done or stopped (cancelled or failed part way).
+    Queued and running generations get an ETA, and their queue position when the job runs in this worker.
+    """
+    plan = doc.get("plan")
+    partial = isinstance(plan, dict) and plan.get("partial")
+    job = doc.get("job")
+    if not job:
+        return {"state": "done" if plan and not partial else "stopped" if partial else "idle"}
+
+    status = doc.get("job_status") or {}
+    state = status.get("state", "queued")
+    seconds = status.get("seconds") or latency_estimator.default_seconds
+    position = None
+    if generation_jobs.local_job(email) == job:
+        state = "running" if generation_jobs.is_running(job) else "queued"
+        position = llm_scheduler.position(email) if state == "queued" else None
+
+    if state == "running":
+        elapsed = (datetime.utcnow() - status["at"]).total_seconds() if status.get("at") else 0
+        eta = seconds - elapsed
+    else:
+        # The calls ahead share the worker's slots
+        eta = seconds * (1 + (position or 0) / llm_scheduler.max_concurrency)
+    eta = max(eta, 1)
+    return {
+        "state": state,
+        "position": position,
+        "etaSeconds": round(eta),
+        "estimatedCompletion": (datetime.utcnow() + timedelta(seconds=eta)).isoformat() + "Z",
+        "daysReady": len(plan.get("days") or []) if partial else 0,
+    }
+
+
+def plan_finished(doc: dict):
+    plan = doc.get("plan")
+    return bool(plan) and not (isinstance(plan, dict) and plan.get("partial"))
+
+
+def retry_after(status: dict):
+    if "etaSeconds" not in status:
+        return {}
+    return {"Retry-After": str(min(RETRY_AFTER_MAX, status["etaSeconds"]))}
+
+
+def supersede_generation(email: str, job, plan, status: dict = None):
+    """Gives the plan to job (None - nothing generating) and cancels the generation it replaces, if any."""
+    previous = repository.start_plan_job(email, job, plan, status)
+    if previous:
+        generation_jobs.cancel(previous)
+    if job is None:
+        plan_waiters.publish(email)
+
+
+def find_reusable_plan(key: str, request_details: dict):
+    """Plan generated for the same canonical request, else for the closest one in the vector index, else None."""
+    plan_ref = generated_plans.get(key)
+    metrics.increment("plan_reuse_hits" if plan_ref else "plan_reuse_misses")
+    if plan_ref or plan_index.max_distance <= 0:
+        return plan_ref
+
+    similar_key, _ = plan_index.nearest(request_details)
+    if similar_key is not None:
+        entry = generated_plans.get_entry(similar_key)
+        if not entry:
+            # Expired since it was indexed
+            plan_index.remove(similar_key)
+        else:
+            plan_ref = entry["plan"]
+            source_dates, dates = entry.get("request", {}).get("dates"), request_details.get("dates")
+            if source_dates != dates:
+                # Same trip length on other dates - the dates the plan quotes are shifted, no model call needed
+                plan = plan_store.resolve(plan_ref)
+                plan_ref = plan_store.put(shift_plan_dates(plan, source_dates, dates)) if plan else None
+                if plan_ref:
+                    generated_plans.put(key, request_details, plan_ref, "adapted")
+                    metrics.increment("plan_reuse_adapted")
+    plan_index.record(bool(plan_ref))
+    return plan_ref
+
+
 # Endpoint to generate responses
-@app.post("/generate-response")
-async def generate_response(request: Request, background_tasks: BackgroundTasks):
+@router.post("/generate-response", dependencies=[limit_generate])
+async def generate_response(request: Request):
+    email = request.query_params.get("email")
+    return await idempotency.run(request, f"generate-response:{email}", lambda: start_generation(request, email))
+
+
+async def start_generation(request: Request, email: str):
     try:
         data = await request.json()
-        email = request.query_params.get("email")
 
-        db.plans.update_one(
-            {"email": email},
-            {"$set": {"plan": []}}
-        )
+        details = read_user_details(data)
+        route = model_router.route(details)
+        template = repository.find_template(details["vacationType"])
+        try:
+            # Sized before get_user_details, so a refused request doesn't rotate templates or store additionalData
+            fit_prompt(format_trip_details(template["template"] if template else "", details["vacationType"], details) +
+                       get_general_template() + get_instructions(), route.model, route.max_tokens, "plan",
+                       record=False)
+        except PromptTooLarge as e:
+            return JSONResponse(content={"message": str(e)}, status_code=413)
 
         user_data = get_user_details(data)
+        request_details = canonical_request(data)
+        key = request_key(request_details)
+        demand_log.record(request_details, data)
+
+        # The same or a near-identical trip was generated before (or pre-generated off-peak) - no model call needed,
+        # unless the user asked for a new plan (?regenerate=true)
+        regenerate = request.query_params.get("regenerate", "").lower() in ("1", "true", "yes")
+        plan_ref = None if regenerate else find_reusable_plan(key, request_details)
+        if plan_ref:
+            supersede_generation(email, None, plan_ref)
+            return JSONResponse(content={"message": "Response generation initiated. Please check back later."},
+                                status_code=200)
+
         general_template = get_general_template()
         user_message = user_data + general_template + get_instructions()
 
-        background_tasks.add_task(assist_improve_response, user_message, email)
+        chunks = split_trip(data, PLAN_FANOUT_MIN_DAYS, PLAN_FANOUT_CHUNK_DAYS) if PLAN_FANOUT else []
+        for chunk in chunks:
+            chunk["route"] = model_router.route(data, days=chunk["last"] - chunk["first"] + 1, cities=1)
+
+        job = generation_jobs.new_id()
+        status = {"state": "queued", "at": datetime.utcnow(), "seconds": generation_estimate(user_message, route, chunks)}
+        supersede_generation(email, job, [], status)
+        generation_jobs.start(job, assist_improve_response(user_message, email, request_details, chunks, route, job),
+                              email)
 
         return JSONResponse(content={"message": "Response generation initiated. Please check back later."}, status_code=200)
 
@@ -132,45 +530,166 @@ async def generate_response(request: Request, background_tasks: BackgroundTasks)
         return HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/get-improved-response/{email}")
-async def get_improved_response(email: str):
+# Cancels the running plan generation of the email - the days already generated stay stored
+@router.post("/cancel-generation/{email}")
+async def cancel_generation(email: str):
+    try:
+        job = repository.find_plan_job(email)
+        if not job or repository.clear_plan_job(email, job).modified_count == 0:
+            raise HTTPException(status_code=404, detail="No plan generation running")
+        generation_jobs.cancel(job)
+        plan_waiters.publish(email)
+        return JSONResponse(content={"message": "Plan generation cancelled"}, status_code=200)
+
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 
+# Where the email's plan generation is - state, queue position and estimated completion
+@router.get("/generation-status/{email}", dependencies=[limit_reads])
+async def generation_status(email: str):
     try:
-        # Query the database to find the user by email
-        plans = plans_collection.find({"email": email})
+        doc = repository.find_plan_status(email)
+        if doc is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        status = describe_generation(email, doc)
+        return JSONResponse(content=status, status_code=200, headers=retry_after(status))
 
-        # If user is found, return user data as JSON
-        if plans:
-            for plan in plans:
-                plan["_id"] = str(plan["_id"])
-                plan = plan["plan"]
-                if not plan == []:
-                    if email == 'global':
-                        plan["saveable"] = False
-                    else:
-                        plan["saveable"] = True
-                    return JSONResponse(content=plan, status_code=200)
-                else:
-                    return JSONResponse(
-                        content={"message": "No improved response available yet. Please try again later."},
-                        status_code=503)
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/get-improved-response/{email}", dependencies=[limit_plan_reads])
+async def get_improved_response(email: str, request: Request):
+
+    try:
+        if email == global_plan.email:
+            body, etag = global_plan.current()
+            if body is not None:
+                headers = {"ETag": etag, "Cache-Control": f"public, max-age={GLOBAL_PLAN_MAX_AGE}"}
+                if request.headers.get("if-none-match") == etag:
+                    return Response(status_code=304, headers=headers)
+                return Response(content=body, media_type="application/json", headers=headers)
+
+        try:
+            wait = min(float(request.query_params.get("wait") or 0), LONG_POLL_MAX_SECONDS)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="wait must be a number of seconds")
+
+        # Registered before the read, so a generation finishing in between still wakes this request
+        event = plan_waiters.watch(email) if wait > 0 else None
+        try:
+            # Query the database for the user's plan and the state of its generation only
+            doc = repository.find_plan_status(email) or {}
+            if event is not None and not plan_finished(doc) and await plan_waiters.wait(event, wait):
+                doc = repository.find_plan_status(email) or {}
+        finally:
+            if event is not None:
+                plan_waiters.unwatch(email, event)
+
+        plan = doc.get("plan")
+        # If a plan is ready, return it as JSON
+        if plan:
+            plan = plan_store.resolve(plan)
+            if plan is None:
+                # The reference points to a body that is gone
+                raise HTTPException(status_code=404, detail="Plan not found, please generate it again")
+            if plan.get("partial"):
+                # Still generating - the days finished so far
+                return JSONResponse(content=dict(plan, saveable=False), status_code=202,
+                                    headers=retry_after(describe_generation(email, doc)))
+            if email == 'global':
+                plan["saveable"] = False
+            else:
+                plan["saveable"] = True
+            return JSONResponse(content=plan, status_code=200)
         else:
             return JSONResponse(content={"message": "No improved response available yet. Please try again later."},
-                                     status_code=503)
+                                status_code=503, headers=retry_after(describe_generation(email, doc)))
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# Regenerates one section of the stored plan (e.g. {"section": "restaurants", "days": [2], "constraint": "vegan"})
+@router.post("/regenerate-section/{email}", dependencies=[limit_generate])
+async def regenerate_section(email: str, request: Request):
+    try:
+        data = await request.json()
+        section = data["section"]
+        constraint = data["constraint"]
+        days = data.get("days")
+
+        stored = repository.find_plan(email)
+        if not stored:
+            raise HTTPException(status_code=404, detail="No plan to update")
+        plan = plan_store.resolve(stored)
+        if plan is None:
+            raise HTTPException(status_code=404, detail="Plan not found, please generate it again")
+        plan.pop("saveable", None)
+
+        try:
+            current = select_section(plan, section, set(days) if days is not None else None)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        prompt = section_prompt(current, constraint, plan.get("title"))
+        try:
+            max_tokens = fit_prompt(prompt, LLM_MODEL, SECTION_MAX_TOKENS, "section")
+        except PromptTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
+
+        async with llm_scheduler.slot(email, PRIORITY_INTERACTIVE):
+            gpt_response = await resources.llm_backend().acomplete(
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt
+                    }
+                ],
+                model=LLM_MODEL,
+                temperature=1,
+                max_tokens=max_tokens,
+                json_mode=True,
+            )
+
+        try:
+            updated = merge_section(plan, current, json.loads(gpt_response.content), section)
+        except ValueError as e:
+            raise HTTPException(status_code=502, detail=f"Section could not be regenerated: {e}")
+
+        # Only replace the plan that was read - a new generation started meanwhile wins
+        if repository.replace_plan(email, stored, plan_store.put(updated)).matched_count == 0:
+            raise HTTPException(status_code=409, detail="The plan changed while regenerating, please try again")
+        if email == global_plan.email:
+            await asyncio.to_thread(global_plan.refresh)
+
+        updated["saveable"] = email != global_plan.email
+        return JSONResponse(content=updated, status_code=200)
+
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 # New API endpoint to check if email and password are valid
-@app.post("/check-credentials")
+@router.post("/check-credentials")
 async def check_credentials(request: Request, db=Depends(get_db)):
     try:
         data = await request.json()
         email = data["email"]
         password = data["password"]
 
-        # Retrieve user from MongoDB based on email
-        user = db.users.find_one({"email": email})
+        from passlib.hash import bcrypt
+
+        # Retrieve only the password hash from MongoDB based on email
+        user = repository.find_credentials(email)
 
         if user:  # Check if user exists
             # Get the stored password hash from the user data
@@ -191,7 +710,7 @@ async def check_credentials(request: Request, db=Depends(get_db)):
 
 
 # New API endpoint to add a new user to the database
-@app.post("/add-user")
+@router.post("/add-user")
 async def add_user(request: Request, db=Depends(get_db)):
     try:
         data = await request.json()
@@ -201,10 +720,10 @@ async def add_user(request: Request, db=Depends(get_db)):
         terms = data["terms"]
 
         # Check if the email already exists in the database
-        existing_users = db.users.find({"email": email})
-        for user in existing_users:
-            if user:
-                raise HTTPException(status_code=400, detail="Email already exists")
+        if repository.user_exists(email):
+            raise HTTPException(status_code=400, detail="Email already exists")
+
+        from passlib.hash import bcrypt
 
         # Hash the password using bcrypt (for security)
         hashed_password = bcrypt.hash(password)
@@ -212,10 +731,9 @@ async def add_user(request: Request, db=Depends(get_db)):
         # Create a new user object
         new_user = {"email": email, "password": hashed_password, "fullName": full_name, "terms": terms}
 
-        # Insert the new user into the database
-        db.users.insert_one(new_user)
-        db.history.insert_one({"email": email})
-        db.plans.insert_one({"email": email, "plan": []})
+        # Insert the new user (and its empty history and plan) into the database
+        repository.insert_user(new_user)
+        invalidation_bus.publish(profile_cache.name, email)
 
         return JSONResponse(content={"message": "User added successfully"}, status_code=201)
 
@@ -223,14 +741,15 @@ async def add_user(request: Request, db=Depends(get_db)):
         return HTTPException(status_code=500, detail=str(e))
 
 
-@app.put("/update-user/{email}")
+@router.put("/update-user/{email}")
 async def update_user(email: str, request: Request):
     try:
         # Parse request JSON data
         data = await request.json()
 
         # Update user information in the database
-        result = db.users.update_one({"email": email}, {"$set": data})
+        result = repository.update_user(email, data)
+        invalidation_bus.publish(profile_cache.name, email)
 
         if result.modified_count == 1:
             return {"message": "User updated successfully"}
@@ -243,24 +762,61 @@ async def update_user(email: str, request: Request):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/get-user/{email}")
+@router.get("/get-user/{email}", dependencies=[limit_reads])
 async def get_user(email: str):
     try:
-        # Query the database to find the user by email
-        users = users_collection.find({"email": email})
+        # Served from the profile cache, or the database (without the password hash) on a miss
+        user = profile_cache.get_or_load(email, load_user_profile)
 
         # If user is found, return user data as JSON
-        if users:
-            for user in users:
-                user["_id"] = str(user["_id"])
-                user = convert_to_json_serializable(user)
-                return JSONResponse(content=user, status_code=200)
+        if user:
+            return JSONResponse(content=user, status_code=200)
         else:
             raise HTTPException(status_code=404, detail="User not found")
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/get-users", dependencies=[limit_reads])
+async def get_users(request: Request):
+    try:
+        data = await request.json()
+        emails = data.get("emails")
+
+        if not isinstance(emails, list) or not emails:
+            raise HTTPException(status_code=400, detail="A non-empty list of emails is required")
+
+        # Keep the order of first appearance, drop repeated emails
+        emails = list(dict.fromkeys(emails))
+        if len(emails) > USER_BATCH_MAX:
+            raise HTTPException(status_code=400, detail=f"At most {USER_BATCH_MAX} emails per request")
+
+        # Cached profiles first, then one query for all the misses, without the password hash
+        users = profile_cache.get_many_or_load(emails, load_user_profiles)
+        return JSONResponse(content=users, status_code=200)
+
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def serialize_user_profile(user):
+    user["_id"] = str(user["_id"])
+    return convert_to_json_serializable(user)
+
+
+def load_user_profile(email: str):
+    user = repository.find_user_profile(email)
+    return serialize_user_profile(user) if user else None
+
+
+def load_user_profiles(emails):
+    return {user["email"]: serialize_user_profile(user) for user in repository.find_user_profiles(emails)}
+
+
 def convert_to_json_serializable(user):
     """Converts datetime objects to ISO 8601 formatted strings."""
     for key, value in user.items():
@@ -269,7 +825,7 @@ def convert_to_json_serializable(user):
     return user
 
 
-@app.get("/test-connection")
+@router.get("/test-connection")
 async def test_connection():
     try:
         return MONGO_DB
@@ -277,209 +833,208 @@ async def test_connection():
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.put("/update-user-history/{email}")
+@router.put("/update-user-history/{email}")
 async def update_user_history(email: str, request: Request):
+    return await idempotency.run(request, f"update-user-history:{email}", lambda: append_history(email, request))
+
+
+async def append_history(email: str, request: Request):
     try:
         # Parse request JSON data
         data = await request.json()
 
-        user = db.history.find_one({"email": email})
+        # Append with the next index in one atomic update - a new entry starts from index 1
+        index = repository.push_history_item(email, plan_store.put(data))
 
-        if user:
-            # If user exists, get the latest index and increment it
-            index = user.get("latest_index", 0) + 1
-            history_item = {
-                "index": index,
-                "data": data,
-            }
-
-            # Update user information in the database
-            result = db.history.update_one(
-                {"email": email},
-                {"$push": {"history": history_item}, "$set": {"latest_index": index}}
-            )
+        return JSONResponse(content={"message": "User history created successfully", "index": index}, status_code=200)
 
-            if result.modified_count == 1:
-                return JSONResponse(content={"message": "User history created successfully", "index": index}, status_code=200)
-            else:
-                raise HTTPException(status_code=500, detail="Failed to update user history")
-        else:
-            # If user not found, create a new entry with index 1
-            index = 1
-            history_item = {
-                "index": index,  # Start index from 1
-                "data": data
-            }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-            db.history.insert_one({
-                "email": email,
-                "history": [history_item],
-                "latest_index": index
-            })
 
-            return JSONResponse(content={"message": "User history created successfully", "index": index}, status_code=200)
+@router.delete("/remove-from-history/{email}/{index}")
+async def remove_from_history(email: str, index: int):
+    try:
+        result = repository.remove_history_item(email, index)
+
+        if result.matched_count == 0:
+            raise HTTPException(status_code=404, detail="User not found")
+        if result.modified_count == 1:
+            return JSONResponse(content={"message": f"Item at index {index} removed from user history "
+                                                    f"successfully"}, status_code=200)
+        else:
+            raise HTTPException(status_code=500, detail="Failed to remove item from user history")
 
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.delete("/remove-from-history/{email}/{index}")
-async def remove_from_history(email: str, index: int):
+@router.get("/get-user-history/{email}", dependencies=[limit_reads])
+async def get_user_history(email: str):
     try:
-        user = db.history.find_one({"email": email})
+        # Query the database for the user's history only
+        history = repository.find_history(email)
 
-        if user:
-            result = db.history.update_one(
-                {"email": email},
-                {"$pull": {"history": {"index": index}}}
-            )
+        # If history is found, return it as JSON
+        if history is not None:
+            return JSONResponse(content=plan_store.resolve_history(history), status_code=200)
+        else:
+            raise HTTPException(status_code=404, detail="History not found")
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-            if result.modified_count == 1:
-                return JSONResponse(content={"message": f"Item at index {index} removed from user history "
-                                                        f"successfully"}, status_code=200)
 
-            else:
-                raise HTTPException(status_code=500, detail="Failed to remove item from user history")
+def export_history_lines():
+    from bson import json_util
+
+    def dump(batch):
+        # Plans referenced by the whole batch are resolved with a single lookup
+        items = [item for user in batch for item in user.get("history") or []]
+        plans = plan_store.resolve_many([item.get("data") for item in items])
+        for item, plan in zip(items, plans):
+            item["data"] = plan
+        return "".join(json_util.dumps(user) + "\n" for user in batch)
+
+    # Server-side cursor - only one batch of users is held in memory at a time
+    cursor = history_read_collection.find({}, {"_id": 0}).batch_size(HISTORY_EXPORT_BATCH)
+    try:
+        batch = []
+        for user in cursor:
+            batch.append(user)
+            if len(batch) >= HISTORY_EXPORT_BATCH:
+                yield dump(batch)
+                batch = []
+        if batch:
+            yield dump(batch)
+    finally:
+        cursor.close()
 
-        else:
-            raise HTTPException(status_code=404, detail="User not found")
 
+@router.get("/export-history", dependencies=[Depends(require_admin)])
+async def export_history():
+    try:
+        return StreamingResponse(export_history_lines(), media_type="application/x-ndjson")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/get-user-history/{email}")
-async def get_user_history(email: str):
+@router.post("/import-history", dependencies=[Depends(require_admin)])
+async def import_history(request: Request):
+    from bson import json_util
+    from pymongo import ReplaceOne
+
+    imported = 0
+    line_number = 0
+    users = []
+
+    def write(batch):
+        # Plans go to the plan store first, history items keep references to them
+        items = [item for user in batch for item in user.get("history") or []]
+        refs = plan_store.put_many([item.get("data") for item in items])
+        for item, ref in zip(items, refs):
+            item["data"] = ref
+        operations = [ReplaceOne({"email": user["email"]}, user, upsert=True) for user in batch]
+        return history_collection.bulk_write(operations, ordered=False)
+
+    def parse(line):
+        user = json_util.loads(line)
+        if "email" not in user:
+            raise ValueError("missing email")
+        users.append(user)
+
+    async def flush():
+        nonlocal imported, users
+        if users:
+            batch, users = users, []
+            result = await asyncio.to_thread(write, batch)
+            imported += result.upserted_count + result.matched_count
+
     try:
-        # Query the database to find the user by email
-        users = history_collection.find({"email": email})
+        # Read the body as it arrives, one user per line
+        pending = b""
+        async for chunk in request.stream():
+            pending += chunk
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                line_number += 1
+                if not line.strip():
+                    continue
+                parse(line)
+                if len(users) >= HISTORY_IMPORT_BATCH:
+                    await flush()
+
+        if pending.strip():
+            line_number += 1
+            parse(pending)
+        await flush()
+
+        return JSONResponse(content={"message": "User history imported successfully", "imported": imported},
+                            status_code=200)
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid line {line_number}: {e} "
+                                                    f"({imported} users imported before the error)")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # If user is found, return user data as JSON
-        if users:
-            for user in users:
-                user["_id"] = str(user["_id"])
-                if "history" in user:
-                    user = user["history"]
-                else:
-                    raise HTTPException(status_code=404, detail="History not found")
-                return JSONResponse(content=user, status_code=200)
+
+USER_DETAIL_FIELDS = ("vacationType", "originCountry", "destCountry", "dates", "ages", "returnCountry", "budget",
+                      "hotel", "stars", "parking", "beach", "restaurants", "bars", "cities", "carRentalCompany",
+                      "dietaryPreferences", "additionalData", "adultsAmount", "childrenAmount")
+
+
+def read_user_details(data):
+    """The trip fields of the request - a missing one is a 500 naming the field."""
+    try:
+        if data:
+            return {field: data[field] for field in USER_DETAIL_FIELDS}
         else:
-            raise HTTPException(status_code=404, detail="User not found")
+            raise HTTPException(status_code=404, detail="User Details not found")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 def get_user_details(data):
     global user_details
+    # Save user details globally
+    user_details = read_user_details(data)
     try:
-        if data:
-            # Save user details globally
-            user_details = {
-                'vacationType': data['vacationType'],
-                'originCountry': data['originCountry'],
-                'destCountry': data['destCountry'],
-                'dates': data['dates'],
-                'ages': data['ages'],
-                'returnCountry': data['returnCountry'],
-                'budget': data['budget'],
-                'hotel': data['hotel'],
-                'stars': data['stars'],
-                'parking': data['parking'],
-                'beach': data['beach'],
-                'restaurants': data['restaurants'],
-                'bars': data['bars'],
-                'cities': data['cities'],
-                'carRentalCompany': data['carRentalCompany'],
-                'dietaryPreferences': data['dietaryPreferences'],
-                'additionalData': data['additionalData'],
-                'adultsAmount': data['adultsAmount'],
-                'childrenAmount': data['childrenAmount']
-            }
-
-            return get_templates(user_details['vacationType'])
-
-        else:
-            raise HTTPException(status_code=404, detail="User Details not found")
+        return get_templates(user_details['vacationType'])
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 def get_templates(vacation_type: str):
     try:
-        templates = templates_collection.find({"vacationType": vacation_type})
-
-        additional_data_template = additionalData_collection.find_one({"vacationType": vacation_type})
+        # Advance the template index (0-9) and read the template in one atomic round trip
+        temp = repository.rotate_template(vacation_type)
 
         # If template is found, return template data as JSON
-        if templates:
-            for temp in templates:
-                new_index = (temp.get("index", 0) + 1) % 10  # Get the current index or default to 0 if it doesn't exist
-                templates_collection.update_one(
-                    {"_id": temp["_id"]},
-                    {"$set": {"index": new_index}}
-                )
-                temp["_id"] = str(temp["_id"])
-                temp = temp["template"]
-                return set_data_to_templates(temp, additional_data_template, vacation_type, new_index)
-
+        if temp:
+            return set_data_to_templates(temp["template"], vacation_type, temp["index"])
         else:
             raise HTTPException(status_code=404, detail="Template not found")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-def set_data_to_templates(template: str, additional_data_template, vacation_type: str, index):
+def set_data_to_templates(template: str, vacation_type: str, index):
     try:
         if index == 9:
-            analyze_data(vacation_type)
-        if not user_details['returnCountry'] == 'As destination country':
-            template += f"We would like to return from the country {user_details['returnCountry']}. " \
-                        f"When the trip will include travel to this country. "
-        if not user_details['cities'] == '':
-            template += f"In {user_details['destCountry']} we would like to travel in the cities " \
-                        f"{user_details['cities']}. "
-        if not user_details['adultsAmount'] is None:
-            if vacation_type == "Couple Vacation":
-                amount = user_details['adultsAmount'] * 2
-                template += f"We are {amount} adults. "
-            else:
-                template += f"We are {user_details['adultsAmount']} adults. "
-        if not user_details['childrenAmount'] is None and vacation_type == "Family Vacation":
-            template += f"Please includes {user_details['childrenAmount']} children. "
-        if not user_details['carRentalCompany'] == '':
-            template += f"In addition, notice that {user_details['carRentalCompany']} - for rent a car. "
-        if not user_details['dietaryPreferences'] == '':
-            template += f"Notice that I have dietary preferences - {user_details['dietaryPreferences']}," \
-                        f" so take this figure into account when you suggest me recommended restaurants and dishes. "
-        if not user_details['bars'] == '':
-            template += f"About bars - {user_details['bars']}. "
-        if not user_details['beach'] == '':
-            template += f"About beach - {user_details['beach']}. "
-        if not user_details['parking'] == '':
-            template += f"About parking - {user_details['parking']}. "
-        if not user_details['restaurants'] == '':
-            template += f"About restaurants - {user_details['restaurants']}. "
-        if not user_details['hotel'] == '':
-            template += f"About the hotel - {user_details['hotel']}. "
+            # Housekeeping runs in the background at low priority instead of blocking this request
+            job = asyncio.get_running_loop().create_task(analyze_data(vacation_type))
+            background_jobs.add(job)
+            job.add_done_callback(background_jobs.discard)
+
+        formatted_trip_details = format_trip_details(template, vacation_type, user_details)
+
         if not user_details['additionalData'] == []:
-            for additional in user_details['additionalData']:
-                template += f"In addition, it is important - {additional}. "
-
-                # Define the additional data to push
-                data = additional
-                result = additionalData_collection.update_one(
-                    {"_id": additional_data_template["_id"]},
-                    {"$push": {"data": data}}
-                )
-
-        # Replace placeholders with variables
-        formatted_trip_details = template.format(ages=user_details['ages'], date1=str(user_details['dates'][0]),
-                                                 date2=str(user_details['dates'][1]),
-                                                 from_country=user_details['originCountry'],
-                                                 to_country=user_details['destCountry'],
-                                                 budget1=str(user_details['budget'][0]),
-                                                 budget2=str(user_details['budget'][1]),
-                                                 stars=str(user_details['stars']))
+            # Push all the additional data in a single update
+            repository.push_additional_data(vacation_type, user_details['additionalData'])
 
         return formatted_trip_details
 
@@ -487,46 +1042,93 @@ def set_data_to_templates(template: str, additional_data_template, vacation_type
         raise HTTPException(status_code=500, detail=str(e))
 
 
-def assist_analyze_data(user_message):
+def format_trip_details(template: str, vacation_type: str, details: dict):
+    """Fills the vacation template with the trip details. No side effects, so pre-generation can use it too."""
+    if not details['returnCountry'] == 'As destination country':
+        template += f"We would like to return from the country {details['returnCountry']}. " \
+                    f"When the trip will include travel to this country. "
+    if not details['cities'] == '':
+        template += f"In {details['destCountry']} we would like to travel in the cities " \
+                    f"{details['cities']}. "
+    if not details['adultsAmount'] is None:
+        if vacation_type == "Couple Vacation":
+            amount = details['adultsAmount'] * 2
+            template += f"We are {amount} adults. "
+        else:
+            template += f"We are {details['adultsAmount']} adults. "
+    if not details['childrenAmount'] is None and vacation_type == "Family Vacation":
+        template += f"Please includes {details['childrenAmount']} children. "
+    if not details['carRentalCompany'] == '':
+        template += f"In addition, notice that {details['carRentalCompany']} - for rent a car. "
+    if not details['dietaryPreferences'] == '':
+        template += f"Notice that I have dietary preferences - {details['dietaryPreferences']}," \
+                    f" so take this figure into account when you suggest me recommended restaurants and dishes. "
+    if not details['bars'] == '':
+        template += f"About bars - {details['bars']}. "
+    if not details['beach'] == '':
+        template += f"About beach - {details['beach']}. "
+    if not details['parking'] == '':
+        template += f"About parking - {details['parking']}. "
+    if not details['restaurants'] == '':
+        template += f"About restaurants - {details['restaurants']}. "
+    if not details['hotel'] == '':
+        template += f"About the hotel - {details['hotel']}. "
+    if not details['additionalData'] == []:
+        for additional in details['additionalData']:
+            template += f"In addition, it is important - {additional}. "
+
+    # Replace placeholders with variables
+    formatted_trip_details = template.format(ages=details['ages'], date1=str(details['dates'][0]),
+                                             date2=str(details['dates'][1]),
+                                             from_country=details['originCountry'],
+                                             to_country=details['destCountry'],
+                                             budget1=str(details['budget'][0]),
+                                             budget2=str(details['budget'][1]),
+                                             stars=str(details['stars']))
+
+    return formatted_trip_details
+
+
+async def assist_analyze_data(user_message):
     try:
-        gpt_response = openai.chat.completions.create(
-            model="gpt-4-turbo",  # Specify the GPT model
-            messages=[
-                {
-                    "role": "user",
-                    "content": user_message
-                }
-            ],
-            temperature=1,
-            max_tokens=2500,
-        )
+        max_tokens = fit_prompt(user_message, LLM_MODEL, ANALYZE_MAX_TOKENS, "analysis")
+        async with llm_scheduler.slot("analyze-data", PRIORITY_BACKGROUND):
+            gpt_response = await resources.llm_backend().acomplete(
+                messages=[
+                    {
+                        "role": "user",
+                        "content": user_message
+                    }
+                ],
+                model=LLM_MODEL,
+                temperature=1,
+                max_tokens=max_tokens,
+            )
 
-        response = gpt_response.choices[0].message.content.strip()
+        response = gpt_response.content
         return response
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-def analyze_data(vacation_type: str):
+async def analyze_data(vacation_type: str):
     try:
-        additional_data_template = additionalData_collection.find_one({"vacationType": vacation_type})
+        additional_data_template = repository.find_additional_data(vacation_type)
 
         if additional_data_template:
-            response = assist_analyze_data("Please review the array: " + str(additional_data_template['data']) +
+            response = await assist_analyze_data("Please review the array: " + str(additional_data_template['data']) +
                                            " If you find something that returns many times, just send it back,"
                                            " without any other words. if didn't found - return 'NOT FOUND'")
             if not response == 'NOT FOUND':
-                templates = templates_collection.find_one({"vacationType": vacation_type})
-                templates_collection.update_one(
-                    {"_id": templates["_id"]},
-                    {"$set": {"template": templates["template"] + " In addition, " + response}}
-                )
+                templates = repository.find_template_for_update(vacation_type)
+                base, additions = template_parts(templates)
+                compacted = compact_template(base, additions + [escape_clause(response)], TEMPLATE_MAX_TOKENS)
+                # Nothing new when the clause was already in the template
+                if compacted != additions:
+                    repository.save_template_version(templates["_id"], base, compacted, "analyze")
 
-                additionalData_collection.update_one(
-                    {"_id": additional_data_template["_id"]},
-                    {"$set": {"data": []}}
-                )
+                repository.clear_additional_data(additional_data_template["_id"])
 
         else:
             raise HTTPException(status_code=404, detail="Template not found")
@@ -535,7 +1137,7 @@ def analyze_data(vacation_type: str):
         return HTTPException(status_code=500, detail=str(e))
 
 
-@app.put("/update-general-template")
+@router.put("/update-general-template")
 async def update_general_template(request: Request):
     try:
         # Parse request JSON data
@@ -552,7 +1154,9 @@ async def update_general_template(request: Request):
         data.pop("general-template", None)
 
         # Update general-template in the database along with other information
-        result = db.templates.update_one({}, {"$set": {"general-template": new_template, **data}})
+        result = repository.update_general_template(new_template, data)
+        invalidation_bus.publish(template_cache.name, "general-template")
+        invalidation_bus.publish(template_cache.name, "instructions")
 
         if result.modified_count == 1:
             return {"message": "General template updated successfully"}
@@ -565,7 +1169,111 @@ async def update_general_template(request: Request):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/")
+def migrate_plan_storage():
+    try:
+        # Inline plans move to the plan store, then stored bodies are re-encoded with the current codec
+        migrated = plan_store.migrate_collection(plans_collection, "plan")
+        migrated += plan_store.migrate_collection(history_collection, "history")
+        if plan_codec.name != "none":
+            migrated += migrate_collection(plan_blobs_collection, "body", plan_codec)
+        metrics.increment("plan_storage_migrated_documents", migrated)
+    except Exception as e:
+        metrics.increment("plan_storage_migration_errors")
+        logger.exception("Plan storage migration failed: %s", e)
+
+
+@router.post("/admin/migrate-plan-storage", dependencies=[Depends(require_admin)])
+async def start_plan_storage_migration(background_tasks: BackgroundTasks):
+    try:
+        background_tasks.add_task(migrate_plan_storage)
+        return JSONResponse(content={"message": f"Migration to the plan store ('{plan_codec.name}' codec) started"},
+                            status_code=202)
+
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/admin/plan-storage-stats", dependencies=[Depends(require_admin)])
+async def get_plan_storage_stats():
+    try:
+        # Scans the three collections in threads, off the event loop - meant for occasional admin use
+        plans, history, plan_blobs = await asyncio.gather(
+            asyncio.to_thread(storage_report, plans_collection, "plan"),
+            asyncio.to_thread(storage_report, history_collection, "history"),
+            asyncio.to_thread(storage_report, plan_blobs_collection, "body"))
+        report = {"codec": plan_codec.name, "plans": plans, "history": history, "plan_blobs": plan_blobs}
+        return JSONResponse(content=report, status_code=200)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/admin/plan-store-gc", dependencies=[Depends(require_admin)])
+async def plan_store_gc():
+    try:
+        deleted = await asyncio.to_thread(plan_store.collect_garbage, plans_collection, history_collection,
+                                        repository.generated_plans_collection)
+        return JSONResponse(content={"message": "Unreferenced plans removed", "deleted": deleted}, status_code=200)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/admin/compact-templates", dependencies=[Depends(require_admin)])
+async def compact_templates():
+    try:
+        compacted = []
+        for template in repository.find_vacation_templates():
+            base, additions = template_parts(template)
+            kept = compact_template(base, additions, TEMPLATE_MAX_TOKENS)
+            # Templates saved before base and additions were kept apart are stored split, even when nothing is dropped
+            if kept != additions or "base" not in template:
+                version = repository.save_template_version(template["_id"], base, kept, "compact")
+                compacted.append({"vacationType": template["vacationType"], "version": version,
+                                  "tokensBefore": estimate_tokens(template["template"]),
+                                  "tokensAfter": estimate_tokens(join_template(base, kept))})
+        return JSONResponse(content={"message": "Templates compacted", "compacted": compacted}, status_code=200)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/admin/templates/{vacation_type}/versions", dependencies=[Depends(require_admin)])
+async def get_template_versions(vacation_type: str):
+    try:
+        versions = [convert_to_json_serializable(version) for version in repository.find_template_versions(vacation_type)]
+        return JSONResponse(content=versions, status_code=200)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/admin/templates/{vacation_type}/rollback/{version}", dependencies=[Depends(require_admin)])
+async def rollback_template(vacation_type: str, version: int):
+    try:
+        previous = repository.find_template_version(vacation_type, version)
+        template = repository.find_template_for_update(vacation_type)
+        if previous is None or template is None:
+            raise HTTPException(status_code=404, detail="Template version not found")
+
+        # A rollback is saved as a new version, so it can be undone as well
+        new_version = repository.save_template_version(template["_id"], *template_parts(previous),
+                                                       f"rollback to {version}")
+        return JSONResponse(content={"message": f"Template rolled back to version {version}", "version": new_version},
+                            status_code=200)
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/metrics")
+async def get_metrics():
+    try:
+        return JSONResponse(content=metrics.snapshot(), status_code=200)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/")
 async def get_backend():
     try:
         return JSONResponse(content="Welcome to Safe Plan server", status_code=200)
@@ -573,6 +1281,45 @@ async def get_backend():
         raise HTTPException(status_code=404, detail=str(e))
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs in each worker after the fork - clients are created and warmed before the first request
+    await resources.open()
+    invalidations = asyncio.create_task(invalidation_bus.run())
+    global_plan_refresh = asyncio.create_task(global_plan.run())
+    pregeneration = asyncio.create_task(pregenerator.run())
+    plan_index_sync = asyncio.create_task(plan_index.run(generated_plans)) if plan_index.max_distance > 0 else None
+    try:
+        yield
+    finally:
+        # Generations stop spending tokens, and finish unwinding while the Mongo client is still open
+        await asyncio.gather(*generation_jobs.cancel_all(), return_exceptions=True)
+        invalidations.cancel()
+        global_plan_refresh.cancel()
+        pregeneration.cancel()
+        if plan_index_sync is not None:
+            plan_index_sync.cancel()
+        resources.close()
+
+
+def create_app():
+    application = FastAPI(lifespan=lifespan)
+    origins = ["*"]
+
+    application.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    application.include_router(router)
+    return application
+
+
+app = create_app()
+
+
 # Run the FastAPI application with Uvicorn
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,18 @@
+import hmac
+from fastapi import HTTPException, Request
+
+
+def admin_token(token: str = None):
+    """
+    Dependency letting through requests with the admin token in X-Admin-Token.
+    Without a configured token every request is refused - admin endpoints are never open by default.
+    """
+
+    async def check(request: Request):
+        if not token:
+            raise HTTPException(status_code=403, detail="Admin endpoints are disabled")
+        supplied = request.headers.get("x-admin-token", "")
+        if not hmac.compare_digest(supplied.encode(), token.encode()):
+            raise HTTPException(status_code=401, detail="Invalid admin token")
+
+    return check
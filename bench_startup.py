@@ -0,0 +1,58 @@
+"""
+Import-time and startup-time benchmark for a worker.
+
+    python bench_startup.py [runs]
+
+Each run starts a fresh interpreter, imports FastAPI.py and then runs the app lifespan (client creation and
+warm-up), which is what every gunicorn worker does before it accepts traffic.
+Startup needs MONGO_DB to point at a reachable server; LLM_BACKEND=stub avoids calling OpenAI.
+"""
+import sys
+import json
+import statistics
+import subprocess
+
+WORKER_SCRIPT = """
+import sys, time, json, asyncio
+started = time.perf_counter()
+import FastAPI
+imported = time.perf_counter()
+heavy = {name: name in sys.modules for name in ("openai", "passlib.hash", "pymongo.mongo_client", "numpy")}
+error = None
+try:
+    async def run_lifespan():
+        async with FastAPI.lifespan(FastAPI.app):
+            return time.perf_counter()
+    ready = asyncio.run(run_lifespan())
+except Exception as e:
+    ready = None
+    error = repr(e)
+print(json.dumps({"import": imported - started, "startup": (ready - imported) if ready else None,
+                  "heavy_at_import": heavy, "error": error}))
+"""
+
+
+def run_once():
+    output = subprocess.run([sys.executable, "-c", WORKER_SCRIPT], capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    results = [run_once() for _ in range(runs)]
+
+    import_times = [result["import"] for result in results]
+    startup_times = [result["startup"] for result in results if result["startup"] is not None]
+
+    print(f"runs: {runs}")
+    print(f"import  median {statistics.median(import_times) * 1000:.1f} ms, max {max(import_times) * 1000:.1f} ms")
+    if startup_times:
+        print(f"startup median {statistics.median(startup_times) * 1000:.1f} ms, "
+              f"max {max(startup_times) * 1000:.1f} ms")
+    else:
+        print(f"startup failed: {results[0]['error']}")
+    print(f"loaded at import: {results[0]['heavy_at_import']}")
+
+
+if __name__ == "__main__":
+    main()
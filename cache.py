@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta
+from metrics import metrics
+
+logger = logging.getLogger("safeplan")
+
+
+class TTLCache:
+    """
+    Named cache on top of a cache_backends tier. Entries expire after ttl seconds, hit/miss counts go to /metrics.
+    Values must be JSON-serializable so they can live in a shared tier.
+    """
+
+    def __init__(self, name: str, backend=None, max_entries: int = 10000, ttl: float = 60):
+        from cache_backends import MemoryBackend
+
+        self.name = name
+        self.backend = backend if backend is not None else MemoryBackend(max_entries)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return f"{self.name}:{key}"
+
+    def _record(self, hit: bool):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            ratio = round(self.hits / (self.hits + self.misses), 4)
+        metrics.increment(f"{self.name}_cache_{'hits' if hit else 'misses'}")
+        metrics.set_gauge(f"{self.name}_cache_hit_ratio", ratio)
+
+    def _lookup(self, key):
+        try:
+            version, value = self.backend.get(self._key(key))
+        except Exception as e:
+            # A broken shared tier degrades to database reads, it never fails the request
+            metrics.increment(f"{self.name}_cache_errors")
+            logger.warning("Cache %s get failed: %s", self.name, e)
+            return None, None
+        self._record(value is not None)
+        return version, value
+
+    def get(self, key):
+        """Returns (found, value)."""
+        value = self._lookup(key)[1]
+        return value is not None, value
+
+    def set(self, key, value, expected_version: int = None):
+        try:
+            return self.backend.set(self._key(key), value, self.ttl, expected_version)
+        except Exception as e:
+            metrics.increment(f"{self.name}_cache_errors")
+            logger.warning("Cache %s set failed: %s", self.name, e)
+            return False
+
+    def invalidate(self, key):
+        try:
+            self.backend.invalidate(self._key(key), self.ttl)
+        except Exception as e:
+            metrics.increment(f"{self.name}_cache_errors")
+            logger.warning("Cache %s invalidate failed: %s", self.name, e)
+
+    def get_or_load(self, key, loader):
+        """
+        Read-through: on a miss the value is loaded and cached (unless None).
+        The write is conditional on the version seen before loading, so an invalidation that happens while we
+        read Mongo is not overwritten by the older value.
+        """
+        version, value = self._lookup(key)
+        if value is not None:
+            return value
+        value = loader(key)
+        if value is not None:
+            self.set(key, value, expected_version=version)
+        return value
+
+    def get_many_or_load(self, keys, loader):
+        """
+        Same as get_or_load for several keys, with one load for all the misses: loader(missing keys) returns
+        {key: value} for the ones it found. Returns {key: value}, None for keys not found.
+        """
+        values = {}
+        versions = {}
+        for key in keys:
+            version, values[key] = self._lookup(key)
+            if values[key] is None:
+                versions[key] = version
+        if versions:
+            for key, value in loader(list(versions)).items():
+                values[key] = value
+                if value is not None and key in versions:
+                    self.set(key, value, expected_version=versions[key])
+        return values
+
+
+class InvalidationBus:
+    """
+    Tells the other gunicorn workers to drop cache entries.
+    Each invalidation is a small document in a TTL collection, and every worker polls for new ones.
+    Polls overlap a little to tolerate clock skew between writers, and events already seen in the overlap are
+    skipped - long-poll waiters must not be woken again by an old event.
+    Anything with a name and invalidate(key) can be registered - generation jobs are cancelled the same way.
+    """
+
+    def __init__(self, collection, poll_interval: float = 1.0, retention_seconds: int = 300):
+        self.collection = collection
+        self.poll_interval = poll_interval
+        self.retention_seconds = retention_seconds
+        self.caches = {}
+        self.last_poll = datetime.utcnow()
+        # event id -> time, for the events inside the overlap window
+        self.seen = {}
+        self.seen_lock = threading.Lock()
+        self.index_ready = False
+
+    def register(self, cache: TTLCache):
+        self.caches[cache.name] = cache
+
+    def publish(self, cache_name: str, key):
+        # Local copy first, then everyone else
+        cache = self.caches.get(cache_name)
+        if cache is not None:
+            cache.invalidate(key)
+        try:
+            now = datetime.utcnow()
+            event_id = self.collection.insert_one({"cache": cache_name, "key": key, "at": now}).inserted_id
+            with self.seen_lock:
+                # Already applied here
+                self.seen[event_id] = now
+        except Exception as e:
+            # Other workers fall back to the cache TTL
+            metrics.increment("cache_invalidation_publish_errors")
+            logger.warning("Cache invalidation for %s:%s not published: %s", cache_name, key, e)
+
+    def poll(self):
+        if not self.index_ready:
+            self.collection.create_index("at", expireAfterSeconds=self.retention_seconds)
+            self.index_ready = True
+
+        since = self.last_poll - timedelta(seconds=5)
+        self.last_poll = datetime.utcnow()
+        events = list(self.collection.find({"at": {"$gte": since}}, {"cache": 1, "key": 1, "at": 1}))
+        with self.seen_lock:
+            self.seen = {event_id: at for event_id, at in self.seen.items() if at >= since}
+            new = [event for event in events if event["_id"] not in self.seen]
+            self.seen.update((event["_id"], event["at"]) for event in new)
+        for event in new:
+            cache = self.caches.get(event["cache"])
+            if cache is not None:
+                cache.invalidate(event["key"])
+
+    async def run(self):
+        """Polls until cancelled - started by the app lifespan in every worker."""
+        while True:
+            try:
+                await asyncio.to_thread(self.poll)
+            except Exception as e:
+                metrics.increment("cache_invalidation_poll_errors")
+                logger.warning("Cache invalidation poll failed: %s", e)
+            await asyncio.sleep(self.poll_interval)
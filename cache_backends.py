@@ -0,0 +1,198 @@
+"""
+Storage tiers for the app caches (cache.TTLCache).
+
+Every backend keeps versioned entries: get returns (version, value) and set can be made conditional on the version
+read before loading, so a value loaded from Mongo is not written back over a newer invalidation.
+Invalidation leaves a tombstone with a bumped version instead of deleting the entry.
+
+    memory  per-process OrderedDict (each gunicorn worker has its own copy)
+    sqlite  one memory-mapped SQLite file per host, shared by all workers (default path under /dev/shm)
+    redis   a Redis-compatible server (optional dependency: pip install redis)
+"""
+import os
+import json
+import time
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class MemoryBackend:
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return 0, None
+            version, expires, value = entry
+            if expires <= now:
+                return version, None
+            self.entries.move_to_end(key)
+            return version, value
+
+    def set(self, key, value, ttl: float, expected_version: int = None):
+        with self.lock:
+            version = self.entries.get(key, (0, 0, None))[0]
+            if expected_version is not None and version != expected_version:
+                return False
+            self.entries[key] = (version + 1, time.time() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return True
+
+    def invalidate(self, key, ttl: float):
+        with self.lock:
+            version = self.entries.get(key, (0, 0, None))[0]
+            self.entries[key] = (version + 1, time.time() + ttl, None)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def size(self):
+        return len(self.entries)
+
+
+class SQLiteBackend:
+    """Host-wide tier: one SQLite file (WAL, memory-mapped), so all workers share a single copy of each entry."""
+
+    def __init__(self, path: str, max_entries: int = 100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.writes = 0
+
+    def _connection(self):
+        # One connection per thread and per process - never reuse a connection across a fork
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute("PRAGMA mmap_size=268435456")
+            connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, version INTEGER NOT NULL, "
+                               "expires REAL NOT NULL, value BLOB)")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute("SELECT version, expires, value FROM cache WHERE key = ?",
+                                         (key,)).fetchone()
+        if row is None:
+            return 0, None
+        version, expires, value = row
+        if value is None or expires <= time.time():
+            return version, None
+        return version, json.loads(value)
+
+    def set(self, key, value, ttl: float, expected_version: int = None):
+        connection = self._connection()
+        data = json.dumps(value, separators=(",", ":"))
+        expires = time.time() + ttl
+        if expected_version is None:
+            connection.execute("INSERT INTO cache (key, version, expires, value) VALUES (?, 1, ?, ?) "
+                               "ON CONFLICT(key) DO UPDATE SET version = version + 1, expires = excluded.expires, "
+                               "value = excluded.value", (key, expires, data))
+            stored = True
+        elif expected_version == 0:
+            stored = connection.execute("INSERT OR IGNORE INTO cache (key, version, expires, value) "
+                                        "VALUES (?, 1, ?, ?)", (key, expires, data)).rowcount == 1
+        else:
+            stored = connection.execute("UPDATE cache SET version = version + 1, expires = ?, value = ? "
+                                        "WHERE key = ? AND version = ?",
+                                        (expires, data, key, expected_version)).rowcount == 1
+        self._trim(connection)
+        return stored
+
+    def invalidate(self, key, ttl: float):
+        self._connection().execute("INSERT INTO cache (key, version, expires, value) VALUES (?, 1, ?, NULL) "
+                                   "ON CONFLICT(key) DO UPDATE SET version = version + 1, expires = excluded.expires, "
+                                   "value = NULL", (key, time.time() + ttl))
+
+    def _trim(self, connection):
+        # Every 1000 writes: drop expired entries, then the soonest to expire above max_entries
+        self.writes += 1
+        if self.writes % 1000:
+            return
+        connection.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+        connection.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires DESC "
+                           "LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def size(self):
+        return self._connection().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+class RedisBackend:
+    """Each entry is a hash {version, value}; writes run as MULTI/EXEC transactions, conditional ones under WATCH."""
+
+    def __init__(self, url: str):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.redis = redis
+
+    def get(self, key):
+        version, value = self.client.hmget(key, "version", "value")
+        version = int(version) if version is not None else 0
+        if not value:
+            return version, None
+        return version, json.loads(value)
+
+    def _write(self, pipe, key, value, ttl):
+        pipe.multi()
+        pipe.hincrby(key, "version", 1)
+        pipe.hset(key, "value", json.dumps(value, separators=(",", ":")) if value is not None else "")
+        pipe.expire(key, max(1, int(ttl)))
+        pipe.execute()
+
+    def set(self, key, value, ttl: float, expected_version: int = None):
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if expected_version is not None:
+                    version = pipe.hget(key, "version")
+                    if (int(version) if version is not None else 0) != expected_version:
+                        return False
+                self._write(pipe, key, value, ttl)
+                return True
+            except self.redis.WatchError:
+                return False
+
+    def invalidate(self, key, ttl: float):
+        with self.client.pipeline() as pipe:
+            self._write(pipe, key, None, ttl)
+
+    def size(self):
+        return self.client.dbsize()
+
+
+shared_backend = None
+
+
+def create_cache_backend(max_entries: int = 10000):
+    """
+    SHARED_CACHE_BACKEND picks the tier. memory gives each cache its own per-process store;
+    sqlite and redis return one backend shared by all caches (keys are prefixed with the cache name).
+    """
+    global shared_backend
+    kind = os.getenv("SHARED_CACHE_BACKEND", "memory").lower()
+
+    if kind == "memory":
+        return MemoryBackend(max_entries)
+    if shared_backend is None:
+        if kind == "sqlite":
+            directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+            shared_backend = SQLiteBackend(os.getenv("SHARED_CACHE_PATH", os.path.join(directory, "safeplan-cache.db")),
+                                           max_entries=int(os.getenv("SHARED_CACHE_MAX_ENTRIES", "100000")))
+        elif kind == "redis":
+            shared_backend = RedisBackend(os.getenv("SHARED_CACHE_URL", "redis://localhost:6379/0"))
+        else:
+            raise ValueError(f"Unknown shared cache backend '{kind}'")
+    return shared_backend
@@ -0,0 +1,97 @@
+"""
+Completion time estimates for plan generations.
+
+Every finished model call is recorded in a rolling latency histogram for its model and prompt size. A histogram
+covers the last one to two windows, so estimates follow the model's current speed. Each worker learns from its own
+calls.
+"""
+import math
+import time
+import threading
+from metrics import Histogram
+from tokens import TOKEN_BUCKETS
+
+# Seconds - plan generations take from a few seconds to a few minutes
+ETA_BUCKETS = (5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300)
+
+
+class RollingHistogram:
+    """Two histograms in turn - the older one is dropped every window_seconds."""
+
+    def __init__(self, buckets=ETA_BUCKETS, window_seconds: float = 900):
+        self.buckets = buckets
+        self.window_seconds = window_seconds
+        self.current = Histogram(buckets)
+        self.previous = Histogram(buckets)
+        self.rotated_at = time.monotonic()
+
+    def _rotate(self):
+        now = time.monotonic()
+        if now - self.rotated_at >= self.window_seconds:
+            # After two idle windows both halves are stale
+            self.previous = self.current if now - self.rotated_at < 2 * self.window_seconds else Histogram(self.buckets)
+            self.current = Histogram(self.buckets)
+            self.rotated_at = now
+
+    def observe(self, value: float):
+        self._rotate()
+        self.current.observe(value)
+
+    def count(self):
+        self._rotate()
+        return self.current.count + self.previous.count
+
+    def quantile(self, q: float):
+        """Upper bound of the bucket holding the q quantile (the largest value seen for the last bucket)."""
+        self._rotate()
+        total = self.current.count + self.previous.count
+        if not total:
+            return None
+        rank = math.ceil(q * total)
+        seen = 0
+        for index, bound in enumerate(self.buckets):
+            seen += self.current.counts[index] + self.previous.counts[index]
+            if seen >= rank:
+                return bound
+        return max(self.current.max, self.previous.max)
+
+
+def prompt_bucket(prompt_tokens: int):
+    for bound in TOKEN_BUCKETS:
+        if prompt_tokens <= bound:
+            return bound
+    return math.inf
+
+
+class LatencyEstimator:
+    """
+    Seconds a model call is expected to take - the q quantile of recent calls with the same model and prompt size,
+    else of the model's recent calls, else default_seconds.
+    """
+
+    def __init__(self, default_seconds: float = 60, quantile: float = 0.75, min_samples: int = 5,
+                 window_seconds: float = 900):
+        self.default_seconds = default_seconds
+        self.q = quantile
+        self.min_samples = min_samples
+        self.window_seconds = window_seconds
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def _histogram(self, key):
+        if key not in self.histograms:
+            self.histograms[key] = RollingHistogram(window_seconds=self.window_seconds)
+        return self.histograms[key]
+
+    def record(self, model: str, prompt_tokens: int, seconds: float):
+        with self.lock:
+            self._histogram((model, prompt_bucket(prompt_tokens))).observe(seconds)
+            self._histogram((model, None)).observe(seconds)
+
+    def estimate(self, model: str, prompt_tokens: int):
+        with self.lock:
+            for key in ((model, prompt_bucket(prompt_tokens)), (model, None)):
+                histogram = self.histograms.get(key)
+                if histogram is not None and histogram.count() >= self.min_samples:
+                    return histogram.quantile(self.q)
+        return self.default_seconds
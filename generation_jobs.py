@@ -0,0 +1,88 @@
+"""
+In-flight plan generations, so a superseded or cancelled one stops spending tokens.
+
+Each generation runs as its own asyncio task under a job id, and the plans document names the job that owns it.
+Cancelling a job goes through the invalidation bus: the worker running it cancels the task, which closes the
+model's HTTP stream and frees its LLM slot. A job that is cancelled late can't overwrite the plan either, since
+its writes only match while it still owns the document (repository.set_job_plan).
+"""
+import asyncio
+import logging
+import uuid
+from metrics import metrics
+
+logger = logging.getLogger("safeplan")
+
+
+class GenerationJobs:
+    name = "generation-jobs"
+
+    def __init__(self, bus=None):
+        # InvalidationBus - reaches the job whichever worker runs it
+        self.bus = bus
+        self.tasks = {}
+        # email -> job, and the jobs whose first model call has started
+        self.jobs_by_email = {}
+        self.running = set()
+        if bus is not None:
+            bus.register(self)
+
+    @staticmethod
+    def new_id():
+        return uuid.uuid4().hex
+
+    def start(self, job: str, coroutine, email: str = None):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks[job] = task
+        if email is not None:
+            self.jobs_by_email[email] = job
+        task.add_done_callback(lambda done: self._finished(job, done))
+        metrics.set_gauge("generation_jobs_running", len(self.tasks))
+        return task
+
+    def _finished(self, job: str, task: asyncio.Task):
+        self.tasks.pop(job, None)
+        self.running.discard(job)
+        for email in [email for email, owned in self.jobs_by_email.items() if owned == job]:
+            del self.jobs_by_email[email]
+        metrics.set_gauge("generation_jobs_running", len(self.tasks))
+        if task.cancelled():
+            metrics.increment("generation_jobs_cancelled")
+        elif task.exception() is not None:
+            metrics.increment("generation_jobs_failed")
+            logger.warning("Generation job %s failed: %s", job, task.exception())
+
+    def local_job(self, email: str):
+        """The email's job when it runs in this worker, else None."""
+        return self.jobs_by_email.get(email)
+
+    def is_running(self, job: str):
+        return job in self.running
+
+    def mark_running(self, email: str):
+        """Called once a model call of the email got its LLM slot - returns the job if that is its first call."""
+        job = self.jobs_by_email.get(email)
+        if job is None or job in self.running:
+            return None
+        self.running.add(job)
+        return job
+
+    def cancel(self, job: str):
+        """Cancels the job here and tells the other workers (publishing cancels the local copy first)."""
+        if self.bus is not None:
+            self.bus.publish(self.name, job)
+        else:
+            self.invalidate(job)
+
+    def invalidate(self, job: str):
+        # Called by the invalidation bus - events are replayed, so an unknown or finished job is not an error
+        task = self.tasks.get(job)
+        if task is not None and not task.done():
+            task.cancel()
+
+    def cancel_all(self):
+        """Cancels this worker's jobs (at shutdown) and returns their tasks, to be awaited."""
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        return tasks
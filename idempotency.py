@@ -0,0 +1,108 @@
+"""
+Idempotency-Key support for endpoints that clients retry on timeouts.
+
+The first request with a key claims it, and its response is stored with the key. Repeats of the key (same endpoint
+and email) get the stored response back instead of running again, until the key expires. A repeat that arrives
+while the first request is still running gets a 409, and a repeat with a different body gets a 422.
+"""
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse
+from metrics import metrics
+
+logger = logging.getLogger("safeplan")
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyStore:
+    def __init__(self, collection, ttl_seconds: int = 86400, pending_seconds: int = 120):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        # A claim whose request never finished (worker died) can be taken over after this long
+        self.pending_seconds = pending_seconds
+        self.index_ready = False
+
+    def _ensure_index(self):
+        if not self.index_ready:
+            self.collection.create_index("expires_at", expireAfterSeconds=0)
+            self.index_ready = True
+
+    def claim(self, key_id: str, fingerprint: str):
+        """Returns None when this request owns the key, otherwise the stored document of the earlier request."""
+        from pymongo.errors import DuplicateKeyError
+
+        self._ensure_index()
+        now = datetime.utcnow()
+        doc = {"fingerprint": fingerprint, "state": "pending", "claimed_at": now,
+               "expires_at": now + timedelta(seconds=self.ttl_seconds)}
+        try:
+            self.collection.insert_one(dict(doc, _id=key_id))
+            return None
+        except DuplicateKeyError:
+            pass
+
+        # Expired (the TTL monitor only runs every minute) or abandoned claims are taken over
+        stale = {"_id": key_id, "$or": [
+            {"expires_at": {"$lte": now}},
+            {"state": "pending", "claimed_at": {"$lte": now - timedelta(seconds=self.pending_seconds)}},
+        ]}
+        if self.collection.find_one_and_update(stale, {"$set": doc, "$unset": {"status": "", "body": ""}}):
+            return None
+        return self.collection.find_one({"_id": key_id}) or {"state": "pending", "fingerprint": fingerprint}
+
+    def finish(self, key_id: str, status_code: int, body):
+        self.collection.update_one({"_id": key_id, "state": "pending"},
+                                   {"$set": {"state": "done", "status": status_code, "body": body}})
+
+    def release(self, key_id: str):
+        """Forgets a claim whose request failed, so a retry runs again."""
+        self.collection.delete_one({"_id": key_id, "state": "pending"})
+
+    async def run(self, request: Request, scope: str, handler):
+        """
+        Runs handler() (an async callable returning a JSONResponse) once per Idempotency-Key of the request.
+        Requests without the header just run. 5xx responses and exceptions are not stored, so their retries run.
+        """
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return await handler()
+        if len(key) > MAX_KEY_LENGTH:
+            raise HTTPException(status_code=400, detail=f"{IDEMPOTENCY_HEADER} is longer than {MAX_KEY_LENGTH}")
+
+        key_id = f"{scope}:{key}"
+        fingerprint = hashlib.sha256(await request.body()).hexdigest()
+        earlier = self.claim(key_id, fingerprint)
+        if earlier is not None:
+            if earlier["fingerprint"] != fingerprint:
+                metrics.increment("idempotency_mismatches")
+                raise HTTPException(status_code=422,
+                                    detail=f"{IDEMPOTENCY_HEADER} was already used with a different request")
+            if earlier["state"] != "done":
+                metrics.increment("idempotency_conflicts")
+                raise HTTPException(status_code=409, detail="A request with this key is still in progress",
+                                    headers={"Retry-After": "1"})
+            metrics.increment("idempotency_replays")
+            return JSONResponse(content=earlier["body"], status_code=earlier["status"],
+                                headers={REPLAYED_HEADER: "true"})
+
+        try:
+            response = await handler()
+        except BaseException:
+            self.release(key_id)
+            raise
+        if not isinstance(response, JSONResponse) or response.status_code >= 500:
+            self.release(key_id)
+            return response
+        try:
+            self.finish(key_id, response.status_code, json.loads(response.body))
+        except Exception as e:
+            # The request itself succeeded - a retry will just run again
+            logger.warning("Idempotency key %s not stored: %s", key_id, e)
+            self.release(key_id)
+        return response
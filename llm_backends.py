@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+
+
+# Result of a single completion, independent of the backend that produced it
+class LLMResult:
+    def __init__(self, content: str, model: str, prompt_tokens: int = 0, completion_tokens: int = 0):
+        self.content = content
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+
+    def to_dict(self):
+        return {"content": self.content, "model": self.model,
+                "prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens}
+
+
+class LLMBackend:
+    """Base class - every backend answers chat completions with an LLMResult."""
+    name = "base"
+
+    def complete(self, messages, model: str, max_tokens: int, temperature: float = 1,
+                 json_mode: bool = False) -> LLMResult:
+        raise NotImplementedError
+
+    async def acomplete(self, messages, model: str, max_tokens: int, temperature: float = 1,
+                        json_mode: bool = False) -> LLMResult:
+        # Default: run the blocking call in a thread so the event loop stays free
+        return await asyncio.to_thread(self.complete, messages, model, max_tokens, temperature, json_mode)
+
+    async def astream(self, messages, model: str, max_tokens: int, temperature: float = 1, json_mode: bool = False,
+                      on_text=None) -> LLMResult:
+        """Like acomplete, calling on_text(text) with each piece of the answer as it arrives."""
+        # Default: the whole answer as a single piece
+        result = await self.acomplete(messages, model, max_tokens, temperature, json_mode)
+        if on_text is not None:
+            on_text(result.content)
+        return result
+
+    async def warm(self):
+        # Called once per worker at startup, before traffic arrives
+        pass
+
+
+class OpenAIBackend(LLMBackend):
+    name = "openai"
+
+    def __init__(self, api_key: str = None, prewarm: bool = False):
+        # The clients are created on first use - the openai client refuses to be built without an API key, and the
+        # app must import and start without one (stub and replay setups, the tests)
+        self.api_key = api_key
+        self.prewarm = prewarm
+        self._client = None
+        self._async_client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import openai
+
+            self._client = openai.OpenAI(api_key=self.api_key)
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            import openai
+
+            self._async_client = openai.AsyncOpenAI(api_key=self.api_key)
+        return self._async_client
+
+    async def warm(self):
+        # Opens the TLS connection to the API up front - listing models costs no tokens
+        if self.prewarm:
+            await self.async_client.models.list()
+
+    @staticmethod
+    def _request(messages, model, max_tokens, temperature, json_mode):
+        request = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+        if json_mode:
+            request["response_format"] = {"type": "json_object"}
+        return request
+
+    @staticmethod
+    def _result(gpt_response, model):
+        usage = gpt_response.usage
+        return LLMResult(gpt_response.choices[0].message.content.strip(), gpt_response.model or model,
+                         usage.prompt_tokens if usage else 0, usage.completion_tokens if usage else 0)
+
+    def complete(self, messages, model, max_tokens, temperature=1, json_mode=False):
+        gpt_response = self.client.chat.completions.create(
+            **self._request(messages, model, max_tokens, temperature, json_mode))
+        return self._result(gpt_response, model)
+
+    async def acomplete(self, messages, model, max_tokens, temperature=1, json_mode=False):
+        gpt_response = await self.async_client.chat.completions.create(
+            **self._request(messages, model, max_tokens, temperature, json_mode))
+        return self._result(gpt_response, model)
+
+    async def astream(self, messages, model, max_tokens, temperature=1, json_mode=False, on_text=None):
+        stream = await self.async_client.chat.completions.create(
+            stream=True, **self._request(messages, model, max_tokens, temperature, json_mode))
+        parts = []
+        response_model = model
+        try:
+            async for chunk in stream:
+                response_model = chunk.model or response_model
+                text = chunk.choices[0].delta.content if chunk.choices else None
+                if text:
+                    parts.append(text)
+                    if on_text is not None:
+                        on_text(text)
+        finally:
+            # A cancelled generation closes the connection, so the API stops generating (and billing) the rest
+            await stream.response.aclose()
+        content = "".join(parts).strip()
+        # Streamed answers carry no usage - approximated at 4 characters per token
+        prompt = "".join(message["content"] for message in messages)
+        return LLMResult(content, response_model, len(prompt) // 4, len(content) // 4)
+
+
+class StubBackend(LLMBackend):
+    """Deterministic offline backend - same prompt always gives the same plan, no tokens are spent."""
+    name = "stub"
+
+    def __init__(self, latency: float = 0.0, completion_tokens: int = 1500, days: int = 3):
+        self.latency = latency
+        self.completion_tokens = completion_tokens
+        self.days = days
+
+    def _build(self, messages, model, json_mode):
+        prompt = "".join(message["content"] for message in messages)
+        seed = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+        if json_mode:
+            content = json.dumps(stub_plan(seed, self.days))
+        else:
+            # analyze_data asks for a repeated item or 'NOT FOUND'
+            content = "NOT FOUND"
+
+        return LLMResult(content, model, prompt_tokens=len(prompt) // 4, completion_tokens=self.completion_tokens)
+
+    def complete(self, messages, model, max_tokens, temperature=1, json_mode=False):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._build(messages, model, json_mode)
+
+    async def acomplete(self, messages, model, max_tokens, temperature=1, json_mode=False):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._build(messages, model, json_mode)
+
+    async def astream(self, messages, model, max_tokens, temperature=1, json_mode=False, on_text=None):
+        # The answer arrives in 20 pieces spread over the latency
+        result = self._build(messages, model, json_mode)
+        size = max(1, -(-len(result.content) // 20))
+        for start in range(0, len(result.content), size):
+            if self.latency:
+                await asyncio.sleep(self.latency / 20)
+            if on_text is not None:
+                on_text(result.content[start:start + size])
+        return result
+
+
+def stub_plan(seed: str, days: int):
+    """Builds a plan with the same shape the app expects from the model."""
+    plan_days = []
+    for day in range(1, days + 1):
+        tag = f"{seed[:8]}-{day}"
+        plan_days.append({
+            "day": day,
+            "city": f"City {seed[day % len(seed)].upper()}",
+            "hotel": {"name": f"Hotel {tag}", "stars": 4, "address": f"{day} Main Street"},
+            "activities": [
+                {"time": "09:00", "name": f"Morning tour {tag}", "description": "Walking tour of the old town."},
+                {"time": "14:00", "name": f"Afternoon visit {tag}", "description": "Local museum and market."},
+            ],
+            "restaurants": [
+                {"name": f"Restaurant {tag}", "cuisine": "Local", "dish": "Chef's special"},
+            ],
+        })
+
+    return {
+        "title": f"Trip plan {seed[:8]}",
+        "days": plan_days,
+        "summary": "Deterministic plan generated by the stub LLM backend.",
+    }
+
+
+class ReplayBackend(LLMBackend):
+    """
+    Serves completions previously captured on disk.
+    When a recorder backend is given, misses are forwarded to it and the answer is saved for next time.
+    """
+    name = "replay"
+
+    def __init__(self, directory: str, recorder: LLMBackend = None):
+        self.directory = directory
+        self.recorder = recorder
+        os.makedirs(directory, exist_ok=True)
+
+    async def warm(self):
+        if self.recorder is not None:
+            await self.recorder.warm()
+
+    def _path(self, messages, model, max_tokens, json_mode):
+        key = json.dumps({"messages": messages, "model": model, "max_tokens": max_tokens, "json_mode": json_mode},
+                         sort_keys=True)
+        return os.path.join(self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+    def _load(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return LLMResult(**json.load(f))
+
+    def _save(self, path, result: LLMResult):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(result.to_dict(), f)
+        os.replace(tmp_path, path)
+
+    def complete(self, messages, model, max_tokens, temperature=1, json_mode=False):
+        path = self._path(messages, model, max_tokens, json_mode)
+        if os.path.exists(path):
+            return self._load(path)
+        if self.recorder is None:
+            raise LookupError(f"No recorded completion for this request ({os.path.basename(path)})")
+
+        result = self.recorder.complete(messages, model, max_tokens, temperature, json_mode)
+        self._save(path, result)
+        return result
+
+    async def acomplete(self, messages, model, max_tokens, temperature=1, json_mode=False):
+        path = self._path(messages, model, max_tokens, json_mode)
+        if os.path.exists(path):
+            return self._load(path)
+        if self.recorder is None:
+            raise LookupError(f"No recorded completion for this request ({os.path.basename(path)})")
+
+        result = await self.recorder.acomplete(messages, model, max_tokens, temperature, json_mode)
+        self._save(path, result)
+        return result
+
+
+def create_llm_backend(kind: str = None) -> LLMBackend:
+    """Builds the backend selected by LLM_BACKEND (openai, stub, replay or record)."""
+    kind = (kind or os.getenv("LLM_BACKEND", "openai")).lower()
+
+    if kind == "openai":
+        return OpenAIBackend(api_key=os.getenv("OPENAI_API_KEY"), prewarm=os.getenv("LLM_PREWARM", "0") == "1")
+    if kind == "stub":
+        return StubBackend(latency=float(os.getenv("LLM_STUB_LATENCY", "0")),
+                           completion_tokens=int(os.getenv("LLM_STUB_COMPLETION_TOKENS", "1500")),
+                           days=int(os.getenv("LLM_STUB_DAYS", "3")))
+    if kind in ("replay", "record"):
+        directory = os.getenv("LLM_REPLAY_DIR", "llm_recordings")
+        recorder = OpenAIBackend(api_key=os.getenv("OPENAI_API_KEY")) if kind == "record" else None
+        return ReplayBackend(directory, recorder=recorder)
+
+    raise ValueError(f"Unknown LLM backend '{kind}'")
@@ -0,0 +1,127 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from metrics import metrics
+
+# Lower value is served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+
+class LLMScheduler:
+    """
+    Bounds the number of model calls running in this worker.
+    Waiting calls are served by priority, and inside a priority the user with the fewest running calls goes
+    first (round robin on ties), so one heavy user can't starve the others.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.running = 0
+        self.running_per_user = {}
+        # priority -> OrderedDict(user -> deque of waiting futures)
+        self.waiting = {}
+
+    def queued(self):
+        return sum(len(waiters) for users in self.waiting.values() for waiters in users.values())
+
+    def position(self, user: str):
+        """
+        1-based place of the user's first waiting call, None when it has none waiting.
+        Approximate - it counts the calls ahead in priority and arrival order, ignoring the fewest-running rule.
+        """
+        ahead = 0
+        for priority in sorted(self.waiting):
+            for name, waiters in self.waiting[priority].items():
+                if name == user:
+                    return ahead + 1
+                ahead += len(waiters)
+        return None
+
+    def _update_gauges(self):
+        metrics.set_gauge("llm_running", self.running)
+        metrics.set_gauge("llm_queued", self.queued())
+
+    def _start(self, user: str):
+        self.running += 1
+        self.running_per_user[user] = self.running_per_user.get(user, 0) + 1
+
+    def _next_waiter(self):
+        for priority in sorted(self.waiting):
+            users = self.waiting[priority]
+            if not users:
+                continue
+            user = min(users, key=lambda name: self.running_per_user.get(name, 0))
+            waiters = users.pop(user)
+            future = waiters.popleft()
+            if waiters:
+                # Back of the line for this user's remaining calls
+                users[user] = waiters
+            return user, future
+        return None, None
+
+    def _wake(self):
+        while self.running < self.max_concurrency:
+            user, future = self._next_waiter()
+            if future is None:
+                return
+            if future.done():
+                continue
+            self._start(user)
+            future.set_result(True)
+
+    async def acquire(self, user: str, priority: int = PRIORITY_INTERACTIVE):
+        started = time.monotonic()
+        if self.running < self.max_concurrency and not self.queued():
+            self._start(user)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.waiting.setdefault(priority, OrderedDict()).setdefault(user, deque()).append(future)
+            self._update_gauges()
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # The slot was granted just before the cancellation - hand it on
+                    self.release(user)
+                else:
+                    self._discard(priority, user, future)
+                raise
+
+        wait = time.monotonic() - started
+        metrics.observe("llm_queue_wait_seconds", wait)
+        metrics.observe(f"llm_queue_wait_seconds_priority_{priority}", wait)
+        self._update_gauges()
+
+    def _discard(self, priority, user, future):
+        waiters = self.waiting.get(priority, {}).get(user)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self.waiting[priority][user]
+        self._update_gauges()
+
+    def release(self, user: str):
+        self.running -= 1
+        self.running_per_user[user] -= 1
+        if not self.running_per_user[user]:
+            del self.running_per_user[user]
+        self._wake()
+        self._update_gauges()
+
+    @asynccontextmanager
+    async def slot(self, user: str, priority: int = PRIORITY_INTERACTIVE):
+        await self.acquire(user, priority)
+        try:
+            yield
+        finally:
+            self.release(user)
+
+
+def create_llm_scheduler():
+    """LLM_MAX_CONCURRENCY is the cap for the whole app, split evenly between the gunicorn workers."""
+    total = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+    workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+    return LLMScheduler(max(1, total // max(1, workers)))
@@ -0,0 +1,69 @@
+import threading
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def to_dict(self):
+        labels = [f"le_{bound}" for bound in self.buckets] + ["le_inf"]
+        return {
+            "count": self.count,
+            "sum": round(self.total, 6),
+            "avg": round(self.total / self.count, 6) if self.count else 0,
+            "max": round(self.max, 6),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+# Default buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Metrics:
+    """Per-process counters, gauges and histograms, exposed as JSON by /metrics."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name: str, value: float, buckets=LATENCY_BUCKETS):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(buckets)
+            self.histograms[name].observe(value)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+            }
+
+
+metrics = Metrics()
@@ -0,0 +1,134 @@
+"""
+Model routing for plan generation.
+
+Each request gets a tier (model + output budget) from its complexity - trip length, number of cities and vacation
+type - and from the latency each model shows right now. Every decision is logged with its outcome (latency, tokens,
+whether the answer was a usable plan) in the model_routing collection, for tuning the thresholds.
+"""
+import os
+import logging
+import threading
+from datetime import datetime
+from metrics import metrics
+from plan_fanout import split_cities
+from plan_reuse import trip_days
+from tokens import plan_output_budget
+
+logger = logging.getLogger("safeplan")
+
+# Extra complexity per vacation type (family trips plan around the children)
+VACATION_TYPE_WEIGHTS = {"Family Vacation": 2}
+# A tier is skipped when it is this much slower per token than the next tier that can serve the request
+LATENCY_MARGIN = 1.25
+
+
+class Tier:
+    def __init__(self, name: str, model: str, max_tokens: int, max_complexity: float = None):
+        self.name = name
+        self.model = model
+        self.max_tokens = max_tokens
+        # None - serves any request
+        self.max_complexity = max_complexity
+
+
+class Route:
+    def __init__(self, tier: Tier, max_tokens: int, days: int, complexity: float, reason: str):
+        self.tier = tier
+        self.model = tier.model
+        self.max_tokens = max_tokens
+        self.days = days
+        self.complexity = complexity
+        self.reason = reason
+
+
+class ModelRouter:
+    def __init__(self, tiers, log_collection=None, smoothing: float = 0.2):
+        # Fastest tier first
+        self.tiers = tiers
+        self.log_collection = log_collection
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        # model -> moving average of seconds per completion token
+        self.seconds_per_token = {}
+        self.index_ready = False
+
+    @staticmethod
+    def complexity(days: int, cities: int, vacation_type: str):
+        return days + 2 * max(cities - 1, 0) + VACATION_TYPE_WEIGHTS.get(vacation_type, 0)
+
+    def route(self, details: dict, days: int = None, cities: int = None):
+        """Picks the tier for a request (days and cities override the request's, e.g. for a fan-out chunk)."""
+        # Unknown length (dates not parseable) - complexity counts one day, the output budget stays the tier's full one
+        known_days = days or trip_days(details.get("dates"))
+        days = known_days or 1
+        cities = cities or len(split_cities(details.get("cities"))) or 1
+        complexity = self.complexity(days, cities, details.get("vacationType"))
+
+        eligible = [tier for tier in self.tiers if tier.max_complexity is None or complexity <= tier.max_complexity]
+        tier = eligible[-1] if eligible else self.tiers[-1]
+        reason = "complexity"
+        with self.lock:
+            for candidate, fallback in zip(eligible, eligible[1:]):
+                own = self.seconds_per_token.get(candidate.model)
+                other = self.seconds_per_token.get(fallback.model)
+                if own is not None and other is not None and own > other * LATENCY_MARGIN:
+                    reason = f"{candidate.name} slow"
+                    continue
+                tier = candidate
+                break
+
+        route = Route(tier, plan_output_budget(known_days, tier.max_tokens), days, complexity, reason)
+        metrics.increment(f"model_route_{tier.name}")
+        return route
+
+    def observe(self, route: Route, seconds: float, result=None, plan=None, error: str = None):
+        """Records the outcome of a routed call - latency statistics, metrics and the routing log."""
+        if error is not None:
+            outcome = "error"
+        elif not isinstance(plan, dict) or not isinstance(plan.get("days"), list):
+            outcome = "invalid"
+        elif len(plan["days"]) < route.days:
+            outcome = "short"
+        else:
+            outcome = "ok"
+
+        if result is not None and result.completion_tokens:
+            per_token = seconds / result.completion_tokens
+            with self.lock:
+                previous = self.seconds_per_token.get(route.model)
+                self.seconds_per_token[route.model] = per_token if previous is None else \
+                    previous + self.smoothing * (per_token - previous)
+        metrics.observe(f"llm_latency_seconds_{route.tier.name}", seconds)
+        metrics.increment(f"model_route_{route.tier.name}_{outcome}")
+
+        if self.log_collection is None:
+            return
+        try:
+            if not self.index_ready:
+                self.log_collection.create_index("at", expireAfterSeconds=30 * 24 * 3600)
+                self.index_ready = True
+            self.log_collection.insert_one({
+                "at": datetime.utcnow(), "tier": route.tier.name, "model": route.model, "reason": route.reason,
+                "complexity": route.complexity, "days": route.days, "max_tokens": route.max_tokens,
+                "seconds": round(seconds, 3), "outcome": outcome, "error": error,
+                "prompt_tokens": result.prompt_tokens if result else None,
+                "completion_tokens": result.completion_tokens if result else None,
+                "truncated": bool(result and result.completion_tokens >= route.max_tokens),
+            })
+        except Exception as e:
+            logger.warning("Routing decision not logged: %s", e)
+
+
+def create_model_router(default_model: str, log_collection=None):
+    """
+    MODEL_ROUTING=on routes simple trips (complexity up to MODEL_FAST_MAX_COMPLEXITY) to MODEL_FAST.
+    Off, every plan goes to the default model (still with an output budget sized to the trip), and nothing is logged.
+    """
+    if os.getenv("MODEL_ROUTING", "off").lower() not in ("1", "on", "true"):
+        return ModelRouter([Tier("default", default_model, 4096)])
+    tiers = [
+        Tier("fast", os.getenv("MODEL_FAST", "gpt-3.5-turbo"), int(os.getenv("MODEL_FAST_MAX_TOKENS", "2048")),
+             float(os.getenv("MODEL_FAST_MAX_COMPLEXITY", "4"))),
+        Tier("strong", default_model, 4096),
+    ]
+    return ModelRouter(tiers, log_collection)
@@ -0,0 +1,85 @@
+"""
+MongoClient settings. Imported when the worker creates its client, not at app import time.
+
+Pool sizes are per worker process - with gunicorn -w 4 the server sees up to 4 * MONGO_MAX_POOL_SIZE connections.
+"""
+import os
+import re
+import time
+import threading
+from pymongo import ReadPreference, monitoring
+from metrics import metrics
+
+
+def read_preference(name: str):
+    """Maps a mode name as written in connection strings (e.g. secondaryPreferred) to pymongo's object."""
+    return getattr(ReadPreference, re.sub(r"(?<!^)(?=[A-Z])", "_", name).upper())
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """Measures how long requests wait for a pooled connection, and how many connections are open / in use."""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.open = 0
+        self.in_use = 0
+
+    def _count(self, attribute: str, delta: int):
+        with self.lock:
+            setattr(self, attribute, getattr(self, attribute) + delta)
+            value = getattr(self, attribute)
+        metrics.set_gauge(f"mongo_connections_{attribute}", value)
+
+    def connection_check_out_started(self, event):
+        # Check-out is synchronous, so the start time can be kept per thread
+        self.local.started = time.monotonic()
+
+    def connection_checked_out(self, event):
+        started = getattr(self.local, "started", None)
+        if started is not None:
+            metrics.observe("mongo_pool_wait_seconds", time.monotonic() - started)
+            self.local.started = None
+        self._count("in_use", 1)
+
+    def connection_check_out_failed(self, event):
+        self.local.started = None
+        metrics.increment(f"mongo_pool_checkout_failed_{event.reason}")
+
+    def connection_checked_in(self, event):
+        self._count("in_use", -1)
+
+    def connection_created(self, event):
+        self._count("open", 1)
+
+    def connection_closed(self, event):
+        self._count("open", -1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        metrics.increment("mongo_pool_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+def mongo_client_options():
+    return {
+        "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "20")),
+        "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "2")),
+        "maxIdleTimeMS": int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000")),
+        "waitQueueTimeoutMS": int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000")),
+        "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+        "connectTimeoutMS": int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000")),
+        "socketTimeoutMS": int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "20000")),
+        "event_listeners": [PoolMetricsListener()],
+    }
+
@@ -0,0 +1,116 @@
+import os
+import json
+
+# Field names marking an encoded plan body
+CODEC_FIELD = "_codec"
+DATA_FIELD = "_data"
+
+
+def _compressor(name: str):
+    if name == "br":
+        import brotli
+
+        return lambda raw: brotli.compress(raw, quality=5), brotli.decompress
+    if name == "zstd":
+        # Optional dependency - pip install zstandard
+        import zstandard
+
+        return zstandard.ZstdCompressor(level=6).compress, zstandard.ZstdDecompressor().decompress
+    raise ValueError(f"Unknown plan codec '{name}'")
+
+
+class PlanCodec:
+    """
+    Stores plan bodies as compressed JSON bytes when PLAN_CODEC is br (Brotli) or zstd.
+    Decoding looks at the stored codec name, so documents written with any codec (or none) can always be read.
+    """
+
+    def __init__(self, name: str = "none"):
+        self.name = name
+        self.compress = _compressor(name)[0] if name != "none" else None
+
+    def encode(self, plan):
+        # Empty placeholders ([] while generating) are kept as they are so existing checks still work
+        if self.compress is None or not plan or is_encoded(plan):
+            return plan
+        from bson.binary import Binary
+
+        raw = json.dumps(plan, separators=(",", ":")).encode("utf-8")
+        return {CODEC_FIELD: self.name, DATA_FIELD: Binary(self.compress(raw))}
+
+
+def is_encoded(value):
+    return isinstance(value, dict) and CODEC_FIELD in value and DATA_FIELD in value
+
+
+def decode_plan(value):
+    if not is_encoded(value):
+        return value
+    decompress = _compressor(value[CODEC_FIELD])[1]
+    return json.loads(decompress(bytes(value[DATA_FIELD])))
+
+
+def decode_history(history):
+    return [dict(item, data=decode_plan(item.get("data"))) for item in history]
+
+
+def create_plan_codec():
+    return PlanCodec(os.getenv("PLAN_CODEC", "none").lower())
+
+
+def migrate_collection(collection, field: str, codec: PlanCodec, batch_size: int = 100):
+    """Encodes plans still stored as plain documents. field is 'plan' (plans) or 'history' (history items)."""
+    from pymongo import UpdateOne
+
+    migrated = 0
+    operations = []
+    for doc in collection.find({}, {field: 1}).batch_size(batch_size):
+        value = doc.get(field)
+        if field == "history":
+            if not value or all(is_encoded(item.get("data")) for item in value):
+                continue
+            new_value = [dict(item, data=codec.encode(item.get("data"))) for item in value]
+            # Only replace the array if nobody changed it since we read it
+            operations.append(UpdateOne({"_id": doc["_id"], field: value}, {"$set": {field: new_value}}))
+        else:
+            if not value or is_encoded(value):
+                continue
+            operations.append(UpdateOne({"_id": doc["_id"], field: value}, {"$set": {field: codec.encode(value)}}))
+
+        if len(operations) >= batch_size:
+            migrated += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+
+    if operations:
+        migrated += collection.bulk_write(operations, ordered=False).modified_count
+    return migrated
+
+
+def storage_report(collection, field: str):
+    """Compares the stored size of the documents with the size they would have without encoding."""
+    import bson
+
+    documents = 0
+    encoded = 0
+    stored_bytes = 0
+    plain_bytes = 0
+    for doc in collection.find({}):
+        documents += 1
+        stored_bytes += len(bson.encode(doc))
+        value = doc.get(field)
+        if field == "history" and value:
+            encoded += sum(1 for item in value if is_encoded(item.get("data")))
+            doc[field] = decode_history(value)
+        elif is_encoded(value):
+            encoded += 1
+            doc[field] = decode_plan(value)
+        plain_bytes += len(bson.encode(doc))
+
+    return {
+        "documents": documents,
+        "encoded_plans": encoded,
+        "stored_bytes": stored_bytes,
+        "plain_bytes": plain_bytes,
+        "saved_bytes": plain_bytes - stored_bytes,
+        "ratio": round(stored_bytes / plain_bytes, 3) if plain_bytes else 1,
+    }
@@ -0,0 +1,102 @@
+"""
+Fan-out generation of long or multi-city trips.
+
+The trip is split into chunks of consecutive days - one per city when several cities are requested, otherwise
+day ranges of chunk_days - each chunk is generated as its own plan, and the chunks are stitched back into one
+plan with the usual shape ({"title", "days": [...], "summary"}).
+"""
+import re
+from plan_reuse import trip_days
+
+CITY_SEPARATORS = re.compile(r",|;|/|&|\band\b", re.IGNORECASE)
+
+
+def split_cities(cities):
+    if not isinstance(cities, str):
+        return []
+    return [city.strip() for city in CITY_SEPARATORS.split(cities) if city.strip()]
+
+
+def split_trip(details: dict, min_days: int = 6, chunk_days: int = 4):
+    """Returns the chunks [{"first", "last", "city"}], or [] when the trip is generated in one piece."""
+    total = trip_days(details.get("dates"))
+    if not total:
+        return []
+
+    cities = split_cities(details.get("cities"))
+    if 1 < len(cities) <= total:
+        chunks = []
+        first = 1
+        for position, city in enumerate(cities):
+            # Days are shared evenly, the first cities get the remainder
+            length = total // len(cities) + (1 if position < total % len(cities) else 0)
+            chunks.append({"first": first, "last": first + length - 1, "city": city})
+            first += length
+        return chunks
+
+    if total < min_days or chunk_days <= 0:
+        return []
+    return [{"first": first, "last": min(first + chunk_days - 1, total), "city": None}
+            for first in range(1, total + 1, chunk_days)]
+
+
+def chunk_prompt(user_message: str, chunk: dict, chunks):
+    total = chunks[-1]["last"]
+    prompt = f"{user_message} Plan only days {chunk['first']} to {chunk['last']} of this {total}-day trip"
+    if chunk["city"]:
+        route = ", ".join(item["city"] for item in chunks)
+        prompt += f", all of them in {chunk['city']} (the whole trip visits {route} in this order)"
+    return prompt + (f". Number these days {chunk['first']} to {chunk['last']} and answer with the same JSON "
+                     f"structure, containing only these days.")
+
+
+def _chunk_days(part, chunk: dict):
+    expected = chunk["last"] - chunk["first"] + 1
+    days = part.get("days") if isinstance(part, dict) else None
+    if not isinstance(days, list) or not all(isinstance(day, dict) for day in days):
+        raise ValueError(f"Chunk {chunk['first']}-{chunk['last']} has no list of days")
+    if len(days) < expected:
+        raise ValueError(f"Chunk {chunk['first']}-{chunk['last']} has {len(days)} days instead of {expected}")
+    return [dict(day, day=chunk["first"] + position) for position, day in enumerate(days[:expected])]
+
+
+def _merge_fields(parts):
+    """
+    Top-level fields of the chunk plans, for the whole trip: text (the summary) is joined in day order, lists are
+    concatenated, and the title and other values come from the first chunk that has them.
+    """
+    merged = {}
+    for part in parts:
+        for key, value in part.items():
+            if key == "days":
+                continue
+            if key not in merged:
+                merged[key] = list(value) if isinstance(value, list) else value
+            elif key == "title":
+                continue
+            elif isinstance(value, str) and isinstance(merged[key], str):
+                if value.strip() and value.strip() not in merged[key]:
+                    merged[key] = f"{merged[key].rstrip()} {value.strip()}".strip()
+            elif isinstance(value, list) and isinstance(merged[key], list):
+                merged[key].extend(item for item in value if item not in merged[key])
+    return merged
+
+
+def stitch(parts, chunks, partial: bool = False):
+    """
+    Joins the chunk plans into one plan (top-level fields merged by _merge_fields).
+    With partial=True, stops at the first chunk not generated yet (None when there is none before it).
+    Raises ValueError when a chunk doesn't have the expected days.
+    """
+    days = []
+    generated = []
+    for part, chunk in zip(parts, chunks):
+        if part is None:
+            if partial:
+                break
+            raise ValueError(f"Chunk {chunk['first']}-{chunk['last']} is missing")
+        days.extend(_chunk_days(part, chunk))
+        generated.append(part)
+    if not days:
+        return None
+    return dict(_merge_fields(generated), days=days)
@@ -0,0 +1,173 @@
+"""
+In-process nearest-neighbour index over the requests of generated plans (plan_reuse.request_features).
+
+Requests are only compared inside their partition (same vacation type, countries, trip length, stars and party),
+by L2 distance, with NumPy.
+The generated_plans collection is the source of truth: every worker syncs new entries from it, and the index is
+saved to an .npz file so a new worker doesn't have to read the whole collection at startup.
+"""
+import os
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta
+from metrics import metrics
+from plan_reuse import request_features, request_partition
+
+logger = logging.getLogger("safeplan")
+
+DISTANCE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.15, 0.25, 0.5, 1.0)
+# Saved files of another version (other features or partitions) are ignored and the index is rebuilt
+INDEX_VERSION = 4
+
+
+class PlanIndex:
+    def __init__(self, path: str, max_distance: float = 0.15):
+        self.path = path
+        self.max_distance = max_distance
+        self.lock = threading.Lock()
+        self.keys = []
+        self.rows = {}
+        self.partition_ids = {}
+        self.partitions = None
+        self.vectors = None
+        self.synced_until = None
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+
+    def _grow(self, dimensions: int):
+        import numpy as np
+
+        if self.vectors is None:
+            self.vectors = np.zeros((1024, dimensions), dtype=np.float32)
+            self.partitions = np.full(1024, -1, dtype=np.int32)
+        elif len(self.keys) == len(self.vectors):
+            self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+            self.partitions = np.concatenate([self.partitions, np.full(len(self.partitions), -1, dtype=np.int32)])
+
+    def add(self, key: str, request: dict):
+        vector = request_features(request)
+        with self.lock:
+            partition = self.partition_ids.setdefault(request_partition(request), len(self.partition_ids))
+            row = self.rows.get(key)
+            if row is None:
+                self._grow(len(vector))
+                row = len(self.keys)
+                self.keys.append(key)
+                self.rows[key] = row
+            self.vectors[row] = vector
+            self.partitions[row] = partition
+            self.changed = True
+
+    def remove(self, key: str):
+        """Drops a key whose plan is gone (e.g. expired) - the row is left unused."""
+        with self.lock:
+            row = self.rows.pop(key, None)
+            if row is not None:
+                self.partitions[row] = -1
+                self.changed = True
+
+    def nearest(self, request: dict):
+        """Returns (key, distance) of the closest request within max_distance, (None, None) otherwise."""
+        import numpy as np
+
+        partition = self.partition_ids.get(request_partition(request))
+        if partition is None or self.vectors is None:
+            return None, None
+        vector = np.asarray(request_features(request), dtype=np.float32)
+        with self.lock:
+            count = len(self.keys)
+            candidates = np.flatnonzero(self.partitions[:count] == partition)
+            if not len(candidates):
+                return None, None
+            distances = np.linalg.norm(self.vectors[candidates] - vector, axis=1)
+            best = int(np.argmin(distances))
+            distance = float(distances[best])
+            key = self.keys[candidates[best]]
+        metrics.observe("plan_similarity_distance", distance, buckets=DISTANCE_BUCKETS)
+        if distance > self.max_distance:
+            return None, None
+        return key, distance
+
+    def record(self, hit: bool):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            ratio = round(self.hits / (self.hits + self.misses), 4)
+        metrics.increment("plan_similarity_hits" if hit else "plan_similarity_misses")
+        metrics.set_gauge("plan_similarity_hit_ratio", ratio)
+
+    def sync(self, generated_plans):
+        """Adds the generated plans created since the last sync."""
+        # Adding a key again only overwrites its row, so syncs overlap a little to tolerate clock skew between workers
+        since = self.synced_until - timedelta(seconds=5) if self.synced_until else None
+        for doc in generated_plans.created_since(since):
+            if doc.get("request"):
+                self.add(doc["_id"], doc["request"])
+            self.synced_until = max(self.synced_until or doc["created_at"], doc["created_at"])
+
+    def load(self):
+        import numpy as np
+
+        if not os.path.exists(self.path):
+            return False
+        with np.load(self.path, allow_pickle=False) as data:
+            if "version" not in data or int(data["version"]) != INDEX_VERSION:
+                return False
+            names = [str(name) for name in data["partition_names"]]
+            keys = [str(key) for key in data["keys"]]
+            vectors = data["vectors"]
+            partitions = data["partitions"]
+            synced_until = float(data["synced_until"])
+        with self.lock:
+            self.partition_ids = {name: index for index, name in enumerate(names)}
+            self.keys = []
+            self.rows = {}
+            self.vectors = None
+            for key, vector, partition in zip(keys, vectors, partitions):
+                self._grow(len(vector))
+                self.rows[key] = len(self.keys)
+                self.vectors[len(self.keys)] = vector
+                self.partitions[len(self.keys)] = partition
+                self.keys.append(key)
+            self.synced_until = datetime.utcfromtimestamp(synced_until) if synced_until else None
+        return True
+
+    def save(self):
+        """Writes the live rows to disk (atomically - several workers may save the same file)."""
+        import numpy as np
+
+        with self.lock:
+            rows = sorted(self.rows.values())
+            keys = np.array([self.keys[row] for row in rows], dtype=str)
+            vectors = self.vectors[rows] if rows else np.zeros((0, 0), dtype=np.float32)
+            partitions = self.partitions[rows] if rows else np.zeros(0, dtype=np.int32)
+            names = sorted(self.partition_ids, key=self.partition_ids.get)
+            synced_until = (self.synced_until - datetime(1970, 1, 1)).total_seconds() if self.synced_until else 0.0
+            self.changed = False
+
+        temporary = f"{self.path}.{os.getpid()}.tmp.npz"
+        np.savez(temporary, keys=keys, vectors=vectors, partitions=partitions,
+                 partition_names=np.array(names, dtype=str), synced_until=np.float64(synced_until),
+                 version=np.int32(INDEX_VERSION))
+        os.replace(temporary, self.path)
+
+    async def run(self, generated_plans, interval: float = 30):
+        """Loads the saved index, then syncs (and saves when changed) until cancelled."""
+        try:
+            await asyncio.to_thread(self.load)
+        except Exception as e:
+            logger.warning("Plan index %s not loaded, rebuilding: %s", self.path, e)
+        while True:
+            try:
+                await asyncio.to_thread(self.sync, generated_plans)
+                if self.changed:
+                    await asyncio.to_thread(self.save)
+                metrics.set_gauge("plan_index_size", len(self.rows))
+            except Exception as e:
+                metrics.increment("plan_index_errors")
+                logger.warning("Plan index sync failed: %s", e)
+            await asyncio.sleep(interval)
@@ -0,0 +1,191 @@
+"""
+Reuse of generated plans across users.
+
+A trip request is reduced to its canonical form - the fields that shape the plan, including the dates the prompt
+quotes, plus the trip length - and plans generated for a canonical request are kept in the generated_plans
+collection, so the same trip asked again is answered without a model call.
+Near-identical trips (a slightly different budget, a different wish, the same length on other dates) are matched
+through request_features and plan_index.PlanIndex; a plan found for other dates gets its quoted dates shifted
+(shift_plan_dates) instead of a model call.
+"""
+import re
+import json
+import math
+import hashlib
+from datetime import date, datetime, timedelta
+
+# Request fields that shape the plan (dates are kept as the prompt quotes them, and counted in tripDays)
+REQUEST_FIELDS = ("vacationType", "originCountry", "destCountry", "ages", "returnCountry", "budget", "hotel", "stars",
+                  "parking", "beach", "restaurants", "bars", "cities", "carRentalCompany", "dietaryPreferences",
+                  "additionalData", "adultsAmount", "childrenAmount")
+
+# Fields that must match for two requests to share a plan - a plan for another trip length or party size is
+# a different plan, however close the rest is (other dates of the same length are shifted)
+PARTITION_FIELDS = ("vacationType", "destCountry", "originCountry", "returnCountry", "tripDays", "stars",
+                    "adultsAmount", "childrenAmount")
+# Free-text wishes, compared as hashed bags of words
+TEXT_FIELDS = ("hotel", "parking", "beach", "restaurants", "bars", "cities", "carRentalCompany", "dietaryPreferences",
+               "additionalData")
+TEXT_DIMENSIONS = 64
+# Scale of each numeric feature - a difference of ~10% of the budget is a distance of ~0.1
+BUDGET_WEIGHT = 1.0
+AGE_WEIGHT = 0.02
+TEXT_WEIGHT = 0.5
+
+
+def trip_days(dates):
+    try:
+        return (date.fromisoformat(str(dates[1])[:10]) - date.fromisoformat(str(dates[0])[:10])).days + 1
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _date_forms(day: date):
+    # How a plan may quote a day - as the request sent it (ISO), or as the model wrote it
+    return [day.isoformat(), f"{day:%d/%m/%Y}", f"{day:%d.%m.%Y}", f"{day:%B} {day.day}", f"{day.day} {day:%B}"]
+
+
+def shift_plan_dates(plan, source_dates, target_dates):
+    """
+    Returns the plan with the days of the source trip quoted in its text replaced by the matching days of the target
+    trip (same length). The plan is returned unchanged when the dates can't be read.
+    """
+    try:
+        source = date.fromisoformat(str(source_dates[0])[:10])
+        target = date.fromisoformat(str(target_dates[0])[:10])
+        days = trip_days(source_dates)
+    except (TypeError, ValueError, IndexError):
+        return plan
+    if not days or source == target:
+        return plan
+
+    replacements = {str(quoted): str(new) for quoted, new in zip(source_dates, target_dates)}
+    for offset in range(days):
+        old_day, new_day = source + timedelta(days=offset), target + timedelta(days=offset)
+        replacements.update(zip(_date_forms(old_day), _date_forms(new_day)))
+    # One pass, longest form first - a day shifted onto another day of the trip isn't shifted twice
+    forms = "|".join(re.escape(form) for form in sorted(replacements, key=len, reverse=True))
+    pattern = re.compile(rf"(?<!\d)(?:{forms})(?!\d)")
+
+    def shift(value):
+        if isinstance(value, str):
+            return pattern.sub(lambda match: replacements[match.group(0)], value)
+        if isinstance(value, list):
+            return [shift(item) for item in value]
+        if isinstance(value, dict):
+            return {key: shift(item) for key, item in value.items()}
+        return value
+
+    return shift(plan)
+
+
+def _normalize(value):
+    if isinstance(value, str):
+        return " ".join(value.split()).casefold()
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def canonical_request(data: dict):
+    request = {field: _normalize(data.get(field)) for field in REQUEST_FIELDS}
+    # The order of the additional wishes doesn't change the plan
+    if isinstance(request["additionalData"], list):
+        request["additionalData"] = sorted(request["additionalData"], key=str)
+    dates = data.get("dates")
+    # The prompt quotes the dates, so the plan may too - another trip's dates would leak into a reused plan
+    request["dates"] = [str(value) for value in dates] if isinstance(dates, list) else dates
+    request["tripDays"] = trip_days(dates)
+    return request
+
+
+def request_key(request: dict):
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _number(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def request_partition(request: dict):
+    return "|".join(str(request.get(field) or "") for field in PARTITION_FIELDS)
+
+
+def request_features(request: dict):
+    """Numeric feature vector of a canonical request, as a list of floats (plan_index compares them by L2)."""
+    budget = request.get("budget") if isinstance(request.get("budget"), list) else []
+    low = _number(budget[0]) if len(budget) > 0 else 0.0
+    high = _number(budget[1]) if len(budget) > 1 else low
+    ages = [float(age) for age in re.findall(r"\d+", str(request.get("ages") or ""))] or [0.0]
+    features = [
+        BUDGET_WEIGHT * math.log1p(max(low, 0.0)),
+        BUDGET_WEIGHT * math.log1p(max(high, 0.0)),
+        AGE_WEIGHT * min(ages),
+        AGE_WEIGHT * max(ages),
+    ]
+
+    # Feature hashing - a stable hash, the built-in one changes between processes
+    text = [0.0] * TEXT_DIMENSIONS
+    for field in TEXT_FIELDS:
+        value = request.get(field)
+        words = " ".join(map(str, value)) if isinstance(value, list) else str(value or "")
+        for word in re.findall(r"\w+", words):
+            digest = hashlib.md5(f"{field}:{word}".encode("utf-8")).digest()
+            text[digest[0] % TEXT_DIMENSIONS] += 1.0 if digest[1] & 1 else -1.0
+    norm = math.sqrt(sum(value * value for value in text))
+    if norm:
+        features.extend(TEXT_WEIGHT * value / norm for value in text)
+    else:
+        features.extend(text)
+    return features
+
+
+class GeneratedPlans:
+    """Plan references by canonical request key. Entries expire after ttl_days so plans follow template changes."""
+
+    def __init__(self, collection, ttl_days: float = 7):
+        self.collection = collection
+        self.ttl_days = ttl_days
+        self.index_ready = False
+
+    def _ensure_index(self):
+        if not self.index_ready:
+            self.collection.create_index("expires_at", expireAfterSeconds=0)
+            self.index_ready = True
+
+    def get(self, key: str):
+        """Returns the stored plan reference, None on a miss."""
+        doc = self.collection.find_one({"_id": key, "expires_at": {"$gt": datetime.utcnow()}}, {"_id": 0, "plan": 1})
+        return doc["plan"] if doc else None
+
+    def get_entry(self, key: str):
+        """Returns the stored plan reference and the dates of its request, None on a miss."""
+        return self.collection.find_one({"_id": key, "expires_at": {"$gt": datetime.utcnow()}},
+                                        {"_id": 0, "plan": 1, "request.dates": 1})
+
+    def put(self, key: str, request: dict, plan_ref, source: str = "generated"):
+        self._ensure_index()
+        now = datetime.utcnow()
+        self.collection.update_one(
+            {"_id": key},
+            {"$set": {"plan": plan_ref, "request": request, "source": source, "created_at": now,
+                      "expires_at": now + timedelta(days=self.ttl_days)}},
+            upsert=True,
+        )
+
+    def created_since(self, since: datetime = None):
+        """Live entries created after since (all live entries when None), oldest first."""
+        query = {"expires_at": {"$gt": datetime.utcnow()}}
+        if since is not None:
+            query["created_at"] = {"$gt": since}
+        return self.collection.find(query, {"request": 1, "created_at": 1}).sort("created_at", 1)
+
+    def keys_present(self, keys):
+        """Returns the subset of keys that have a live entry, in one query."""
+        found = self.collection.find({"_id": {"$in": list(keys)}, "expires_at": {"$gt": datetime.utcnow()}},
+                                     {"_id": 1})
+        return {doc["_id"] for doc in found}
@@ -0,0 +1,79 @@
+"""
+Regeneration of one section of a stored plan (e.g. the restaurants, or the hotel of day 2).
+
+Only the selected part is sent to the model, as a partial plan with the same shape as the full one:
+{"days": [{"day": 2, "city": ..., "hotel": {...}}]} for day sections, {"summary": ...} for top-level ones.
+The answer has the same shape and is merged back by day number.
+"""
+import json
+
+# Output budget of a section answer - a full plan gets 4096
+SECTION_MAX_TOKENS = 1024
+# Day fields sent along as context, never replaced
+CONTEXT_FIELDS = ("day", "city")
+
+
+def _days(plan: dict):
+    days = plan.get("days")
+    return days if isinstance(days, list) else []
+
+
+def _day_number(day: dict, position: int):
+    return day.get("day", position + 1) if isinstance(day, dict) else position + 1
+
+
+def select_section(plan: dict, section: str, days=None):
+    """Returns the partial plan holding the section (for the given day numbers, all days when None)."""
+    if section in CONTEXT_FIELDS:
+        raise ValueError(f"Section '{section}' can't be regenerated")
+    if section in plan and section != "days":
+        return {section: plan[section]}
+
+    selected = []
+    for position, day in enumerate(_days(plan)):
+        number = _day_number(day, position)
+        if isinstance(day, dict) and section in day and (days is None or number in days):
+            entry = {field: day[field] for field in CONTEXT_FIELDS if field in day}
+            entry["day"] = number
+            entry[section] = day[section]
+            selected.append(entry)
+    if not selected:
+        raise ValueError(f"Section '{section}' not found in the plan")
+    return {"days": selected}
+
+
+def section_prompt(current: dict, constraint: str, title: str = None):
+    trip = f" for the trip '{title}'" if title else ""
+    return (f"This is part of a travel plan{trip}, as JSON: {json.dumps(current, ensure_ascii=False)}. "
+            f"Suggest a new version of it with this change: {constraint}. "
+            f"Keep the days and cities as they are. "
+            f"Return only a JSON object with exactly the same structure and keys.")
+
+
+def merge_section(plan: dict, current: dict, answer: dict, section: str):
+    """Returns a copy of the plan with the section replaced from the model's answer."""
+    if not isinstance(answer, dict):
+        raise ValueError("The answer is not a JSON object")
+    merged = dict(plan)
+    if "days" not in current:
+        if section not in answer:
+            raise ValueError(f"The answer has no '{section}'")
+        merged[section] = answer[section]
+        return merged
+
+    answered = {}
+    for position, day in enumerate(_days(answer)):
+        if isinstance(day, dict) and section in day:
+            answered[_day_number(day, position)] = day[section]
+    wanted = {day["day"] for day in current["days"]}
+    missing = wanted - set(answered)
+    if missing:
+        raise ValueError(f"The answer has no '{section}' for days {sorted(missing)}")
+
+    merged["days"] = []
+    for position, day in enumerate(_days(plan)):
+        number = _day_number(day, position)
+        if number in wanted:
+            day = dict(day, **{section: answered[number]})
+        merged["days"].append(day)
+    return merged
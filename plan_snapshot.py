@@ -0,0 +1,59 @@
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import repository
+from metrics import metrics
+
+logger = logging.getLogger("safeplan")
+
+
+class PlanSnapshot:
+    """
+    One plan kept in memory as ready-to-send JSON bytes with its ETag - used for the shared 'global' plan.
+    Every worker polls the plan document and only resolves / serializes again when the stored value changed.
+    While a new plan is being generated (stored value []) the previous snapshot keeps being served.
+    """
+
+    def __init__(self, email: str, plan_store, poll_interval: float = 5.0):
+        self.email = email
+        self.plan_store = plan_store
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.stored = None
+        self.body = None
+        self.etag = None
+
+    def current(self):
+        """Returns (body, etag), (None, None) until a plan exists."""
+        with self.lock:
+            return self.body, self.etag
+
+    def refresh(self):
+        stored = repository.find_plan(self.email)
+        if not stored or stored == self.stored or (isinstance(stored, dict) and stored.get("partial")):
+            return False
+
+        plan = self.plan_store.resolve(stored)
+        if plan is None:
+            # Dangling reference - keep serving the previous snapshot
+            return False
+        plan["saveable"] = False
+        body = json.dumps(plan, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        with self.lock:
+            self.stored = stored
+            self.body = body
+            self.etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        metrics.increment(f"plan_snapshot_{self.email}_refreshes")
+        return True
+
+    async def run(self):
+        """Polls until cancelled - started by the app lifespan in every worker."""
+        while True:
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                metrics.increment(f"plan_snapshot_{self.email}_errors")
+                logger.warning("Plan snapshot %s refresh failed: %s", self.email, e)
+            await asyncio.sleep(self.poll_interval)
@@ -0,0 +1,173 @@
+import json
+import hashlib
+from datetime import datetime, timedelta
+from plan_codec import PlanCodec, decode_plan
+
+# Field holding the hash in a plan reference
+REF_FIELD = "_ref"
+# Display-only fields added to plans on the way out - kept on the reference, not in the shared body
+VIEW_FIELDS = ("saveable",)
+
+
+def is_ref(value):
+    return isinstance(value, dict) and REF_FIELD in value
+
+
+def plan_hash(plan):
+    canonical = json.dumps(plan, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class PlanStore:
+    """
+    Content-addressed plan bodies, stored once per distinct plan in the plan_blobs collection.
+    plans and history documents only keep {"_ref": <sha256>}, so the same plan saved by many users or copied
+    from plans to history takes space once.
+    """
+
+    def __init__(self, collection, codec: PlanCodec, cache=None):
+        self.collection = collection
+        self.codec = codec
+        # Bodies never change once stored, so cached bodies need no invalidation
+        self.cache = cache
+
+    def _split(self, plan):
+        plan = decode_plan(plan)
+        body = {key: value for key, value in plan.items() if key not in VIEW_FIELDS}
+        ref = {REF_FIELD: plan_hash(body)}
+        ref.update({key: plan[key] for key in VIEW_FIELDS if key in plan})
+        return body, ref
+
+    def _insert(self, body):
+        # used_at keeps a body that was just referenced again safe from collect_garbage
+        now = datetime.utcnow()
+        return {"$setOnInsert": {"body": self.codec.encode(body), "created_at": now}, "$set": {"used_at": now}}
+
+    def put(self, plan):
+        """Stores the plan body if it is new and returns the reference to keep in plans/history."""
+        if not isinstance(plan, dict) or not plan or is_ref(plan):
+            return plan
+        from pymongo.errors import DuplicateKeyError
+
+        body, ref = self._split(plan)
+        try:
+            self.collection.update_one({"_id": ref[REF_FIELD]}, self._insert(body), upsert=True)
+        except DuplicateKeyError:
+            # Another worker stored the same plan at the same moment
+            pass
+        return ref
+
+    def put_many(self, plans):
+        """Same as put for a list of plans, with a single unordered bulk write."""
+        from pymongo import UpdateOne
+
+        refs = []
+        operations = {}
+        for plan in plans:
+            if not isinstance(plan, dict) or not plan or is_ref(plan):
+                refs.append(plan)
+                continue
+            body, ref = self._split(plan)
+            operations[ref[REF_FIELD]] = UpdateOne({"_id": ref[REF_FIELD]}, self._insert(body),
+                                                   upsert=True)
+            refs.append(ref)
+
+        if operations:
+            from pymongo.errors import BulkWriteError
+
+            try:
+                self.collection.bulk_write(list(operations.values()), ordered=False)
+            except BulkWriteError as e:
+                # Duplicate keys only mean the plan is already stored
+                if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                    raise
+        return refs
+
+    def resolve_many(self, values):
+        """Replaces every reference in values with its plan, using one lookup for all of them."""
+        hashes = list({value[REF_FIELD] for value in values if is_ref(value)})
+        bodies = {}
+        if self.cache is not None:
+            for digest in hashes:
+                found, body = self.cache.get(digest)
+                if found:
+                    bodies[digest] = body
+            hashes = [digest for digest in hashes if digest not in bodies]
+
+        if hashes:
+            for blob in self.collection.find({"_id": {"$in": hashes}}, {"body": 1}):
+                bodies[blob["_id"]] = decode_plan(blob["body"])
+                if self.cache is not None:
+                    self.cache.set(blob["_id"], bodies[blob["_id"]])
+
+        resolved = []
+        for value in values:
+            if is_ref(value):
+                body = bodies.get(value[REF_FIELD])
+                if body is None:
+                    resolved.append(None)
+                    continue
+                plan = dict(body)
+                plan.update({key: value[key] for key in VIEW_FIELDS if key in value})
+                resolved.append(plan)
+            else:
+                resolved.append(decode_plan(value))
+        return resolved
+
+    def resolve(self, value):
+        return self.resolve_many([value])[0]
+
+    def resolve_history(self, history):
+        plans = self.resolve_many([item.get("data") for item in history])
+        return [dict(item, data=plan) for item, plan in zip(history, plans)]
+
+    def migrate_collection(self, collection, field: str, batch_size: int = 100):
+        """Moves plans still stored inline (plain or encoded) into the store. field is 'plan' or 'history'."""
+        from pymongo import UpdateOne
+
+        migrated = 0
+        operations = []
+        for doc in collection.find({}, {field: 1}).batch_size(batch_size):
+            value = doc.get(field)
+            if field == "history":
+                if not value or all(is_ref(item.get("data")) or not item.get("data") for item in value):
+                    continue
+                refs = self.put_many([item.get("data") for item in value])
+                new_value = [dict(item, data=ref) for item, ref in zip(value, refs)]
+            else:
+                if not isinstance(value, dict) or not value or is_ref(value):
+                    continue
+                new_value = self.put(value)
+            # Only replace the value if nobody changed it since we read it
+            operations.append(UpdateOne({"_id": doc["_id"], field: value}, {"$set": {field: new_value}}))
+
+            if len(operations) >= batch_size:
+                migrated += collection.bulk_write(operations, ordered=False).modified_count
+                operations = []
+
+        if operations:
+            migrated += collection.bulk_write(operations, ordered=False).modified_count
+        return migrated
+
+    def collect_garbage(self, plans_collection, history_collection, generated_plans_collection=None,
+                        grace_hours: int = 1):
+        """Deletes bodies no plan, history item or generated plan points to. Recent bodies are kept - their
+        reference may be about to be written."""
+        referenced = set()
+        for doc in plans_collection.find({"plan._ref": {"$exists": True}}, {"plan._ref": 1}):
+            referenced.add(doc["plan"][REF_FIELD])
+        for doc in history_collection.find({"history.data._ref": {"$exists": True}}, {"history.data._ref": 1}):
+            referenced.update(item["data"][REF_FIELD] for item in doc.get("history", []) if is_ref(item.get("data")))
+        if generated_plans_collection is not None:
+            for doc in generated_plans_collection.find({"plan._ref": {"$exists": True}}, {"plan._ref": 1}):
+                referenced.add(doc["plan"][REF_FIELD])
+
+        cutoff = datetime.utcnow() - timedelta(hours=grace_hours)
+        unreferenced = [blob["_id"] for blob in self.collection.find({"used_at": {"$lt": cutoff}}, {"_id": 1})
+                        if blob["_id"] not in referenced]
+        if not unreferenced:
+            return 0
+        # used_at is checked again - a put() since the listing means the body is about to be referenced
+        return self.collection.delete_many({"_id": {"$in": unreferenced},
+                                            "used_at": {"$lt": cutoff}}).deleted_count
+
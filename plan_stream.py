@@ -0,0 +1,129 @@
+"""
+Incremental parsing of a streamed JSON plan.
+
+IncrementalPlanParser is fed the completion text as it arrives and keeps `plan`, the top-level object built from
+the elements that are already complete: scalars and objects once they close, and arrays (e.g. "days") one
+element at a time.
+"""
+import json
+
+WHITESPACE = " \t\r\n"
+
+
+class IncrementalPlanParser:
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.expect_key = False
+        self.key = None
+        self.token_start = None
+        self.value_start = None
+        self.plan = {}
+
+    def _emit_value(self, end: int):
+        self.plan[self.key] = json.loads(self.buffer[self.value_start:end])
+        self.value_start = None
+
+    def _emit_element(self, end: int):
+        self.plan[self.key].append(json.loads(self.buffer[self.value_start:end]))
+        self.value_start = None
+
+    def _in_top_array(self):
+        return len(self.stack) == 2 and self.stack[1] == "["
+
+    def feed(self, text: str):
+        """
+        Adds text and returns the top-level keys that got a new complete value or array element, in order.
+        Raises ValueError if the text can't be a JSON object.
+        """
+        self.buffer += text
+        completed = []
+        buffer = self.buffer
+        for index in range(self.position, len(buffer)):
+            char = buffer[index]
+            depth = len(self.stack)
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    if depth == 1 and self.expect_key:
+                        self.key = json.loads(buffer[self.token_start:index + 1])
+                    elif self.value_start is not None and depth == 1:
+                        self._emit_value(index + 1)
+                        completed.append(self.key)
+                    elif self.value_start is not None and self._in_top_array():
+                        self._emit_element(index + 1)
+                        completed.append(self.key)
+                continue
+
+            if char in WHITESPACE:
+                # Ends a number or literal
+                if self.value_start is not None and depth == 1:
+                    self._emit_value(index)
+                    completed.append(self.key)
+                elif self.value_start is not None and self._in_top_array() and buffer[self.value_start] not in "{[":
+                    self._emit_element(index)
+                    completed.append(self.key)
+                continue
+
+            if char == '"':
+                self.in_string = True
+                if depth == 1 and self.expect_key:
+                    self.token_start = index
+                elif (depth == 1 or self._in_top_array()) and self.value_start is None:
+                    self.value_start = index
+            elif char in "{[":
+                if depth == 0:
+                    if char != "{":
+                        raise ValueError("A plan must be a JSON object")
+                    self.expect_key = True
+                elif depth == 1:
+                    if char == "[":
+                        # Top-level arrays are filled element by element
+                        self.plan[self.key] = []
+                    else:
+                        self.value_start = index
+                elif self._in_top_array() and self.value_start is None:
+                    self.value_start = index
+                self.stack.append(char)
+            elif char in "}]":
+                if self.value_start is not None and buffer[self.value_start] not in "{[\"":
+                    # A number or literal closed by the bracket
+                    if depth == 1:
+                        self._emit_value(index)
+                    else:
+                        self._emit_element(index)
+                    completed.append(self.key)
+                self.stack.pop()
+                depth = len(self.stack)
+                if self.value_start is not None and depth == 1 and buffer[self.value_start] == "{":
+                    self._emit_value(index + 1)
+                    completed.append(self.key)
+                elif self.value_start is not None and self._in_top_array():
+                    self._emit_element(index + 1)
+                    completed.append(self.key)
+            elif char == ":":
+                if depth == 1:
+                    self.expect_key = False
+            elif char == ",":
+                if self.value_start is not None and depth == 1:
+                    self._emit_value(index)
+                    completed.append(self.key)
+                elif self.value_start is not None and self._in_top_array():
+                    self._emit_element(index)
+                    completed.append(self.key)
+                if depth == 1:
+                    self.expect_key = True
+            elif self.value_start is None and (depth == 1 or self._in_top_array()):
+                # Start of a number or literal
+                self.value_start = index
+
+        self.position = len(buffer)
+        return completed
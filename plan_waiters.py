@@ -0,0 +1,71 @@
+"""
+Long polling of plans - requests waiting for an email's generation to finish.
+
+Waiters of an email share one asyncio.Event, set when the generation finishes (plan stored, failed or cancelled).
+Other workers hear about it through the invalidation bus, which polls Mongo once per worker whatever the number of
+waiters, so waiting requests never query Mongo themselves.
+"""
+import asyncio
+import threading
+from metrics import metrics
+
+
+class PlanWaiters:
+    name = "plan-writes"
+
+    def __init__(self, bus=None):
+        self.bus = bus
+        self.lock = threading.Lock()
+        # email -> [event, number of waiters]
+        self.events = {}
+        self.loop = None
+        if bus is not None:
+            bus.register(self)
+
+    def watch(self, email: str):
+        """Registers a waiter - call before reading the plan, so a finish in between isn't missed."""
+        self.loop = asyncio.get_running_loop()
+        with self.lock:
+            entry = self.events.setdefault(email, [asyncio.Event(), 0])
+            entry[1] += 1
+            metrics.set_gauge("long_poll_waiters", sum(waiters for _, waiters in self.events.values()))
+            return entry[0]
+
+    def unwatch(self, email: str, event: asyncio.Event):
+        with self.lock:
+            entry = self.events.get(email)
+            if entry is not None and entry[0] is event:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.events[email]
+            metrics.set_gauge("long_poll_waiters", sum(waiters for _, waiters in self.events.values()))
+
+    async def wait(self, event: asyncio.Event, timeout: float):
+        """True when woken, False on timeout."""
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            metrics.increment("long_poll_wakeups")
+            return True
+        except asyncio.TimeoutError:
+            metrics.increment("long_poll_timeouts")
+            return False
+
+    def publish(self, email: str):
+        """Wakes the email's waiters here and in the other workers."""
+        if self.bus is not None:
+            self.bus.publish(self.name, email)
+        else:
+            self.invalidate(email)
+
+    def invalidate(self, email: str):
+        # Called by the invalidation bus from its polling thread - events are set on the event loop
+        with self.lock:
+            entry = self.events.pop(email, None)
+            metrics.set_gauge("long_poll_waiters", sum(waiters for _, waiters in self.events.values()))
+        if entry is None or self.loop is None:
+            return
+        try:
+            self.loop.call_soon_threadsafe(entry[0].set)
+        except RuntimeError:
+            # Loop closed at shutdown
+            pass
@@ -0,0 +1,146 @@
+"""
+Off-peak pre-generation of popular trips.
+
+Every /generate-response is counted in plan_demand per destination, vacation type and trip length - exact
+repeats of a request are rare, while these combinations recur. During the off-peak hours one worker per night takes
+the combinations asked at least min_count times and, from the latest request of each, generates the plans that have
+no live generated plan and whose trip hasn't started yet, at background priority, until the night's token budget
+is spent.
+"""
+import os
+import asyncio
+import logging
+from datetime import date, datetime, timedelta
+from metrics import metrics
+from plan_reuse import GeneratedPlans, canonical_request, request_key
+
+logger = logging.getLogger("safeplan")
+
+# Canonical request fields demand is counted on
+DEMAND_FIELDS = ("destCountry", "vacationType", "tripDays")
+
+
+def demand_key(request: dict):
+    return "|".join(str(request.get(field) or "") for field in DEMAND_FIELDS)
+
+
+def trip_start(dates):
+    try:
+        return date.fromisoformat(str(dates[0])[:10])
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class DemandLog:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def record(self, request: dict, data: dict):
+        # The latest raw request is kept as the sample the plan is pre-generated from
+        self.collection.update_one({"_id": demand_key(request)},
+                                   {"$inc": {"count": 1}, "$set": {"last_at": datetime.utcnow(), "sample": data}},
+                                   upsert=True)
+
+    def popular(self, limit: int, since: datetime, min_count: int = 1):
+        return list(self.collection.find({"last_at": {"$gte": since}, "count": {"$gte": min_count}},
+                                         {"count": 1, "sample": 1})
+                    .sort("count", -1).limit(limit))
+
+
+class Pregenerator:
+    """
+    generate(data) is an async callable that builds the prompt for a request without side effects, runs the model
+    and returns (plan_ref, LLMResult).
+    """
+
+    def __init__(self, demand: DemandLog, plans: GeneratedPlans, runs_collection, generate, hours=(2, 6),
+                 top: int = 20, token_budget: int = 0, lookback_days: int = 30, min_count: int = 3,
+                 check_interval: float = 600):
+        self.demand = demand
+        self.plans = plans
+        self.runs_collection = runs_collection
+        self.generate = generate
+        self.start_hour, self.end_hour = hours
+        self.top = top
+        self.token_budget = token_budget
+        self.lookback_days = lookback_days
+        self.min_count = min_count
+        self.check_interval = check_interval
+
+    def in_window(self, now: datetime):
+        if self.start_hour <= self.end_hour:
+            return self.start_hour <= now.hour < self.end_hour
+        # Window across midnight, e.g. 22-4
+        return now.hour >= self.start_hour or now.hour < self.end_hour
+
+    def claim_run(self, now: datetime):
+        """Only the first worker to insert tonight's run document does the work."""
+        from pymongo.errors import DuplicateKeyError
+
+        run_id = "pregenerate:" + (now - timedelta(hours=self.start_hour)).date().isoformat()
+        try:
+            self.runs_collection.insert_one({"_id": run_id, "started_at": now, "pid": os.getpid()})
+            return run_id
+        except DuplicateKeyError:
+            return None
+
+    def candidates(self, now: datetime):
+        """The popular samples to generate, with the key (plan_reuse.request_key) their plan is stored under."""
+        popular = self.demand.popular(self.top, now - timedelta(days=self.lookback_days), self.min_count)
+        # A plan for a trip that already started will not be asked for again
+        upcoming = [doc for doc in popular if (trip_start(doc["sample"].get("dates")) or date.min) >= now.date()]
+        for doc in upcoming:
+            doc["key"] = request_key(canonical_request(doc["sample"]))
+        present = self.plans.keys_present(doc["key"] for doc in upcoming)
+        return [doc for doc in upcoming if doc["key"] not in present]
+
+    async def run_once(self, now: datetime = None):
+        now = now or datetime.utcnow()
+        run_id = await asyncio.to_thread(self.claim_run, now)
+        if run_id is None:
+            return None
+
+        spent = 0
+        generated = 0
+        for doc in await asyncio.to_thread(self.candidates, now):
+            if spent >= self.token_budget:
+                break
+            try:
+                plan_ref, result = await self.generate(doc["sample"])
+            except Exception as e:
+                metrics.increment("pregenerate_errors")
+                logger.warning("Pre-generation of %s failed: %s", doc["_id"], e)
+                continue
+            await asyncio.to_thread(self.plans.put, doc["key"], canonical_request(doc["sample"]), plan_ref,
+                                    "pregenerated")
+            spent += result.prompt_tokens + result.completion_tokens
+            generated += 1
+            metrics.increment("pregenerated_plans")
+
+        metrics.increment("pregenerate_tokens", spent)
+        summary = {"finished_at": datetime.utcnow(), "generated": generated, "tokens": spent}
+        await asyncio.to_thread(self.runs_collection.update_one, {"_id": run_id}, {"$set": summary})
+        return summary
+
+    async def run(self):
+        """Checks for the off-peak window until cancelled - started by the app lifespan in every worker."""
+        if self.token_budget <= 0:
+            return
+        while True:
+            try:
+                if self.in_window(datetime.utcnow()):
+                    await self.run_once()
+            except Exception as e:
+                metrics.increment("pregenerate_errors")
+                logger.warning("Pre-generation run failed: %s", e)
+            await asyncio.sleep(self.check_interval)
+
+
+def create_pregenerator(demand: DemandLog, plans: GeneratedPlans, runs_collection, generate):
+    """PREGENERATE_TOKEN_BUDGET > 0 enables the nightly run, in the PREGENERATE_HOURS window (UTC, e.g. 2-6)."""
+    start, end = (int(hour) for hour in os.getenv("PREGENERATE_HOURS", "2-6").split("-"))
+    return Pregenerator(demand, plans, runs_collection, generate, hours=(start, end),
+                        top=int(os.getenv("PREGENERATE_TOP", "20")),
+                        token_budget=int(os.getenv("PREGENERATE_TOKEN_BUDGET", "0")),
+                        lookback_days=int(os.getenv("PREGENERATE_LOOKBACK_DAYS", "30")),
+                        min_count=int(os.getenv("PREGENERATE_MIN_COUNT", "3")))
@@ -0,0 +1,111 @@
+import math
+import time
+import threading
+from fastapi import HTTPException, Request
+
+
+class LocalBucketStore:
+    """In-process token buckets - a stand-in for development, every worker keeps its own counts."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key: str, capacity: float, refill_rate: float):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated_at = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * refill_rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+        return allowed, tokens
+
+
+class MongoBucketStore:
+    """Token buckets kept in one Mongo document per key, so all gunicorn workers share the same counts."""
+
+    def __init__(self, collection, idle_ttl_seconds: int = 3600):
+        self.collection = collection
+        self.idle_ttl_ms = idle_ttl_seconds * 1000
+        self.index_ready = False
+
+    def take(self, key: str, capacity: float, refill_rate: float):
+        from pymongo import ReturnDocument
+
+        if not self.index_ready:
+            # Idle buckets are removed by Mongo once expires_at has passed
+            self.collection.create_index("expires_at", expireAfterSeconds=0)
+            self.index_ready = True
+
+        # Refill, check and consume in a single atomic update, using the server clock
+        elapsed_seconds = {"$divide": [{"$subtract": ["$$NOW", {"$ifNull": ["$updated_at", "$$NOW"]}]}, 1000]}
+        bucket = self.collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {
+                    "tokens": {"$min": [capacity, {"$add": [{"$ifNull": ["$tokens", capacity]},
+                                                            {"$multiply": [elapsed_seconds, refill_rate]}]}]},
+                    "updated_at": "$$NOW",
+                    "expires_at": {"$add": ["$$NOW", self.idle_ttl_ms]},
+                }},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+                {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]}}},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return bucket["allowed"], bucket["tokens"]
+
+
+class RateLimiter:
+    def __init__(self, store, name: str, capacity: float, per_minute: float):
+        self.store = store
+        self.name = name
+        self.capacity = capacity
+        self.refill_rate = per_minute / 60.0
+
+    def hit(self, key: str):
+        """Consumes one token for the key, returns 0 when allowed or the seconds to wait otherwise."""
+        allowed, tokens = self.store.take(f"{self.name}:{key}", self.capacity, self.refill_rate)
+        if allowed:
+            return 0
+        return max(1, math.ceil((1 - tokens) / self.refill_rate))
+
+
+def client_ip(request: Request):
+    # The Heroku router appends the peer it saw as the last X-Forwarded-For entry - earlier entries come from the
+    # client and can be anything
+    forwarded = request.headers.get("x-forwarded-for")
+    if forwarded:
+        return forwarded.split(",")[-1].strip()
+    return request.client.host if request.client else "unknown"
+
+
+def rate_limit(limiter: RateLimiter, global_limiter: RateLimiter = None, public_emails=(),
+               ip_limiter: RateLimiter = None):
+    """
+    Builds a FastAPI dependency checking the caller's email bucket in limiter and IP bucket in ip_limiter (limiter
+    when not given), and an optional global one. Everyone behind a NAT or an office proxy shares the IP bucket, so
+    ip_limiter is usually the larger one.
+    Requests for public_emails (shared plans served from memory) are not limited - every visitor would share
+    one email bucket, and each check is a Mongo write.
+    """
+    ip_limiter = ip_limiter or limiter
+
+    def dependency(request: Request):
+        email = request.path_params.get("email") or request.query_params.get("email")
+        if email in public_emails:
+            return
+        retry_after = ip_limiter.hit(f"ip:{client_ip(request)}")
+        if email:
+            retry_after = max(retry_after, limiter.hit(f"email:{email}"))
+        if global_limiter is not None and not retry_after:
+            retry_after = global_limiter.hit("all")
+
+        if retry_after:
+            raise HTTPException(status_code=429, detail="Too many requests",
+                                headers={"Retry-After": str(retry_after)})
+
+    return dependency
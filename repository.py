@@ -0,0 +1,297 @@
+"""
+Database access patterns used by the endpoints.
+Every read declares the fields it needs, and every read-modify-write is a single atomic operation.
+"""
+import os
+from datetime import datetime
+from resources import resources, LazyDatabase
+from tokens import estimate_tokens
+from template_maintenance import join_template
+
+db = LazyDatabase(resources)
+users_collection = db["users"]
+templates_collection = db["templates"]
+history_collection = db['history']
+additionalData_collection = db['additionalData']
+plans_collection = db['plans']
+plan_blobs_collection = db['plan_blobs']
+rate_limits_collection = db['rate_limits']
+cache_invalidations_collection = db['cache_invalidations']
+generated_plans_collection = db['generated_plans']
+plan_demand_collection = db['plan_demand']
+scheduled_runs_collection = db['scheduled_runs']
+model_routing_collection = db['model_routing']
+template_versions_collection = db['template_versions']
+idempotency_keys_collection = db['idempotency_keys']
+
+# Read-mostly data may be served by secondaries (MONGO_READ_MOSTLY_PREFERENCE), everything else uses the primary
+READ_MOSTLY_PREFERENCE = os.getenv("MONGO_READ_MOSTLY_PREFERENCE", "secondaryPreferred")
+templates_read_collection = db.get_collection("templates", READ_MOSTLY_PREFERENCE)
+history_read_collection = db.get_collection("history", READ_MOSTLY_PREFERENCE)
+
+# Per-operation time limits, in milliseconds
+READ_TIMEOUT_MS = int(os.getenv("MONGO_READ_TIMEOUT_MS", "2000"))
+WRITE_TIMEOUT_MS = int(os.getenv("MONGO_WRITE_TIMEOUT_MS", "5000"))
+
+# Projections - what each access pattern reads
+USER_PROFILE_PROJECTION = {"password": 0}
+CREDENTIALS_PROJECTION = {"_id": 1, "password": 1}
+EXISTS_PROJECTION = {"_id": 1}
+PLAN_PROJECTION = {"_id": 0, "plan": 1}
+PLAN_JOB_PROJECTION = {"job": 1}
+PLAN_STATUS_PROJECTION = {"_id": 0, "plan": 1, "job": 1, "job_status": 1}
+HISTORY_PROJECTION = {"_id": 0, "history": 1}
+GENERAL_TEMPLATE_PROJECTION = {"_id": 0, "general-template": 1}
+INSTRUCTIONS_PROJECTION = {"_id": 0, "instructions": 1}
+TEMPLATE_PROJECTION = {"template": 1, "index": 1}
+TEMPLATE_TEXT_PROJECTION = {"vacationType": 1, "template": 1, "base": 1, "additions": 1, "version": 1, "tokens": 1}
+TEMPLATE_VERSION_PROJECTION = {"_id": 0, "version": 1, "tokens": 1, "reason": 1, "at": 1}
+ADDITIONAL_DATA_PROJECTION = {"data": 1}
+
+
+def _after():
+    from pymongo import ReturnDocument
+
+    return ReturnDocument.AFTER
+
+
+def _write_timeout():
+    # Client-side operation timeout - pymongo also sends it to the server as maxTimeMS
+    import pymongo
+
+    return pymongo.timeout(WRITE_TIMEOUT_MS / 1000)
+
+
+# Users
+
+def find_user_profile(email: str):
+    return users_collection.find_one({"email": email}, USER_PROFILE_PROJECTION, max_time_ms=READ_TIMEOUT_MS)
+
+
+def find_user_profiles(emails):
+    return users_collection.find({"email": {"$in": emails}}, USER_PROFILE_PROJECTION).max_time_ms(READ_TIMEOUT_MS)
+
+
+def find_credentials(email: str):
+    return users_collection.find_one({"email": email}, CREDENTIALS_PROJECTION, max_time_ms=READ_TIMEOUT_MS)
+
+
+def user_exists(email: str):
+    return users_collection.find_one({"email": email}, EXISTS_PROJECTION, max_time_ms=READ_TIMEOUT_MS) is not None
+
+
+def insert_user(user: dict):
+    with _write_timeout():
+        users_collection.insert_one(user)
+        history_collection.insert_one({"email": user["email"]})
+        plans_collection.insert_one({"email": user["email"], "plan": []})
+
+
+def update_user(email: str, data: dict):
+    with _write_timeout():
+        return users_collection.update_one({"email": email}, {"$set": data})
+
+
+# Plans
+
+def find_plan(email: str):
+    """Returns the stored plan value (a reference, an inline plan or [] while generating), None if no user."""
+    doc = plans_collection.find_one({"email": email}, PLAN_PROJECTION, max_time_ms=READ_TIMEOUT_MS)
+    return doc.get("plan") if doc else None
+
+
+def set_plan(email: str, plan):
+    with _write_timeout():
+        return plans_collection.update_one({"email": email}, {"$set": {"plan": plan}})
+
+
+def replace_plan(email: str, expected, plan):
+    """Sets the plan only if the stored value is still the one read before (matched_count 0 otherwise)."""
+    with _write_timeout():
+        return plans_collection.update_one({"email": email, "plan": expected}, {"$set": {"plan": plan}})
+
+
+def start_plan_job(email: str, job: str, plan, status: dict = None):
+    """
+    Sets the plan and the generation job now owning it, with the job's status (state, since when, estimate).
+    Returns the job it replaced, None when there was none.
+    """
+    from pymongo import ReturnDocument
+
+    with _write_timeout():
+        before = plans_collection.find_one_and_update({"email": email},
+                                                      {"$set": {"plan": plan, "job": job, "job_status": status}},
+                                                      projection=PLAN_JOB_PROJECTION,
+                                                      return_document=ReturnDocument.BEFORE)
+    return before.get("job") if before else None
+
+
+def set_job_plan(email: str, job: str, plan, done: bool = False):
+    """Sets the plan only while job still owns it (matched_count 0 once superseded or cancelled)."""
+    update = {"$set": {"plan": plan}}
+    if done:
+        update["$unset"] = {"job": "", "job_status": ""}
+    with _write_timeout():
+        return plans_collection.update_one({"email": email, "job": job}, update)
+
+
+def set_job_state(email: str, job: str, state: str):
+    with _write_timeout():
+        return plans_collection.update_one({"email": email, "job": job},
+                                           {"$set": {"job_status.state": state, "job_status.at": datetime.utcnow()}})
+
+
+def find_plan_status(email: str):
+    """Returns the plans document with the plan, its job and the job status, None if no user."""
+    return plans_collection.find_one({"email": email}, PLAN_STATUS_PROJECTION, max_time_ms=READ_TIMEOUT_MS)
+
+
+def find_plan_job(email: str):
+    doc = plans_collection.find_one({"email": email}, PLAN_JOB_PROJECTION, max_time_ms=READ_TIMEOUT_MS)
+    return doc.get("job") if doc else None
+
+
+def clear_plan_job(email: str, job: str):
+    with _write_timeout():
+        return plans_collection.update_one({"email": email, "job": job}, {"$unset": {"job": "", "job_status": ""}})
+
+
+# History
+
+def find_history(email: str):
+    """Returns the history list, None when the user has no history document or field."""
+    doc = history_read_collection.find_one({"email": email}, HISTORY_PROJECTION, max_time_ms=READ_TIMEOUT_MS)
+    return doc.get("history") if doc else None
+
+
+def push_history_item(email: str, data):
+    """Appends an item with the next index in one atomic update (creating the document if needed)."""
+    with _write_timeout():
+        doc = history_collection.find_one_and_update(
+            {"email": email},
+            [
+                {"$set": {"latest_index": {"$add": [{"$ifNull": ["$latest_index", 0]}, 1]}}},
+                {"$set": {"history": {"$concatArrays": [
+                    {"$ifNull": ["$history", []]},
+                    [{"index": "$latest_index", "data": {"$literal": data}}],
+                ]}}},
+            ],
+            projection={"_id": 0, "latest_index": 1},
+            upsert=True,
+            return_document=_after(),
+        )
+    return doc["latest_index"]
+
+
+def remove_history_item(email: str, index: int):
+    with _write_timeout():
+        return history_collection.update_one({"email": email}, {"$pull": {"history": {"index": index}}})
+
+
+# Templates
+
+def find_general_template():
+    doc = templates_read_collection.find_one({"general-template": {"$exists": True}}, GENERAL_TEMPLATE_PROJECTION,
+                                             max_time_ms=READ_TIMEOUT_MS)
+    return doc.get("general-template") if doc else None
+
+
+def find_instructions():
+    doc = templates_read_collection.find_one({"instructions": {"$exists": True}}, INSTRUCTIONS_PROJECTION,
+                                             max_time_ms=READ_TIMEOUT_MS)
+    return doc.get("instructions") if doc else None
+
+
+def update_general_template(template: str, data: dict):
+    with _write_timeout():
+        return templates_collection.update_one({"general-template": {"$exists": True}},
+                                               {"$set": {"general-template": template, **data}})
+
+
+def find_template(vacation_type: str):
+    return templates_read_collection.find_one({"vacationType": vacation_type}, TEMPLATE_PROJECTION,
+                                              max_time_ms=READ_TIMEOUT_MS)
+
+
+def rotate_template(vacation_type: str):
+    """Advances the template's 0-9 index and returns the template with its new index, in one round trip."""
+    with _write_timeout():
+        return templates_collection.find_one_and_update(
+            {"vacationType": vacation_type},
+            [{"$set": {"index": {"$mod": [{"$add": [{"$ifNull": ["$index", 0]}, 1]}, 10]}}}],
+            projection=TEMPLATE_PROJECTION,
+            return_document=_after(),
+        )
+
+
+def find_template_for_update(vacation_type: str):
+    """The template's text and parts from the primary - for a read-modify-write, a stale secondary would lose a save."""
+    return templates_collection.find_one({"vacationType": vacation_type}, TEMPLATE_TEXT_PROJECTION,
+                                         max_time_ms=READ_TIMEOUT_MS)
+
+
+def find_vacation_templates():
+    return templates_collection.find({"vacationType": {"$exists": True}}, TEMPLATE_TEXT_PROJECTION) \
+        .max_time_ms(READ_TIMEOUT_MS)
+
+
+def save_template_version(template_id, base: str, additions, reason: str):
+    """
+    Sets the template's base and learned clauses (and their joined text) as its next version, and keeps them in
+    template_versions. Returns the version.
+    """
+    from pymongo import ReturnDocument
+
+    now = datetime.utcnow()
+    text = join_template(base, additions)
+    tokens = estimate_tokens(text)
+    with _write_timeout():
+        before = templates_collection.find_one_and_update(
+            {"_id": template_id},
+            {"$set": {"template": text, "base": base, "additions": additions, "tokens": tokens},
+             "$inc": {"version": 1}},
+            projection=TEMPLATE_TEXT_PROJECTION,
+            return_document=ReturnDocument.BEFORE,
+        )
+        if before is None:
+            return None
+        version = before.get("version", 0) + 1
+        entries = [{"vacationType": before["vacationType"], "version": version, "template": text, "base": base,
+                    "additions": additions, "tokens": tokens, "reason": reason, "at": now}]
+        if "version" not in before:
+            # First change - keep the original text too, as version 0
+            entries.insert(0, {"vacationType": before["vacationType"], "version": 0, "template": before["template"],
+                               "base": before.get("base", before["template"]),
+                               "additions": before.get("additions", []),
+                               "tokens": estimate_tokens(before["template"]), "reason": "initial", "at": now})
+        template_versions_collection.insert_many(entries)
+    return version
+
+
+def find_template_versions(vacation_type: str):
+    return list(template_versions_collection.find({"vacationType": vacation_type}, TEMPLATE_VERSION_PROJECTION)
+                .sort("version", -1).max_time_ms(READ_TIMEOUT_MS))
+
+
+def find_template_version(vacation_type: str, version: int):
+    return template_versions_collection.find_one({"vacationType": vacation_type, "version": version},
+                                                 {"_id": 0, "template": 1, "base": 1, "additions": 1},
+                                                 max_time_ms=READ_TIMEOUT_MS)
+
+
+# Additional data collected per vacation type
+
+def find_additional_data(vacation_type: str):
+    return additionalData_collection.find_one({"vacationType": vacation_type}, ADDITIONAL_DATA_PROJECTION,
+                                              max_time_ms=READ_TIMEOUT_MS)
+
+
+def push_additional_data(vacation_type: str, items):
+    with _write_timeout():
+        return additionalData_collection.update_one({"vacationType": vacation_type},
+                                                    {"$push": {"data": {"$each": list(items)}}})
+
+
+def clear_additional_data(additional_data_id):
+    with _write_timeout():
+        return additionalData_collection.update_one({"_id": additional_data_id}, {"$set": {"data": []}})
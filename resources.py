@@ -0,0 +1,84 @@
+import os
+import threading
+
+
+class Resources:
+    """
+    Owns the per-worker clients (Mongo + LLM backend).
+    They are created on first use or by the app lifespan, never at import time, so a gunicorn --preload master
+    doesn't hand clients over to forked workers.
+    """
+
+    def __init__(self, database_name: str = "safeplan"):
+        self.database_name = database_name
+        self.mongo_client = None
+        self.llm = None
+        self.lock = threading.Lock()
+
+    def database(self):
+        if self.mongo_client is None:
+            with self.lock:
+                if self.mongo_client is None:
+                    from pymongo.mongo_client import MongoClient
+                    from mongo_config import mongo_client_options
+
+                    self.mongo_client = MongoClient(os.getenv("MONGO_DB"), **mongo_client_options())
+        return self.mongo_client[self.database_name]
+
+    def llm_backend(self):
+        if self.llm is None:
+            with self.lock:
+                if self.llm is None:
+                    from llm_backends import create_llm_backend
+
+                    self.llm = create_llm_backend()
+        return self.llm
+
+    async def open(self):
+        """Creates the clients and warms their connections before the worker accepts traffic."""
+        # The ping waits for server selection; the pool then fills up to MONGO_MIN_POOL_SIZE in the background
+        self.database().command("ping")
+        await self.llm_backend().warm()
+
+    def close(self):
+        if self.mongo_client is not None:
+            self.mongo_client.close()
+            self.mongo_client = None
+        self.llm = None
+
+
+class LazyDatabase:
+    """Stands in for the Mongo database until the worker's client exists."""
+
+    def __init__(self, resources: Resources):
+        self._resources = resources
+
+    def __getitem__(self, name: str):
+        return LazyCollection(self._resources, name)
+
+    def get_collection(self, name: str, read_preference: str = None):
+        return LazyCollection(self._resources, name, read_preference)
+
+    def __getattr__(self, name: str):
+        return getattr(self._resources.database(), name)
+
+
+class LazyCollection:
+    def __init__(self, resources: Resources, name: str, read_preference: str = None):
+        self._resources = resources
+        self._name = name
+        self._read_preference = read_preference
+
+    def _collection(self):
+        database = self._resources.database()
+        if self._read_preference is None:
+            return database[self._name]
+        from mongo_config import read_preference
+
+        return database.get_collection(self._name, read_preference=read_preference(self._read_preference))
+
+    def __getattr__(self, name: str):
+        return getattr(self._collection(), name)
+
+
+resources = Resources()
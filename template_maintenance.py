@@ -0,0 +1,69 @@
+"""
+Keeps the vacation templates from growing without bound.
+
+analyze_data appends what it learns to a template as a clause. A template document keeps its base text (which holds
+the format placeholders) and its learned clauses apart, in base and additions, next to the joined text the prompts
+read. Before a template is saved its clauses are deduplicated (also against the base) and, above max_tokens, the
+oldest clauses are dropped - the base is always kept as written. Every saved text is kept as a version in
+template_versions for rollback.
+
+Templates saved before base and additions were kept apart are split when first read: learned clauses were appended
+after the whole original text, so they start at the first " In addition, " past the last format placeholder.
+"""
+import re
+from tokens import estimate_tokens
+
+ADDITION_MARKER = " In addition, "
+# A str.format placeholder, not an escaped brace
+PLACEHOLDER = re.compile(r"(?<!\{)\{[A-Za-z_]\w*\}(?!\})")
+
+
+def split_legacy_template(text: str):
+    placeholders = list(PLACEHOLDER.finditer(text))
+    if not placeholders:
+        # Nothing tells the original text from the learned clauses
+        return text, []
+    start = text.find(ADDITION_MARKER, placeholders[-1].end())
+    if start < 0:
+        return text, []
+    base, *additions = [text[:start]] + text[start + len(ADDITION_MARKER):].split(ADDITION_MARKER)
+    return base, additions
+
+
+def template_parts(template: dict):
+    """The template's base text and learned clauses (split from its text when saved before they were kept apart)."""
+    if "base" in template:
+        return template["base"], list(template.get("additions") or [])
+    return split_legacy_template(template["template"])
+
+
+def join_template(base: str, additions):
+    return base + "".join(ADDITION_MARKER + addition for addition in additions)
+
+
+def _clause_key(clause: str):
+    return " ".join(clause.split()).casefold().rstrip(". ")
+
+
+def escape_clause(clause: str):
+    # The template goes through str.format - braces in learned text must not be read as placeholders
+    return clause.replace("{", "{{").replace("}", "}}")
+
+
+def compact_template(base: str, additions, max_tokens: int):
+    """
+    Returns the clauses without repeats (of each other or of a sentence of the base), and without the oldest ones
+    while the template is above max_tokens.
+    """
+    unique = []
+    seen = {_clause_key(sentence.removeprefix(ADDITION_MARKER.strip()))
+            for sentence in re.split(r"(?<=[.!?])\s+", base)}
+    for addition in additions:
+        key = _clause_key(addition)
+        if key and key not in seen:
+            seen.add(key)
+            unique.append(addition.strip())
+
+    while unique and estimate_tokens(join_template(base, unique)) > max_tokens:
+        unique.pop(0)
+    return unique
@@ -1,6 +1,35 @@
+import asyncio
+import json
+import openai
+import time
 import unittest
+from unittest import mock
 from fastapi.testclient import TestClient
+import FastAPI as api
 from FastAPI import app, get_db
+from llm_backends import StubBackend, ReplayBackend, create_llm_backend
+from fastapi import FastAPI, Depends
+from rate_limit import RateLimiter, LocalBucketStore, rate_limit
+from admin_auth import admin_token
+from plan_codec import PlanCodec, decode_plan
+import os
+import tempfile
+from datetime import datetime
+from cache import TTLCache, InvalidationBus
+from cache_backends import SQLiteBackend
+from plan_reuse import canonical_request, request_key, shift_plan_dates
+from plan_index import PlanIndex
+from pregeneration import Pregenerator, demand_key
+from plan_sections import select_section, merge_section
+from plan_stream import IncrementalPlanParser
+from plan_fanout import split_trip, stitch
+from model_router import ModelRouter, Tier
+from template_maintenance import compact_template, join_template, template_parts
+from tokens import fit_prompt, plan_output_budget, PromptTooLarge
+from generation_jobs import GenerationJobs
+from generation_eta import LatencyEstimator
+from plan_waiters import PlanWaiters
+from llm_scheduler import LLMScheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
 
 
 class TestEndpoints(unittest.TestCase):
@@ -65,6 +94,26 @@ class TestEndpoints(unittest.TestCase):
         response = self.client.post("/check-credentials", json=data)
         self.assertIn("Invalid credentials", response.text)
 
+    def test_history_of_unknown_user(self):
+        # Test ID: Unknown history
+        # Description: Read and remove history of an email that has no history document.
+        # Expected results: Status code: 404 for both
+        response = self.client.get("/get-user-history/nobody@example.com")
+        self.assertEqual(response.status_code, 404)
+        response = self.client.delete("/remove-from-history/nobody@example.com/1")
+        self.assertEqual(response.status_code, 404)
+
+    def test_update_user_history_with_idempotency_key(self):
+        # Test ID: Idempotent history write
+        # Description: Send the same history item twice with one Idempotency-Key, as a client retry would.
+        # Expected results: Both answers carry the same index, the second one is marked as replayed.
+        headers = {"Idempotency-Key": os.urandom(8).hex()}
+        first = self.client.put("/update-user-history/natali@gmail.com", json={"title": "Budapest"}, headers=headers)
+        second = self.client.put("/update-user-history/natali@gmail.com", json={"title": "Budapest"}, headers=headers)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.json()["index"], first.json()["index"])
+        self.assertEqual(second.headers.get("Idempotent-Replayed"), "true")
+
 
 class TestDatabase(unittest.TestCase):
     # test DB connection + add/get/update user + add to history
@@ -98,6 +147,17 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn('"email":"natali@gmail.com"', response.text)
 
+    def test_get_users_batch(self):
+        # Test ID: Successful batch fetching from DB
+        # Description: Get several users in one request.
+        # Expected results: Status code: 200, results keyed by email, unknown emails are null, no password hash.
+        response = self.client.post("/get-users", json={"emails": ["natali@gmail.com", "unknown@gmail.com"]})
+        self.assertEqual(response.status_code, 200)
+        users = response.json()
+        self.assertEqual(users["natali@gmail.com"]["email"], "natali@gmail.com")
+        self.assertNotIn("password", users["natali@gmail.com"])
+        self.assertIsNone(users["unknown@gmail.com"])
+
     def test_update_user(self):
         # Test ID: Successful updating data in DB
         # Description: Update user information.
@@ -165,5 +225,601 @@ class TestDependencies(unittest.TestCase):
         self.assertEqual(app.openapi_version, "3.1.0")
 
 
+class TestLLMBackends(unittest.TestCase):
+    # test offline LLM backends - stub + record/replay
+    def test_stub_backend_is_deterministic(self):
+        # Test ID: Stub determinism
+        # Description: The stub backend returns the same valid plan JSON for the same prompt.
+        # Expected results: Equal JSON plans with the configured token count.
+        backend = StubBackend(completion_tokens=123, days=2)
+        messages = [{"role": "user", "content": "Family Vacation to Budapest"}]
+        first = backend.complete(messages, model="gpt-4-turbo", max_tokens=4096, json_mode=True)
+        second = backend.complete(messages, model="gpt-4-turbo", max_tokens=4096, json_mode=True)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(len(json.loads(first.content)["days"]), 2)
+        self.assertEqual(first.completion_tokens, 123)
+
+    def test_replay_backend_serves_recorded_response(self):
+        # Test ID: Record and replay
+        # Description: A completion recorded once is served from disk without the recorder.
+        # Expected results: Replayed content equals recorded content, unknown prompts raise LookupError.
+        messages = [{"role": "user", "content": "Couple Vacation to Rome"}]
+        with tempfile.TemporaryDirectory() as directory:
+            recorded = ReplayBackend(directory, recorder=StubBackend()).complete(
+                messages, model="gpt-4-turbo", max_tokens=4096, json_mode=True)
+            replay = ReplayBackend(directory)
+            self.assertEqual(replay.complete(messages, model="gpt-4-turbo", max_tokens=4096, json_mode=True).content,
+                             recorded.content)
+            with self.assertRaises(LookupError):
+                replay.complete([{"role": "user", "content": "unknown"}], model="gpt-4-turbo", max_tokens=4096)
+
+
+    def test_openai_backend_without_key(self):
+        # Test ID: Offline start
+        # Description: Build the OpenAI backend (and a recorder) without OPENAI_API_KEY, as stub and replay setups do.
+        # Expected results: Nothing fails until a client is actually needed.
+        with mock.patch.dict(os.environ):
+            os.environ.pop("OPENAI_API_KEY", None)
+            backend = create_llm_backend("openai")
+            create_llm_backend("record")
+            with self.assertRaises(openai.OpenAIError):
+                backend.client.chat
+
+class TestRateLimiting(unittest.TestCase):
+    # test token bucket rate limiting
+    def test_bucket_rejects_after_burst(self):
+        # Test ID: Token bucket burst
+        # Description: A bucket allows its burst capacity and then asks the caller to retry later.
+        # Expected results: 3 allowed hits, then a positive Retry-After, other keys are unaffected.
+        limiter = RateLimiter(LocalBucketStore(), "generate", capacity=3, per_minute=1)
+        self.assertEqual([limiter.hit("email:natali") for _ in range(3)], [0, 0, 0])
+        self.assertGreater(limiter.hit("email:natali"), 0)
+        self.assertEqual(limiter.hit("email:other"), 0)
+
+    def test_public_plan_not_limited(self):
+        # Test ID: Public plan rate limiting
+        # Description: 70 visitors from distinct IPs read the shared 'global' plan,
+        #              one user reads their own plan 70 times.
+        # Expected results: No visitor of the global plan is limited, the single user is.
+        limiter = RateLimiter(LocalBucketStore(), "read", capacity=60, per_minute=60)
+        limited = FastAPI()
+
+        @limited.get("/plan/{email}", dependencies=[Depends(rate_limit(limiter, public_emails=("global",)))])
+        def plan(email: str):
+            return {"email": email}
+
+        client = TestClient(limited)
+        statuses = {client.get("/plan/global", headers={"X-Forwarded-For": f"10.0.0.{caller}"}).status_code
+                    for caller in range(70)}
+        self.assertEqual(statuses, {200})
+        statuses = [client.get("/plan/natali").status_code for _ in range(70)]
+        self.assertIn(429, statuses)
+
+    def test_forwarded_for_spoofing(self):
+        # Test ID: Forwarded IP
+        # Description: One client rotates the X-Forwarded-For entries it sends itself,
+        #              the router appends its real address.
+        # Expected results: All requests count against the appended address - the client gets a 429.
+        limiter = RateLimiter(LocalBucketStore(), "read", capacity=5, per_minute=1)
+        limited = FastAPI()
+
+        @limited.get("/plans", dependencies=[Depends(rate_limit(limiter))])
+        def plans():
+            return {}
+
+        client = TestClient(limited)
+        statuses = [client.get("/plans", headers={"X-Forwarded-For": f"1.2.3.{attempt}, 203.0.113.7"}).status_code
+                    for attempt in range(10)]
+        self.assertIn(429, statuses)
+
+    def test_shared_address_own_bucket(self):
+        # Test ID: Shared address
+        # Description: Twenty users behind one NAT address generate a plan each, with a per-user burst of 2.
+        # Expected results: None is limited - the address has its own, larger bucket; one user's third call is.
+        limiter = RateLimiter(LocalBucketStore(), "generate", capacity=2, per_minute=1)
+        ip_limiter = RateLimiter(LocalBucketStore(), "generate-ip", capacity=30, per_minute=20)
+        limited = FastAPI()
+
+        @limited.post("/generate", dependencies=[Depends(rate_limit(limiter, ip_limiter=ip_limiter))])
+        def generate():
+            return {}
+
+        client = TestClient(limited)
+        statuses = [client.post(f"/generate?email=user{user}@x").status_code for user in range(20)]
+        self.assertEqual(set(statuses), {200})
+        self.assertEqual([client.post("/generate?email=user0@x").status_code for _ in range(2)], [200, 429])
+
+
+class TestAdminAuth(unittest.TestCase):
+    # test the admin token guard
+    def test_admin_token(self):
+        # Test ID: Admin token
+        # Description: Call a guarded endpoint without, with a wrong and with the right token, then with none set.
+        # Expected results: 401, 401, 200, and 403 for every request while no token is configured.
+        guarded = FastAPI()
+
+        @guarded.get("/admin/stats", dependencies=[Depends(admin_token("secret"))])
+        def stats():
+            return {}
+
+        @guarded.get("/admin/closed", dependencies=[Depends(admin_token(None))])
+        def closed():
+            return {}
+
+        client = TestClient(guarded)
+        self.assertEqual(client.get("/admin/stats").status_code, 401)
+        self.assertEqual(client.get("/admin/stats", headers={"X-Admin-Token": "guess"}).status_code, 401)
+        self.assertEqual(client.get("/admin/stats", headers={"X-Admin-Token": "secret"}).status_code, 200)
+        self.assertEqual(client.get("/admin/closed", headers={"X-Admin-Token": "secret"}).status_code, 403)
+
+    def test_app_admin_endpoints_guarded(self):
+        # Test ID: Guarded endpoints
+        # Description: Export the history and read the storage stats without an admin token.
+        # Expected results: Both refused before any database access.
+        client = TestClient(app)
+        self.assertIn(client.get("/export-history").status_code, (401, 403))
+        self.assertIn(client.get("/admin/plan-storage-stats").status_code, (401, 403))
+
+
+class TestLLMScheduler(unittest.TestCase):
+    # test LLM concurrency scheduling - priorities + per-user fairness
+    def test_interactive_and_fair_order(self):
+        # Test ID: Scheduler order
+        # Description: With one slot busy, queued calls are served interactive first and users take turns.
+        # Expected results: The other user is served between the heavy user's calls, background job last.
+        async def scenario():
+            scheduler = LLMScheduler(max_concurrency=1)
+            order = []
+
+            async def call(user, priority):
+                async with scheduler.slot(user, priority):
+                    order.append(user)
+
+            await scheduler.acquire("heavy")
+            tasks = [asyncio.create_task(call("analyze", PRIORITY_BACKGROUND)),
+                     asyncio.create_task(call("heavy", PRIORITY_INTERACTIVE)),
+                     asyncio.create_task(call("heavy", PRIORITY_INTERACTIVE)),
+                     asyncio.create_task(call("other", PRIORITY_INTERACTIVE))]
+            await asyncio.sleep(0)
+            scheduler.release("heavy")
+            await asyncio.gather(*tasks)
+            return order
+
+        self.assertEqual(asyncio.run(scenario()), ["heavy", "other", "heavy", "analyze"])
+
+
+class TestPlanCodec(unittest.TestCase):
+    # test compressed plan storage
+    def test_encode_decode_round_trip(self):
+        # Test ID: Plan codec round trip
+        # Description: A plan encoded with Brotli decodes to the same plan, plain plans pass through unchanged.
+        # Expected results: Decoded plan equals the original, empty placeholder is not encoded.
+        plan = {"days": [{"day": i, "activities": ["Museum", "Old town", "Market"]} for i in range(10)]}
+        codec = PlanCodec("br")
+        encoded = codec.encode(plan)
+        self.assertEqual(encoded["_codec"], "br")
+        self.assertEqual(decode_plan(encoded), plan)
+        self.assertEqual(decode_plan(plan), plan)
+        self.assertEqual(codec.encode([]), [])
+
+
+class TestProfileCache(unittest.TestCase):
+    # test read-through LRU/TTL cache
+    def test_read_through_and_eviction(self):
+        # Test ID: Cache read-through
+        # Description: Misses are loaded once, the least recently used entry is evicted when full.
+        # Expected results: Loader called once per key, evicted key is loaded again, invalidated key too.
+        loads = []
+
+        def loader(key):
+            loads.append(key)
+            return {"email": key}
+
+        cache = TTLCache("test", max_entries=2, ttl=60)
+        cache.get_or_load("a", loader)
+        cache.get_or_load("a", loader)
+        cache.get_or_load("b", loader)
+        cache.get_or_load("c", loader)
+        cache.get_or_load("a", loader)
+        cache.invalidate("c")
+        cache.get_or_load("c", loader)
+        self.assertEqual(loads, ["a", "b", "c", "a", "c"])
+
+    def test_batch_load_after_invalidation(self):
+        # Test ID: Cache batch read-through
+        # Description: A profile is updated (invalidated) while the batch of misses is read from Mongo.
+        # Expected results: The stale profile is returned but not cached, the others are; hits are not loaded.
+        cache = TTLCache("test", max_entries=10, ttl=60)
+        cache.set("a", {"name": "cached"})
+        loads = []
+
+        def loader(keys):
+            loads.append(keys)
+            cache.invalidate("b")
+            return {key: {"name": "old " + key} for key in keys if key != "d"}
+
+        users = cache.get_many_or_load(["a", "b", "c", "d"], loader)
+        self.assertEqual(users, {"a": {"name": "cached"}, "b": {"name": "old b"}, "c": {"name": "old c"}, "d": None})
+        self.assertEqual(loads, [["b", "c", "d"]])
+        self.assertEqual((cache.get("b"), cache.get("c")), ((False, None), (True, {"name": "old c"})))
+
+    def test_shared_backend_versions(self):
+        # Test ID: Shared cache versioning
+        # Description: A load that started before an invalidation must not be cached over it.
+        # Expected results: Stale conditional write rejected, fresh conditional write accepted, value shared.
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.db")
+            worker_a, worker_b = SQLiteBackend(path), SQLiteBackend(path)
+            version, value = worker_a.get("profile:a")
+            self.assertIsNone(value)
+            worker_b.invalidate("profile:a", 60)
+            self.assertFalse(worker_a.set("profile:a", {"name": "old"}, 60, expected_version=version))
+            version, value = worker_a.get("profile:a")
+            self.assertTrue(worker_a.set("profile:a", {"name": "new"}, 60, expected_version=version))
+            self.assertEqual(worker_b.get("profile:a")[1], {"name": "new"})
+
+
+class TestPlanReuse(unittest.TestCase):
+    # test canonical request keys
+    def test_canonical_request_key(self):
+        # Test ID: Canonical request
+        # Description: Requests that differ only in case, spacing or wish order describe the same trip.
+        # Expected results: Same key for those, different keys for other dates (the plan may quote them).
+        request = {"vacationType": "Family Vacation", "destCountry": "Budapest", "dates": ["2024-05-08", "2024-05-12"],
+                   "budget": [9000, 15000], "additionalData": ["kids", "museums"]}
+        respaced = dict(request, destCountry=" budapest", additionalData=["museums", "kids"])
+        shifted = dict(request, dates=["2024-06-01", "2024-06-05"])
+        longer = dict(request, dates=["2024-05-08", "2024-05-14"])
+        self.assertEqual(request_key(canonical_request(request)), request_key(canonical_request(respaced)))
+        self.assertNotEqual(request_key(canonical_request(request)), request_key(canonical_request(shifted)))
+        self.assertNotEqual(request_key(canonical_request(request)), request_key(canonical_request(longer)))
+        self.assertEqual(canonical_request(request)["tripDays"], 5)
+
+    def test_similar_request_index(self):
+        # Test ID: Similar request index
+        # Description: A slightly different budget or other dates of the same length find the stored request, a
+        #              different destination, trip length or party size does not.
+        # Expected results: Nearest key within the distance, nothing for far or other-partition requests, same after reload.
+        request = canonical_request({"vacationType": "Family Vacation", "destCountry": "Budapest",
+                                     "dates": ["2024-05-08", "2024-05-12"], "budget": [9000, 15000], "hotel": "center"})
+        with tempfile.TemporaryDirectory() as directory:
+            index = PlanIndex(os.path.join(directory, "index.npz"), max_distance=0.15)
+            index.add("stored", request)
+            self.assertEqual(index.nearest(dict(request, budget=[9100, 15000]))[0], "stored")
+            shifted = canonical_request({"vacationType": "Family Vacation", "destCountry": "Budapest",
+                                         "dates": ["2024-06-01", "2024-06-05"], "budget": [9000, 15000],
+                                         "hotel": "center"})
+            self.assertEqual(index.nearest(shifted)[0], "stored")
+            self.assertIsNone(index.nearest(dict(request, budget=[3000, 5000]))[0])
+            self.assertIsNone(index.nearest(dict(request, destCountry="rome"))[0])
+            self.assertIsNone(index.nearest(dict(request, adultsAmount=3))[0])
+            index.save()
+            reloaded = PlanIndex(index.path, max_distance=0.15)
+            reloaded.load()
+            self.assertEqual(reloaded.nearest(dict(request, budget=[9100, 15000]))[0], "stored")
+            self.assertIsNone(reloaded.nearest(dict(request, tripDays=6))[0])
+
+    def test_shift_plan_dates(self):
+        # Test ID: Reused plan dates
+        # Description: A plan for 08-12.05 is reused for the same trip one day later.
+        # Expected results: Every quoted day moves by one day, once, in each form; other numbers are unchanged.
+        plan = {"title": "Budapest, 2024-05-08 to 2024-05-12",
+                "days": [{"day": 1, "date": "08/05/2024", "note": "May 8, then 18 May"}, {"day": 2, "date": "May 9"}]}
+        shifted = shift_plan_dates(plan, ["2024-05-08", "2024-05-12"], ["2024-05-09", "2024-05-13"])
+        self.assertEqual(shifted, {"title": "Budapest, 2024-05-09 to 2024-05-13",
+                                   "days": [{"day": 1, "date": "09/05/2024", "note": "May 9, then 18 May"},
+                                            {"day": 2, "date": "May 10"}]})
+        self.assertIs(shift_plan_dates(plan, None, ["2024-05-09", "2024-05-13"]), plan)
+
+
+class TestPlanSections(unittest.TestCase):
+    # test section selection and merge
+    def test_merge_only_selected_days(self):
+        # Test ID: Section merge
+        # Description: Regenerating the restaurants of day 2 only replaces that section of that day.
+        # Expected results: Day 2 restaurants replaced, day 1 and the hotels unchanged, missing answer rejected.
+        plan = {"title": "Trip", "days": [{"day": 1, "city": "A", "hotel": "H1", "restaurants": ["R1"]},
+                                          {"day": 2, "city": "B", "hotel": "H2", "restaurants": ["R2"]}]}
+        current = select_section(plan, "restaurants", {2})
+        self.assertEqual(current, {"days": [{"day": 2, "city": "B", "restaurants": ["R2"]}]})
+        merged = merge_section(plan, current, {"days": [{"day": 2, "city": "C", "restaurants": ["Vegan"]}]},
+                               "restaurants")
+        self.assertEqual([day["restaurants"] for day in merged["days"]], [["R1"], ["Vegan"]])
+        self.assertEqual([day["city"] for day in merged["days"]], ["A", "B"])
+        self.assertEqual(plan["days"][1]["restaurants"], ["R2"])
+        with self.assertRaises(ValueError):
+            merge_section(plan, current, {"days": []}, "restaurants")
+
+
+class TestPlanStream(unittest.TestCase):
+    # test incremental parsing of a streamed plan
+    def test_days_complete_one_by_one(self):
+        # Test ID: Incremental plan parsing
+        # Description: A plan fed a few characters at a time exposes each day as soon as it closes.
+        # Expected results: Day counts grow 1, 2, 3 and the final plan equals json.loads of the whole text.
+        text = json.dumps({"title": "Trip", "days": [{"day": day, "city": "A}[\"", "activities": [{"time": 9}]}
+                                                     for day in (1, 2, 3)], "summary": "done", "cost": 120})
+        parser = IncrementalPlanParser()
+        progress = []
+        for start in range(0, len(text), 5):
+            if "days" in parser.feed(text[start:start + 5]):
+                progress.append(len(parser.plan["days"]))
+        self.assertEqual(progress, [1, 2, 3])
+        self.assertEqual(parser.plan, json.loads(text))
+
+    def test_progress_writes_coalesced(self):
+        # Test ID: Partial plan writes
+        # Description: Days complete faster than Mongo writes - partials are saved off the event loop.
+        # Expected results: The first and the latest partial are written, as they were when saved, before flush returns.
+        written = []
+
+        def save_progress(email, partial, job=None):
+            time.sleep(0.05)
+            written.append(len(partial["days"]))
+
+        async def generate():
+            plan = {"days": []}
+            writer = api.ProgressWriter("natali", "job")
+            for day in (1, 2, 3):
+                plan["days"].append({"day": day})
+                writer.save(plan)
+                await asyncio.sleep(0)
+            plan["days"].append({"day": 4})
+            await writer.flush()
+
+        with mock.patch.object(api, "save_progress", save_progress):
+            asyncio.run(generate())
+        self.assertEqual(written, [1, 3])
+
+
+class TestPlanFanout(unittest.TestCase):
+    # test splitting a trip into chunks and stitching them back
+    def test_split_and_stitch(self):
+        # Test ID: Fan-out chunks
+        # Description: Multi-city trips split by city, long trips by day range, chunks stitch back in day order.
+        # Expected results: Day ranges cover the trip, stitched days renumbered, short chunk rejected.
+        by_city = split_trip({"dates": ["2024-05-01", "2024-05-07"], "cities": "Budapest, Vienna and Prague"})
+        self.assertEqual([(c["first"], c["last"], c["city"]) for c in by_city],
+                         [(1, 3, "Budapest"), (4, 5, "Vienna"), (6, 7, "Prague")])
+        by_days = split_trip({"dates": ["2024-05-01", "2024-05-09"], "cities": ""}, min_days=6, chunk_days=4)
+        self.assertEqual([(c["first"], c["last"]) for c in by_days], [(1, 4), (5, 8), (9, 9)])
+        self.assertEqual(split_trip({"dates": ["2024-05-01", "2024-05-03"], "cities": ""}), [])
+
+        parts = [{"title": "A", "days": [{"day": 1}, {"day": 2}, {"day": 3}]}, {"title": "B", "days": [{"day": 1}] * 2},
+                 None]
+        self.assertEqual([day["day"] for day in stitch(parts, by_city, partial=True)["days"]], [1, 2, 3, 4, 5])
+        parts[2] = {"days": []}
+        with self.assertRaises(ValueError):
+            stitch(parts, by_city)
+
+    def test_stitch_merges_summaries(self):
+        # Test ID: Fan-out plan fields
+        # Description: Each city chunk answers with its own title, summary and tips.
+        # Expected results: First title, summaries joined in day order, tips concatenated without repeats.
+        chunks = split_trip({"dates": ["2024-05-01", "2024-05-04"], "cities": "Budapest, Vienna"})
+        parts = [{"title": "Budapest", "days": [{}, {}], "summary": "Two days in Budapest.", "tips": ["Cash"]},
+                 {"title": "Vienna", "days": [{}, {}], "summary": "Two days in Vienna.", "tips": ["Cash", "Opera"]}]
+        plan = stitch(parts, chunks)
+        self.assertEqual((plan["title"], plan["summary"], plan["tips"]),
+                         ("Budapest", "Two days in Budapest. Two days in Vienna.", ["Cash", "Opera"]))
+        self.assertEqual(stitch([parts[0], None], chunks, partial=True)["summary"], "Two days in Budapest.")
+
+    def test_failed_chunk_falls_back(self):
+        # Test ID: Fan-out chunk failure
+        # Description: One chunk answers with invalid JSON while the others are still generating.
+        # Expected results: The other chunks are cancelled and the trip is generated in one piece instead.
+        cancelled = []
+
+        async def complete_plan(prompt, user, priority=None, on_progress=None, route=None):
+            if "days 1 to" in prompt:
+                raise json.JSONDecodeError("Unterminated string", prompt, 0)
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(prompt)
+                raise
+
+        async def generate_plan(user_message, user, priority=None, on_progress=None, route=None):
+            return "one-piece", None
+
+        chunks = split_trip({"dates": ["2024-05-01", "2024-05-09"], "cities": ""}, min_days=6, chunk_days=4)
+        with mock.patch.object(api, "complete_plan", complete_plan), mock.patch.object(api, "generate_plan",
+                                                                                       generate_plan):
+            plan_ref = asyncio.run(asyncio.wait_for(api.generate_fanout_plan("Plan a trip.", "natali", chunks), 2))
+        self.assertEqual(plan_ref, "one-piece")
+        self.assertEqual(len(cancelled), 2)
+
+
+class TestPregeneration(unittest.TestCase):
+    # test choosing the trips to pre-generate
+    def test_candidates(self):
+        # Test ID: Pre-generation candidates
+        # Description: Demand is counted per destination, vacation type and trip length; one combination is popular
+        #              for an upcoming trip, one only for a trip already started, one already has a live plan.
+        # Expected results: Only the upcoming trip without a plan is generated, under its own request key.
+        trip = {"vacationType": "Family Vacation", "destCountry": "Budapest", "dates": ["2026-05-08", "2026-05-12"]}
+        self.assertEqual(demand_key(canonical_request(dict(trip, budget=[1, 2]))),
+                         demand_key(canonical_request(dict(trip, budget=[3, 4], dates=["2026-06-01", "2026-06-05"]))))
+
+        upcoming = {"_id": "budapest", "count": 5, "sample": trip}
+        started = {"_id": "vienna", "count": 9, "sample": dict(trip, destCountry="Vienna",
+                                                              dates=["2025-12-30", "2026-01-03"])}
+        covered = {"_id": "rome", "count": 4, "sample": dict(trip, destCountry="Rome")}
+
+        class Demand:
+            def popular(self, limit, since, min_count):
+                return [started, upcoming, covered]
+
+        class Plans:
+            def keys_present(self, keys):
+                return {key for key in keys if key == request_key(canonical_request(covered["sample"]))}
+
+        pregenerator = Pregenerator(Demand(), Plans(), None, None)
+        candidates = pregenerator.candidates(datetime(2026, 1, 1, 3))
+        self.assertEqual([doc["_id"] for doc in candidates], ["budapest"])
+        self.assertEqual(candidates[0]["key"], request_key(canonical_request(trip)))
+
+
+class TestModelRouter(unittest.TestCase):
+    # test model tier selection
+    def test_route_by_complexity_and_latency(self):
+        # Test ID: Model routing
+        # Description: Short trips go to the fast tier, long or multi-city trips to the strong one,
+        #              and the fast tier is skipped while it is clearly slower.
+        # Expected results: fast, strong, strong, then strong for a short trip once fast is slow.
+        router = ModelRouter([Tier("fast", "small", 2048, 4), Tier("strong", "large", 4096)])
+        weekend = {"vacationType": "Couple Vacation", "dates": ["2024-05-03", "2024-05-05"], "cities": ""}
+        self.assertEqual(router.route(weekend).tier.name, "fast")
+        self.assertEqual(router.route(weekend).max_tokens, 600 + 350 * 3)
+        self.assertEqual(router.route(dict(weekend, dates=[08.05, 12.05])).max_tokens, 2048)
+        self.assertEqual(router.route(dict(weekend, dates=["08/05/2024", "12/05/2024"])).max_tokens, 2048)
+        self.assertEqual(router.route(dict(weekend, dates=["2024-05-01", "2024-05-10"])).tier.name, "strong")
+        self.assertEqual(router.route(dict(weekend, cities="Rome, Florence")).tier.name, "strong")
+        router.seconds_per_token = {"small": 0.05, "large": 0.01}
+        self.assertEqual(router.route(weekend).tier.name, "strong")
+
+
+class TestTemplateCompaction(unittest.TestCase):
+    # test template deduplication and token ceiling
+    def test_compact_template(self):
+        # Test ID: Template compaction
+        # Description: Repeated learned clauses are kept once, the oldest are dropped above the token ceiling.
+        # Expected results: Deduplicated clauses, base text with placeholders always kept as written.
+        base = "Trip to {to_country} for {ages}. In addition, keep it cheap."
+        additions = ["pools.", "Pools. ", "museums", "pools."]
+        self.assertEqual(compact_template(base, additions, 1000), ["pools.", "museums"])
+        self.assertEqual(compact_template(base, additions, 21), ["museums"])
+        self.assertEqual(compact_template(base, additions, 1), [])
+        self.assertEqual(join_template(base, ["museums"]), base + " In addition, museums")
+        # Clauses the base already says are not added again
+        self.assertEqual(compact_template(base, ["Keep it cheap", "museums"], 1000), ["museums"])
+        # A template saved before base and additions were kept apart is split after its last placeholder
+        legacy = "Trip to {to_country}. In addition, keep it cheap for {ages}."
+        self.assertEqual(template_parts({"template": legacy + " In addition, pools. In addition, {{museums}}"}),
+                         (legacy, ["pools.", "{{museums}}"]))
+        self.assertEqual(template_parts({"template": "Trip. In addition, pools."}), ("Trip. In addition, pools.", []))
+        self.assertEqual(template_parts({"template": "x", "base": base, "additions": ["museums"]}),
+                         (base, ["museums"]))
+
+
+class TestTokenBudget(unittest.TestCase):
+    # test local prompt counting and output budgets
+    def test_fit_prompt(self):
+        # Test ID: Token budget
+        # Description: The output budget grows with the trip and shrinks to what the context window leaves,
+        #              prompts that leave no room for an answer are refused.
+        # Expected results: Budgets capped as expected, PromptTooLarge for an oversized prompt.
+        self.assertEqual(plan_output_budget(3), 600 + 350 * 3)
+        self.assertEqual(plan_output_budget(30), 4096)
+        self.assertEqual(plan_output_budget(None), 4096)
+        self.assertEqual(fit_prompt("word " * 100, "gpt-4", 1000, "test", record=False), 1000)
+        self.assertLess(fit_prompt("x" * 4 * 6000, "gpt-4", 4096, "test", record=False), 4096)
+        with self.assertRaises(PromptTooLarge):
+            fit_prompt("x" * 4 * 8000, "gpt-4", 4096, "test", record=False)
+
+
+class TestGenerationJobs(unittest.TestCase):
+    # test cancelling a superseded generation
+    def test_cancel_job(self):
+        # Test ID: Generation cancel
+        # Description: Start two generations and cancel the first one, as a newer request for the email would.
+        # Expected results: The first task is cancelled, the second finishes, no job is left registered.
+        async def scenario():
+            jobs = GenerationJobs()
+            first = jobs.start("first", asyncio.sleep(10))
+            second = jobs.start("second", asyncio.sleep(0.01))
+            jobs.cancel("first")
+            jobs.invalidate("unknown")
+            await asyncio.gather(first, second, return_exceptions=True)
+            return first.cancelled(), second.cancelled(), jobs.tasks
+
+        self.assertEqual(asyncio.run(scenario()), (True, False, {}))
+
+    def test_cancel_all_at_shutdown(self):
+        # Test ID: Generation shutdown
+        # Description: The worker shuts down while two generations are running.
+        # Expected results: Both tasks are cancelled and no job is left registered.
+        async def scenario():
+            jobs = GenerationJobs()
+            jobs.start("first", asyncio.sleep(10), "natali")
+            jobs.start("second", asyncio.sleep(10))
+            tasks = jobs.cancel_all()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            return [task.cancelled() for task in tasks], jobs.tasks, jobs.jobs_by_email
+
+        self.assertEqual(asyncio.run(scenario()), ([True, True], {}, {}))
+
+
+class TestGenerationEstimate(unittest.TestCase):
+    # test completion estimates from recent latency
+    def test_latency_estimate(self):
+        # Test ID: Generation ETA
+        # Description: Record model latencies for two prompt sizes and ask for estimates.
+        # Expected results: Default until enough calls, then the 75th percentile bucket for the prompt size,
+        #                   and the model's overall figure for an unseen prompt size.
+        estimator = LatencyEstimator(default_seconds=60, min_samples=4)
+        self.assertEqual(estimator.estimate("gpt-4", 400), 60)
+        for seconds in (8, 9, 12, 14):
+            estimator.record("gpt-4", 400, seconds)
+        self.assertEqual(estimator.estimate("gpt-4", 450), 15)
+        for seconds in (40, 50, 55, 58):
+            estimator.record("gpt-4", 3000, seconds)
+        self.assertEqual(estimator.estimate("gpt-4", 3000), 60)
+        self.assertEqual(estimator.estimate("gpt-4", 100000), 60)
+        self.assertEqual(estimator.estimate("gpt-3.5-turbo", 400), 60)
+
+
+class TestPlanWaiters(unittest.TestCase):
+    # test long-poll wake-ups
+    def test_wake_waiters(self):
+        # Test ID: Long polling
+        # Description: Two requests wait for one email's plan, another waits for a different email.
+        # Expected results: The finished email's waiters wake up, the other one times out, nothing stays registered.
+        async def scenario():
+            waiters = PlanWaiters()
+            events = [waiters.watch("a"), waiters.watch("a"), waiters.watch("b")]
+            tasks = [asyncio.create_task(waiters.wait(event, 0.5)) for event in events]
+            await asyncio.sleep(0.01)
+            waiters.publish("a")
+            results = await asyncio.gather(*tasks)
+            for email, event in zip(["a", "a", "b"], events):
+                waiters.unwatch(email, event)
+            return results, waiters.events
+
+        self.assertEqual(asyncio.run(scenario()), ([True, True, False], {}))
+
+    def test_event_delivered_once(self):
+        # Test ID: Long polling after an earlier event
+        # Description: Another worker publishes a plan event, then a new request starts waiting for the same email
+        #              while the bus polls again over the same overlap window.
+        # Expected results: The first waiter wakes up, the later one is not woken by the old event and times out.
+        class Events:
+            def __init__(self):
+                self.docs = []
+
+            def create_index(self, *args, **kwargs):
+                pass
+
+            def insert_one(self, doc):
+                self.docs.append(dict(doc, _id=len(self.docs)))
+
+            def find(self, query, projection=None):
+                return [doc for doc in self.docs if doc["at"] >= query["at"]["$gte"]]
+
+        async def scenario():
+            bus = InvalidationBus(Events())
+            waiters = PlanWaiters(bus)
+            first = waiters.watch("natali")
+            bus.collection.insert_one({"cache": waiters.name, "key": "natali", "at": datetime.utcnow()})
+            bus.poll()
+            woken = await waiters.wait(first, 0.2)
+            waiters.unwatch("natali", first)
+            later = waiters.watch("natali")
+            bus.poll()
+            return woken, await waiters.wait(later, 0.2)
+
+        self.assertEqual(asyncio.run(scenario()), (True, False))
+
+
 if __name__ == '__main__':
     unittest.main()
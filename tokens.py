@@ -0,0 +1,87 @@
+"""
+Local prompt-size estimates, so sizes are known before anything is sent to the model.
+
+count_tokens uses tiktoken when it is installed (optional dependency - pip install tiktoken) and falls back to
+about 4 characters per token, which is close for English prose on the GPT models.
+"""
+import os
+import threading
+from metrics import metrics
+
+CHARS_PER_TOKEN = 4
+TOKEN_BUCKETS = (250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+# Context window per model (prompt + answer), LLM_CONTEXT_TOKENS overrides it for every model
+CONTEXT_WINDOWS = {"gpt-4-turbo": 128000, "gpt-4-turbo-preview": 128000, "gpt-4o": 128000, "gpt-4": 8192,
+                   "gpt-3.5-turbo": 16385}
+DEFAULT_CONTEXT_WINDOW = 8192
+# Prompts above this are refused whatever the window - a prompt this long is a bug, not a trip
+PROMPT_MAX_TOKENS = int(os.getenv("PROMPT_MAX_TOKENS", "12000"))
+# Below this many tokens left for the answer, a plan can't be complete
+MIN_OUTPUT_TOKENS = 500
+
+# Output budget of a plan - base plus per day
+BASE_TOKENS = 600
+TOKENS_PER_DAY = 350
+
+_encodings = {}
+_lock = threading.Lock()
+
+
+class PromptTooLarge(ValueError):
+    pass
+
+
+def estimate_tokens(text: str):
+    return -(-len(text or "") // CHARS_PER_TOKEN)
+
+
+def _encoding(model: str):
+    with _lock:
+        if model not in _encodings:
+            try:
+                import tiktoken
+
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except Exception:
+                # Not installed, unknown model or encoding not downloadable - estimate instead
+                _encodings[model] = None
+        return _encodings[model]
+
+
+def count_tokens(text: str, model: str = None):
+    encoding = _encoding(model) if model else None
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text or "", disallowed_special=()))
+
+
+def context_window(model: str):
+    if os.getenv("LLM_CONTEXT_TOKENS"):
+        return int(os.getenv("LLM_CONTEXT_TOKENS"))
+    return CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+
+
+def plan_output_budget(days: int, cap: int = 4096):
+    if not days:
+        # Trip length unknown - a short budget would truncate a long plan
+        return cap
+    return min(cap, BASE_TOKENS + TOKENS_PER_DAY * days)
+
+
+def fit_prompt(prompt: str, model: str, max_tokens: int, purpose: str, min_output: int = MIN_OUTPUT_TOKENS,
+               record: bool = True):
+    """
+    Counts the prompt and returns the output budget that still fits the model's context window (at most max_tokens).
+    Raises PromptTooLarge, before any network call, when the prompt is over PROMPT_MAX_TOKENS or leaves less than
+    min_output tokens for the answer. Prompt sizes go to the llm_prompt_tokens_<purpose> histogram.
+    """
+    tokens = count_tokens(prompt, model)
+    if record:
+        metrics.observe(f"llm_prompt_tokens_{purpose}", tokens, buckets=TOKEN_BUCKETS)
+    available = context_window(model) - tokens
+    if tokens > PROMPT_MAX_TOKENS or available < min(min_output, max_tokens):
+        if record:
+            metrics.increment(f"llm_prompts_rejected_{purpose}")
+        raise PromptTooLarge(f"Prompt of {tokens} tokens is too large for {model}")
+    return min(max_tokens, available)